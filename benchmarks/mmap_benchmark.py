@@ -0,0 +1,109 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2016 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compares parse and save times of the read and memory map backends.
+
+Synthesizes a file with a multi-GB mdat followed by the moov (see
+synthesize.py), then times loading + parsing and injecting + saving with
+mpeg.load(fh) and mpeg.load(fh, memory_map=True). Saves go both to a
+file (kernel copies) and to a pipe, which is written from Python.
+
+    python benchmarks/mmap_benchmark.py [--size-gb 2] [--directory /tmp]
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                ".."))
+from spatialmedia import metadata_utils
+from spatialmedia import mpeg
+
+import synthesize
+
+
+def time_parse(path, memory_map):
+    start = time.perf_counter()
+    with open(path, "rb") as in_fh:
+        mpeg4_file = mpeg.load(in_fh, memory_map=memory_map)
+        metadata_utils.parse_spherical_mpeg4(
+            mpeg4_file, mpeg4_file.reader, lambda x: None)
+        mpeg4_file.close()
+    return time.perf_counter() - start
+
+
+def time_save(path, memory_map, output):
+    start = time.perf_counter()
+    with open(path, "rb") as in_fh:
+        mpeg4_file = mpeg.load(in_fh, memory_map=memory_map)
+        metadata_utils.mpeg4_add_spherical_v2(
+            mpeg4_file, mpeg4_file.reader, "equirectangular", None, None)
+        if output is None:
+            drain = subprocess.Popen(["cat"], stdin=subprocess.PIPE,
+                                     stdout=subprocess.DEVNULL)
+            mpeg4_file.save(mpeg4_file.reader, drain.stdin)
+            drain.stdin.close()
+            drain.wait()
+        else:
+            with open(output, "wb") as out_fh:
+                mpeg4_file.save(mpeg4_file.reader, out_fh)
+        mpeg4_file.close()
+    return time.perf_counter() - start
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--size-gb", type=float, default=2.0)
+    parser.add_argument("--directory", default=None)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args(args)
+
+    directory = tempfile.mkdtemp(dir=args.directory)
+    path = os.path.join(directory, "input.mp4")
+    output = os.path.join(directory, "output.mp4")
+    size = int(args.size_gb * 1024 * 1024 * 1024)
+    synthesize.synthesize(path, synthesize.make_config(mdat_size=size))
+
+    results = {"file_size": os.path.getsize(path)}
+    try:
+        for backend, memory_map in (("read", False), ("mmap", True)):
+            results[backend] = {
+                "parse_seconds": min(time_parse(path, memory_map)
+                                     for i in range(args.repeat)),
+                "save_to_file_seconds": min(
+                    time_save(path, memory_map, output)
+                    for i in range(args.repeat)),
+                "save_to_pipe_seconds": min(
+                    time_save(path, memory_map, None)
+                    for i in range(args.repeat)),
+            }
+    finally:
+        for name in (path, output):
+            if os.path.exists(name):
+                os.remove(name)
+        os.rmdir(directory)
+
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
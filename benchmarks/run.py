@@ -0,0 +1,283 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2016 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmarks loading, parsing, injecting and saving synthetic files.
+
+For every case of a suite a file is synthesized (see synthesize.py) and the
+following operations are timed, each run in a fresh process:
+
+  load:   mpeg.load of the file
+  parse:  metadata_utils.parse_metadata
+  inject: metadata_utils.inject_metadata of spherical v1 metadata
+  save:   Mpeg4Container.save after adding spherical v2 metadata
+
+For each operation the fastest of --repeat runs is reported with its
+throughput over the file size, the peak RSS of its process and the read and
+write system calls it made (from /proc/self/io, null where unavailable).
+Results are printed as JSON; --compare prints the change in time of every
+operation against the results of an earlier run.
+
+    python benchmarks/run.py [--suite quick|full] [--directory DIR]
+        [--repeat N] [--output results.json] [--compare baseline.json]
+"""
+
+import argparse
+import concurrent.futures
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                ".."))
+from spatialmedia import metadata_utils
+from spatialmedia import mpeg
+
+import synthesize
+
+FORMAT_VERSION = 1
+
+OPERATIONS = ("load", "parse", "inject", "save")
+
+MIB = 1024 * 1024
+
+
+def quick_suite():
+    return [
+        synthesize.make_config(),
+        synthesize.make_config(layout="moov-before"),
+        synthesize.make_config(layout="fragmented"),
+        synthesize.make_config(table="co64", entries=10 ** 5),
+        synthesize.make_config(tracks=8),
+    ]
+
+
+def full_suite():
+    suite = []
+    for table in ("stco", "co64"):
+        for exponent in range(3, 8):
+            suite.append(synthesize.make_config(table=table,
+                                                entries=10 ** exponent))
+    for mdat_size in (256 * MIB, 1024 * MIB, 4096 * MIB):
+        suite.append(synthesize.make_config(mdat_size=mdat_size,
+                                            table="co64"))
+    for tracks in (4, 16):
+        suite.append(synthesize.make_config(tracks=tracks, entries=10 ** 5))
+    for layout in ("moov-before", "fragmented"):
+        suite.append(synthesize.make_config(layout=layout,
+                                            mdat_size=1024 * MIB))
+    suite.append(synthesize.make_config(layout="fragmented", fragments=1024,
+                                        mdat_size=1024 * MIB))
+    return suite
+
+
+SUITES = {"quick": quick_suite, "full": full_suite}
+
+
+def case_name(config):
+    """Returns a stable name for a case, used to match cases across runs."""
+    name = "%s/%s-%d/%d-track/%dMiB" % (
+        config["layout"], config["table"], config["entries"],
+        config["tracks"], config["mdat_size"] // MIB)
+    if config["layout"] == "fragmented":
+        name += "/%d-fragments" % config["fragments"]
+    return name
+
+
+def io_counters():
+    """Returns the read and write system calls made by this process."""
+    counters = {}
+    try:
+        with open("/proc/self/io") as fh:
+            for line in fh:
+                key, value = line.split(":")
+                counters[key] = int(value)
+    except (OSError, ValueError):
+        return None
+    return {"read": counters.get("syscr"), "write": counters.get("syscw")}
+
+
+def spherical_metadata():
+    metadata = metadata_utils.Metadata()
+    metadata.video = metadata_utils.generate_spherical_xml()
+    return metadata
+
+
+def prepare(operation, path, output):
+    """Sets up an operation.
+
+    Returns:
+      (run, cleanup), functions running the timed part of the operation and
+      releasing what the setup holds on to.
+    """
+    def ignore(line):
+        pass
+
+    if operation == "load":
+        def run():
+            with open(path, "rb") as fh:
+                mpeg.load(fh)
+        return run, lambda: None
+
+    if operation == "parse":
+        return (lambda: metadata_utils.parse_metadata(path, ignore),
+                lambda: None)
+
+    if operation == "inject":
+        metadata = spherical_metadata()
+        return (lambda: metadata_utils.inject_metadata(path, output, metadata,
+                                                       ignore),
+                lambda: None)
+
+    in_fh = open(path, "rb")
+    mpeg4_file = mpeg.load(in_fh)
+    metadata_utils.mpeg4_add_spherical_v2(
+        mpeg4_file, mpeg4_file.reader, "equirectangular", None, None)
+
+    def run():
+        with open(output, "wb") as out_fh:
+            mpeg4_file.save(mpeg4_file.reader, out_fh)
+
+    def cleanup():
+        mpeg4_file.close()
+        in_fh.close()
+
+    return run, cleanup
+
+
+def measure(operation, path, output):
+    """Runs one operation. Meant to be called in a fresh process."""
+    run, cleanup = prepare(operation, path, output)
+    before = io_counters()
+    start = time.perf_counter()
+    run()
+    seconds = time.perf_counter() - start
+    after = io_counters()
+    cleanup()
+
+    syscalls = None
+    if before is not None and after is not None:
+        syscalls = dict((key, after[key] - before[key]) for key in after)
+    return {
+        "seconds": seconds,
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "syscalls": syscalls,
+    }
+
+
+def measure_in_process(operation, path, output, context):
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=1, mp_context=context) as executor:
+        return executor.submit(measure, operation, path, output).result()
+
+
+def run_case(config, directory, repeat, context):
+    path = os.path.join(directory, "input.mp4")
+    output = os.path.join(directory, "output.mp4")
+    file_size = synthesize.synthesize(path, config)
+    results = {}
+    try:
+        for operation in OPERATIONS:
+            runs = [measure_in_process(operation, path, output, context)
+                    for _ in range(repeat)]
+            result = min(runs, key=lambda run: run["seconds"])
+            result["mb_per_s"] = (file_size / MIB /
+                                  max(result["seconds"], 1e-9))
+            results[operation] = result
+    finally:
+        for name in (path, output):
+            if os.path.exists(name):
+                os.remove(name)
+    return {"name": case_name(config), "config": config,
+            "file_size": file_size, "results": results}
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(baseline, report):
+    """Prints the time of each operation relative to baseline."""
+    baseline_cases = dict((case["name"], case) for case in baseline["cases"])
+    for case in report["cases"]:
+        old_case = baseline_cases.get(case["name"])
+        if old_case is None:
+            continue
+        for operation in OPERATIONS:
+            old = old_case["results"].get(operation)
+            new = case["results"].get(operation)
+            if not old or not new:
+                continue
+            print("%-60s %-6s %10.4fs -> %10.4fs (%+.1f%%)" % (
+                case["name"], operation, old["seconds"], new["seconds"],
+                100.0 * (new["seconds"] - old["seconds"]) /
+                max(old["seconds"], 1e-9)), file=sys.stderr)
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--suite", choices=sorted(SUITES), default="quick")
+    parser.add_argument("--directory", default=None,
+                        help="where to write the synthetic files")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", default=None,
+                        help="file to write the JSON results to")
+    parser.add_argument("--compare", default=None, metavar="BASELINE",
+                        help="JSON results of an earlier run to compare to")
+    args = parser.parse_args(args)
+
+    context = multiprocessing.get_context("spawn")
+    directory = tempfile.mkdtemp(dir=args.directory)
+    try:
+        cases = [run_case(config, directory, args.repeat, context)
+                 for config in SUITES[args.suite]()]
+    finally:
+        os.rmdir(directory)
+
+    report = {
+        "format_version": FORMAT_VERSION,
+        "suite": args.suite,
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "repeat": args.repeat,
+        "cases": cases,
+    }
+    contents = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as fh:
+            fh.write(contents + "\n")
+    else:
+        print(contents)
+
+    if args.compare:
+        with open(args.compare) as fh:
+            compare(json.load(fh), report)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
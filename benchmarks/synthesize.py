@@ -0,0 +1,262 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2016 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Synthesizes MP4 files for benchmarking.
+
+Files have a configurable mdat size, number of video tracks, chunk offset
+table type and size and box layout:
+
+  moov-after:  ftyp, mdat, moov (as written by most encoders)
+  moov-before: ftyp, moov, mdat (as written for progressive download)
+  fragmented:  ftyp, moov (with mvex), sidx, fragments of moof + mdat, mfra
+
+The sample tables only hold what the metadata tools look at; the files are
+not playable.
+
+    python benchmarks/synthesize.py output.mp4 [--mdat-size N] [--tracks N]
+        [--table stco|co64] [--entries N] [--layout LAYOUT] [--fragments N]
+"""
+
+import argparse
+import json
+import os
+import struct
+import sys
+
+LAYOUTS = ("moov-after", "moov-before", "fragmented")
+
+DEFAULT_CONFIG = {
+    "mdat_size": 64 * 1024 * 1024,
+    "tracks": 1,
+    "table": "stco",
+    "entries": 1000,
+    "layout": "moov-after",
+    "fragments": 16,
+    "sparse": False,
+}
+
+BLOCK_SIZE = 16 * 1024 * 1024
+
+
+def make_config(**overrides):
+    """Returns DEFAULT_CONFIG updated with overrides."""
+    config = dict(DEFAULT_CONFIG)
+    for key, value in overrides.items():
+        if key not in config:
+            raise ValueError("unknown configuration key: %s" % key)
+        config[key] = value
+    if config["layout"] not in LAYOUTS:
+        raise ValueError("unknown layout: %s" % config["layout"])
+    if config["table"] not in ("stco", "co64"):
+        raise ValueError("unknown chunk offset table: %s" % config["table"])
+    return config
+
+
+def box(name, *payload):
+    payload = b"".join(payload)
+    return struct.pack(">I4s", 8 + len(payload), name) + payload
+
+
+def full_box(name, version, flags, *payload):
+    return box(name, struct.pack(">I", (version << 24) | flags), *payload)
+
+
+def chunk_offset_box(table, offsets):
+    """Returns an stco or co64 box holding offsets."""
+    if table == "stco":
+        if offsets and offsets[-1] > 0xFFFFFFFF:
+            raise ValueError("chunk offsets do not fit an stco table, "
+                             "use co64")
+        typecode = "I"
+    else:
+        typecode = "Q"
+    return full_box(table.encode("ascii"), 0, 0,
+                    struct.pack(">I%d%s" % (len(offsets), typecode),
+                                len(offsets), *offsets))
+
+
+def video_track(track_id, table, offsets):
+    """Returns a trak box with an avc1 sample description."""
+    avc1 = box(b"avc1",
+               bytes(6), struct.pack(">H", 1),   # reserved, data ref index
+               bytes(16),                        # pre-defined and reserved
+               struct.pack(">HHIIIH", 320, 240, 0x480000, 0x480000, 0, 1),
+               bytes(32),                        # compressor name
+               struct.pack(">Hh", 24, -1))
+    stbl = box(b"stbl",
+               full_box(b"stsd", 0, 0, struct.pack(">I", 1), avc1),
+               full_box(b"stts", 0, 0, struct.pack(">III", 1, len(offsets),
+                                                    1)),
+               full_box(b"stsc", 0, 0, struct.pack(">IIII", 1, 1, 1, 1)),
+               full_box(b"stsz", 0, 0, struct.pack(">II", 1, len(offsets))),
+               chunk_offset_box(table, offsets))
+    minf = box(b"minf",
+               full_box(b"vmhd", 0, 1, bytes(8)),
+               box(b"dinf", full_box(b"dref", 0, 0, struct.pack(">I", 1),
+                                     full_box(b"url ", 0, 1))),
+               stbl)
+    mdia = box(b"mdia",
+               full_box(b"mdhd", 0, 0, bytes(8),
+                        struct.pack(">II", 90000, len(offsets)), bytes(4)),
+               full_box(b"hdlr", 0, 0, bytes(4), b"vide", bytes(12),
+                        b"VideoHandler\0"),
+               minf)
+    tkhd = full_box(b"tkhd", 0, 3, bytes(8), struct.pack(">I", track_id),
+                    bytes(60), struct.pack(">II", 320 << 16, 240 << 16))
+    return box(b"trak", tkhd, mdia)
+
+
+def movie_box(config, mdat_payload_start):
+    """Returns the moov box with chunk offsets into the mdat payload."""
+    entries = config["entries"]
+    if config["layout"] == "fragmented":
+        entries = 0
+    stride = config["mdat_size"] // max(entries, 1)
+    offsets = [mdat_payload_start + i * stride for i in range(entries)]
+
+    children = [full_box(b"mvhd", 0, 0, bytes(8),
+                         struct.pack(">II", 90000, 0), bytes(76),
+                         struct.pack(">I", config["tracks"] + 1))]
+    for track in range(config["tracks"]):
+        children.append(video_track(track + 1, config["table"], offsets))
+    if config["layout"] == "fragmented":
+        children.append(box(b"mvex", *[
+            full_box(b"trex", 0, 0,
+                     struct.pack(">IIIII", track + 1, 1, 0, 0, 0))
+            for track in range(config["tracks"])]))
+    return box(b"moov", *children)
+
+
+def fragment_header(sequence, data_offset_base, samples, tracks):
+    """Returns a moof box for one fragment.
+
+    Each track fragment has a tfhd with an absolute base data offset and a
+    trun whose data offset is relative to it.
+    """
+    trafs = []
+    for track in range(tracks):
+        tfhd = full_box(b"tfhd", 0, 0x1,
+                        struct.pack(">IQ", track + 1, data_offset_base))
+        trun = full_box(b"trun", 0, 0x201,
+                        struct.pack(">Ii", samples, 0),
+                        struct.pack(">%dI" % samples, *([0] * samples)))
+        trafs.append(box(b"traf", tfhd, trun))
+    return box(b"moof", full_box(b"mfhd", 0, 0, struct.pack(">I", sequence)),
+               *trafs)
+
+
+def write_payload(fh, size, sparse, block):
+    """Writes size bytes of mdat payload."""
+    if sparse:
+        fh.seek(size, 1)
+        return
+    remaining = size
+    while remaining > 0:
+        fh.write(block[:min(len(block), remaining)])
+        remaining -= len(block)
+
+
+def write_mdat(fh, size, sparse, block):
+    fh.write(struct.pack(">I4sQ", 1, b"mdat", size + 16))
+    write_payload(fh, size, sparse, block)
+
+
+def write_fragments(fh, config, block):
+    """Writes sidx, the moof + mdat fragments and mfra."""
+    fragments = max(config["fragments"], 1)
+    fragment_size = config["mdat_size"] // fragments
+    samples = max(config["entries"] // fragments, 1)
+    moof_size = len(fragment_header(1, 0, samples, config["tracks"]))
+    fragment_total = moof_size + 16 + fragment_size
+
+    sidx = full_box(b"sidx", 1, 0,
+                    struct.pack(">IIQQHH", 1, 90000, 0, 0, 0, fragments),
+                    b"".join(struct.pack(">III", fragment_total, 1, 0)
+                             for _ in range(fragments)))
+    fh.write(sidx)
+
+    moof_positions = []
+    for index in range(fragments):
+        position = fh.tell()
+        moof_positions.append(position)
+        moof = fragment_header(index + 1, position + moof_size + 16,
+                               samples, config["tracks"])
+        fh.write(moof)
+        write_mdat(fh, fragment_size, config["sparse"], block)
+
+    tfras = [full_box(b"tfra", 1, 0,
+                      struct.pack(">II", track + 1, 0),
+                      struct.pack(">I", fragments),
+                      b"".join(struct.pack(">QQBBB", index * 90000, position,
+                                           1, 1, 1)
+                               for index, position in
+                               enumerate(moof_positions)))
+             for track in range(config["tracks"])]
+    mfro_size = 16
+    mfra_size = 8 + sum(len(tfra) for tfra in tfras) + mfro_size
+    fh.write(box(b"mfra", *(tfras + [
+        full_box(b"mfro", 0, 0, struct.pack(">I", mfra_size))])))
+
+
+def synthesize(path, config):
+    """Writes a file described by config to path.
+
+    Args:
+      path: string, output file.
+      config: dictionary, see DEFAULT_CONFIG.
+
+    Returns:
+      int, size of the written file.
+    """
+    config = make_config(**config)
+    ftyp = box(b"ftyp", b"isom", struct.pack(">I", 512), b"isomiso2avc1mp41")
+    block = os.urandom(min(BLOCK_SIZE, max(config["mdat_size"], 1)))
+
+    with open(path, "wb") as fh:
+        fh.write(ftyp)
+        if config["layout"] == "moov-after":
+            write_mdat(fh, config["mdat_size"], config["sparse"], block)
+            fh.write(movie_box(config, len(ftyp) + 16))
+        elif config["layout"] == "moov-before":
+            moov_size = len(movie_box(config, 0))
+            fh.write(movie_box(config, len(ftyp) + moov_size + 16))
+            write_mdat(fh, config["mdat_size"], config["sparse"], block)
+        else:
+            fh.write(movie_box(config, 0))
+            write_fragments(fh, config, block)
+        fh.truncate()
+        return fh.tell()
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("output")
+    for key, value in sorted(DEFAULT_CONFIG.items()):
+        option = "--" + key.replace("_", "-")
+        if isinstance(value, bool):
+            parser.add_argument(option, action="store_true")
+        else:
+            parser.add_argument(option, type=type(value), default=value)
+    args = vars(parser.parse_args(args))
+    output = args.pop("output")
+    size = synthesize(output, args)
+    print(json.dumps({"file": output, "file_size": size, "config": args},
+                     sort_keys=True))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
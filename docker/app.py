@@ -1,21 +1,13 @@
+import mimetypes
 import os
-import sys
 import tempfile
 import zipfile
 import shutil
 from werkzeug.utils import secure_filename
-from flask import Flask, render_template, request, send_file, jsonify, after_this_request
-
-# Ensure we can import spatialmedia
-# Assuming the Dockerfile places spatialmedia in a reachable location or we are running from root
-try:
-    from spatialmedia import metadata_utils
-    from spatialmedia import mpeg
-except ImportError:
-    # Fallback for local dev if running from docker folder
-    sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
-    from spatialmedia import metadata_utils
-    from spatialmedia import mpeg
+from flask import Flask, Response, render_template, request, send_file, jsonify, after_this_request
+
+import jobs
+import virtual
 
 app = Flask(__name__)
 # Use a static path so all workers access the same directory
@@ -26,14 +18,6 @@ app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024 * 1024  # 16GB max upload
 # Ensure upload folder exists
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 
-class Console:
-    def __init__(self):
-        self.log = []
-    def append(self, text):
-        self.log.append(text)
-    def __call__(self, text):
-        self.append(text)
-
 @app.route('/')
 def index():
     return render_template('index.html')
@@ -82,66 +66,91 @@ def inject_metadata():
     if not files_to_process:
         return jsonify({'error': 'No files specified'}), 400
 
-    stereo_mode = "none"
-    if options.get('stereo'): # Checkbox for 3D
-         stereo_mode = "top-bottom" # As per GUI logic
-    
-    metadata = metadata_utils.Metadata()
-    if options.get('spherical'):
-        metadata.video = metadata_utils.generate_spherical_xml(stereo=stereo_mode)
-    
-    # Audio handling logic copied from gui.py
-    # Note: In the GUI 'spatial_audio' checkbox is only enabled if supported.
-    # We will assume backend logic needs to re-verify or trust frontend.
-    # For now, simplistic approach:
-    
+    # Files are injected by the worker pool of jobs.py, only queue them here.
     results = []
-    
-    for raw_filename in files_to_process:
-        normalized_filename = raw_filename.replace('\\', '/')
-        if '/' in normalized_filename or '..' in normalized_filename:
-            results.append({
-                'filename': raw_filename,
-                'error': 'Invalid filename detected',
-                'logs': ['Rejected due to unsafe filename path.'],
-                'success': False
-            })
-            continue
+    conn = jobs.connect()
+    try:
+        for raw_filename in files_to_process:
+            normalized_filename = raw_filename.replace('\\', '/')
+            if '/' in normalized_filename or '..' in normalized_filename:
+                results.append({
+                    'filename': raw_filename,
+                    'error': 'Invalid filename detected',
+                    'logs': ['Rejected due to unsafe filename path.'],
+                    'success': False
+                })
+                continue
 
-        filename = secure_filename(raw_filename)
-        input_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        output_filename = f"injected_{filename}"
-        output_path = os.path.join(app.config['UPLOAD_FOLDER'], output_filename)
-        
-        console = Console()
-        try:
-             # Re-parse to get specific audio audio capabilities for this file if needed
-            if options.get('spatial_audio'):
-                parsed = metadata_utils.parse_metadata(input_path, lambda x: None)
-                if parsed and parsed.num_audio_channels:
-                     desc = metadata_utils.get_spatial_audio_description(parsed.num_audio_channels)
-                     if desc.is_supported:
-                         metadata.audio = metadata_utils.get_spatial_audio_metadata(
-                            desc.order,
-                            desc.has_head_locked_stereo
-                        )
-            
-            metadata_utils.inject_metadata(input_path, output_path, metadata, console.append)
+            filename = secure_filename(raw_filename)
+            job_id = jobs.enqueue(conn, filename, options)
             results.append({
                 'filename': filename,
-                'output_url': f"/download/{output_filename}",
-                'logs': console.log,
+                'job_id': job_id,
+                'status_url': f"/jobs/{job_id}",
+                'events_url': f"/jobs/{job_id}/events",
                 'success': True
             })
-        except Exception as e:
-            results.append({
-                'filename': filename,
-                'error': str(e),
-                'logs': console.log,
-                'success': False
-            })
+    finally:
+        conn.close()
+
+    return jsonify({'results': results}), 202
+
+@app.route('/stream/<filename>', methods=['PUT'])
+def stream_inject(filename):
+    # Injects while the raw request body arrives, without storing the upload.
+    # Options are query parameters: ?spherical=1&stereo=1&spatial_audio=1
+    normalized_filename = filename.replace('\\', '/')
+    if '/' in normalized_filename or '..' in normalized_filename:
+        return jsonify({'error': f'Invalid filename detected: {filename}'}), 400
+    filename = secure_filename(filename)
+    options = {name: request.args.get(name) in ('1', 'true')
+               for name in ('spherical', 'stereo', 'spatial_audio')}
+
+    conn = jobs.connect()
+    try:
+        job_id = jobs.run_stream(conn, filename, options, request.stream,
+                                 request.content_length or 0,
+                                 app.config['UPLOAD_FOLDER'])
+        job = jobs.get(conn, job_id)
+    finally:
+        conn.close()
+    return jsonify(job), 200 if job['status'] == jobs.DONE else 422
+
+@app.route('/metrics')
+def metrics():
+    conn = jobs.connect()
+    try:
+        contents = jobs.prometheus_metrics(conn)
+    finally:
+        conn.close()
+    return Response(contents, mimetype='text/plain; version=0.0.4')
 
-    return jsonify({'results': results})
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    conn = jobs.connect()
+    try:
+        job = jobs.get(conn, job_id)
+    finally:
+        conn.close()
+    if job is None:
+        return jsonify({'error': 'Unknown job'}), 404
+    return jsonify(job)
+
+@app.route('/jobs/<job_id>/events')
+def job_event_stream(job_id):
+    return event_stream([job_id])
+
+@app.route('/jobs/events')
+def jobs_event_stream():
+    # One stream for several jobs: ?id=<job>&id=<job>
+    job_ids = request.args.getlist('id')
+    if not job_ids:
+        return jsonify({'error': 'No jobs specified'}), 400
+    return event_stream(job_ids)
+
+def event_stream(job_ids):
+    return Response(jobs.events(job_ids), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 @app.route('/download/<path:filename>')
 def download_file(filename):
@@ -150,7 +159,48 @@ def download_file(filename):
         return "Invalid file path", 400
         
     secure_name = secure_filename(filename)
-    return send_file(os.path.join(app.config['UPLOAD_FOLDER'], secure_name), as_attachment=True)
+    path = os.path.join(app.config['UPLOAD_FOLDER'], secure_name)
+    if not os.path.exists(path) and os.path.exists(path + virtual.SUFFIX):
+        return send_virtual(path + virtual.SUFFIX, secure_name)
+    return send_file(path, as_attachment=True)
+
+def send_virtual(path, download_name):
+    """Serves a virtual output (see virtual.py), honoring Range requests."""
+    try:
+        output = virtual.VirtualFile(path)
+    except virtual.StaleError:
+        return "The uploaded file has changed since it was injected", 410
+
+    headers = {
+        'Accept-Ranges': 'bytes',
+        'Content-Disposition': f'attachment; filename="{download_name}"',
+        'ETag': f'"{output.etag}"',
+    }
+    start, stop, status = 0, output.size, 200
+    range_header = request.headers.get('Range')
+    if_range = request.if_range
+    if if_range.date is not None or (if_range.etag is not None and
+                                     if_range.etag != output.etag):
+        # The client holds another version, send all of it.
+        range_header = None
+    try:
+        byte_range = virtual.byte_range(range_header, output.size)
+    except virtual.RangeError:
+        output.close()
+        return Response(status=416, headers={'Content-Range': f'bytes */{output.size}'})
+    if byte_range is not None:
+        start, stop = byte_range
+        status = 206
+        headers['Content-Range'] = f'bytes {start}-{stop - 1}/{output.size}'
+    headers['Content-Length'] = str(stop - start)
+
+    mimetype = mimetypes.guess_type(download_name)[0] or 'application/octet-stream'
+    if request.method == 'HEAD':
+        output.close()
+        return Response(status=status, headers=headers, mimetype=mimetype)
+    body = output.body(start, stop, request.environ.get('wsgi.file_wrapper'))
+    return Response(body, status=status, headers=headers, mimetype=mimetype,
+                    direct_passthrough=True)
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000, debug=True)
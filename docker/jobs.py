@@ -0,0 +1,504 @@
+"""Background injection jobs for the web service.
+
+Jobs live in a SQLite database next to the uploads, so queued jobs survive
+restarts of both the web server and the workers. Run this module to start
+the worker pool:
+
+    python jobs.py
+
+It starts JOB_WORKERS processes that claim queued jobs one at a time and
+record the progress reported by Mpeg4Container.save while injecting. A
+worker that dies has its job queued again and is replaced; jobs still marked
+as running when the pool starts are queued again as well.
+
+Files uploaded to /stream are injected by the web server as the request body
+arrives (see run_stream) and are recorded as streamed jobs, which no worker
+runs, along with the id of the web server process reading the upload. A
+streamed job still running after that process is gone lost its upload and
+is marked as failed by the pool.
+
+With VIRTUAL_OUTPUTS=1 workers store the output of a job as a virtual file
+(see virtual.py) referring to the media data of the upload instead of
+writing a copy of it.
+
+The timings and counters of every finished job (see spatialmedia.mpeg.stats)
+are added to the metrics table, exported by the web server in the Prometheus
+text format.
+"""
+import json
+import multiprocessing
+import os
+import sqlite3
+import sys
+import time
+import traceback
+import uuid
+
+import virtual
+
+try:
+    from spatialmedia import batch
+    from spatialmedia import cache
+    from spatialmedia import metadata_utils
+    from spatialmedia import mpeg
+except ImportError:
+    # Fallback for local dev if running from docker folder
+    sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+    from spatialmedia import batch
+    from spatialmedia import cache
+    from spatialmedia import metadata_utils
+    from spatialmedia import mpeg
+
+UPLOAD_FOLDER = os.getenv('UPLOAD_FOLDER', '/app/uploads')
+DATABASE = os.getenv('JOBS_DATABASE', os.path.join(UPLOAD_FOLDER, '.jobs.sqlite3'))
+
+# Seconds between polls for new jobs and for job updates.
+POLL_INTERVAL = 0.5
+
+# Keepalive comment interval of the job event streams, in seconds.
+EVENTS_KEEPALIVE = 15
+
+VIRTUAL_OUTPUTS = os.getenv('VIRTUAL_OUTPUTS') == '1'
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+ERROR = 'error'
+FINISHED = (DONE, ERROR)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    filename TEXT NOT NULL,
+    options TEXT NOT NULL,
+    status TEXT NOT NULL,
+    worker INTEGER,
+    bytes_written INTEGER NOT NULL DEFAULT 0,
+    total_bytes INTEGER NOT NULL DEFAULT 0,
+    mb_per_s REAL NOT NULL DEFAULT 0,
+    output_filename TEXT,
+    error TEXT,
+    logs TEXT NOT NULL DEFAULT '[]',
+    stats TEXT,
+    streamed INTEGER NOT NULL DEFAULT 0,
+    created REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created);
+CREATE TABLE IF NOT EXISTS metrics (
+    name TEXT NOT NULL,
+    label TEXT NOT NULL,
+    value REAL NOT NULL,
+    PRIMARY KEY (name, label)
+);
+'''
+
+# Columns added to the jobs table after its creation, for older databases.
+ADDED_COLUMNS = [
+    ('mb_per_s', 'REAL NOT NULL DEFAULT 0'),
+    ('stats', 'TEXT'),
+    ('streamed', 'INTEGER NOT NULL DEFAULT 0'),
+]
+
+
+def connect(path=DATABASE):
+    """Opens the job database, creating it if needed."""
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.executescript(SCHEMA)
+    columns = [row['name'] for row in conn.execute('PRAGMA table_info(jobs)')]
+    for name, definition in ADDED_COLUMNS:
+        if name not in columns:
+            conn.execute(f'ALTER TABLE jobs ADD COLUMN {name} {definition}')
+    return conn
+
+
+def to_dict(row):
+    """Returns the JSON serializable state of a job row."""
+    job = {
+        'id': row['id'],
+        'filename': row['filename'],
+        'status': row['status'],
+        'bytes_written': row['bytes_written'],
+        'total_bytes': row['total_bytes'],
+        'mb_per_s': row['mb_per_s'],
+        'logs': json.loads(row['logs']),
+    }
+    if row['error']:
+        job['error'] = row['error']
+    if row['stats']:
+        job['stats'] = json.loads(row['stats'])
+    if row['status'] == DONE:
+        job['output_url'] = f"/download/{row['output_filename']}"
+    return job
+
+
+def enqueue(conn, filename, options, status=QUEUED, streamed=False,
+            worker=None):
+    """Adds a job injecting metadata into an uploaded file, returns its id."""
+    job_id = uuid.uuid4().hex
+    now = time.time()
+    conn.execute(
+        'INSERT INTO jobs (id, filename, options, status, streamed, worker, '
+        'created, updated) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+        (job_id, filename, json.dumps(options), status, int(streamed), worker,
+         now, now))
+    return job_id
+
+
+def get(conn, job_id):
+    """Returns the state of a job or None if it does not exist."""
+    row = conn.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+    return to_dict(row) if row is not None else None
+
+
+def claim(conn, worker):
+    """Marks the oldest queued job as run by worker and returns its row."""
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        row = conn.execute(
+            'SELECT * FROM jobs WHERE status = ? ORDER BY created LIMIT 1',
+            (QUEUED,)).fetchone()
+        if row is not None:
+            conn.execute(
+                'UPDATE jobs SET status = ?, worker = ?, updated = ? '
+                'WHERE id = ?', (RUNNING, worker, time.time(), row['id']))
+        conn.execute('COMMIT')
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+    return row
+
+
+def requeue(conn, worker=None):
+    """Queues the running jobs of worker (of any worker if None) again."""
+    query = ('UPDATE jobs SET status = ?, worker = NULL, bytes_written = 0, '
+             'updated = ? WHERE status = ? AND NOT streamed')
+    args = [QUEUED, time.time(), RUNNING]
+    if worker is not None:
+        query += ' AND worker = ?'
+        args.append(worker)
+    return conn.execute(query, args).rowcount
+
+
+def abandon_streams(conn):
+    """Marks running streamed jobs whose process is gone as failed.
+
+    Their uploads were lost with the web server process reading them.
+    """
+    rows = conn.execute(
+        'SELECT id, worker FROM jobs WHERE status = ? AND streamed',
+        (RUNNING,)).fetchall()
+    abandoned = 0
+    for row in rows:
+        if row['worker'] is not None and is_alive(row['worker']):
+            continue
+        abandoned += conn.execute(
+            'UPDATE jobs SET status = ?, error = ?, updated = ? '
+            'WHERE id = ? AND status = ?',
+            (ERROR, 'Upload interrupted', time.time(), row['id'],
+             RUNNING)).rowcount
+    return abandoned
+
+
+def is_alive(pid):
+    """Returns whether the process pid exists."""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def build_metadata(options):
+    stereo_mode = "none"
+    if options.get('stereo'): # Checkbox for 3D
+        stereo_mode = "top-bottom" # As per GUI logic
+
+    metadata = metadata_utils.Metadata()
+    if options.get('spherical'):
+        metadata.video = metadata_utils.generate_spherical_xml(stereo=stereo_mode)
+    return metadata
+
+
+def run_job(conn, job, upload_folder, parse_cache=None):
+    """Injects the metadata of a claimed job and records the result."""
+    options = json.loads(job['options'])
+    input_path = os.path.join(upload_folder, job['filename'])
+    output_filename = f"injected_{job['filename']}"
+    output_path = os.path.join(upload_folder, output_filename)
+    log = []
+
+    progress = progress_hook(conn, job['id'])
+    error = None
+    stats = mpeg.Stats()
+    try:
+        metadata = build_metadata(options)
+        # Note: In the GUI 'spatial_audio' checkbox is only enabled if supported.
+        # Re-parse to get specific audio capabilities for this file.
+        if options.get('spatial_audio'):
+            parsed = metadata_utils.parse_metadata(input_path, lambda x: None, parse_cache, stats)
+            if parsed and parsed.num_audio_channels:
+                desc = metadata_utils.get_spatial_audio_description(parsed.num_audio_channels)
+                if desc.is_supported:
+                    metadata.audio = metadata_utils.get_spatial_audio_metadata(
+                        desc.order,
+                        desc.has_head_locked_stereo
+                    )
+
+        if VIRTUAL_OUTPUTS:
+            error = inject_virtual(input_path, output_path, metadata, log,
+                                   parse_cache, progress, stats)
+        else:
+            error = metadata_utils.inject_metadata(
+                input_path, output_path, metadata, log.append, parse_cache,
+                progress=progress, stats=stats)
+            remove(output_path + virtual.SUFFIX)
+        if not error and batch.has_errors(log):
+            error = next(line for line in log if line.startswith('Error'))
+    except Exception as e:
+        log.append(traceback.format_exc())
+        error = str(e)
+
+    finish(conn, job['id'], output_filename, error, log, stats)
+
+
+def inject_virtual(input_path, output_path, metadata, log, parse_cache,
+                   progress, stats):
+    """Injects metadata, storing the output as a virtual file."""
+    if os.path.splitext(input_path)[1].lower() not in metadata_utils.MPEG_FILE_EXTENSIONS:
+        return 'Unknown file type'
+    log.append('Processing: ' + input_path)
+    with mpeg.stats.recording(stats):
+        segments = metadata_utils.inject_mpeg4_segments(
+            input_path, metadata, log.append, parse_cache)
+    if segments is None:
+        return None
+    virtual.write(output_path + virtual.SUFFIX, input_path, segments)
+    # A previous copy would be downloaded instead.
+    remove(output_path)
+    size = sum(segment.size for segment in segments)
+    progress(size, size, 0)
+    return None
+
+
+def remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def run_stream(conn, filename, options, in_fh, total, upload_folder):
+    """Injects metadata into a file while it is being uploaded.
+
+    The upload is read once, only its boxes ahead of the media and its moov
+    are held in memory, and the output is written to injected_<filename>
+    as it is produced. The input is never stored. The job is recorded as a
+    streamed job while it runs.
+
+    Args:
+      conn: job database connection.
+      filename: string, secure name of the uploaded file.
+      options: dict, injection options as for enqueue.
+      in_fh: file handle, the upload, read to its end.
+      total: int, size of the upload if known, 0 otherwise.
+      upload_folder: string, directory of the output.
+
+    Returns:
+      The id of the finished job.
+    """
+    job_id = enqueue(conn, filename, options, RUNNING, streamed=True,
+                     worker=os.getpid())
+    output_filename = f"injected_{filename}"
+    output_path = os.path.join(upload_folder, output_filename)
+    # Only a complete output replaces the previous one.
+    partial_path = os.path.join(upload_folder, f".{job_id}.part")
+    log = []
+    error = None
+    stats = mpeg.Stats()
+    meter = mpeg.box.ProgressMeter(progress_hook(conn, job_id), total)
+    try:
+        metadata = build_metadata(options)
+        with mpeg.stats.recording(stats), stats.phase('stream'), \
+                open(partial_path, 'wb') as out_fh:
+            chunks = metadata_utils.inject_mpeg4_stream(
+                stats.wrap(in_fh), metadata, log.append,
+                spatial_audio=bool(options.get('spatial_audio')))
+            out_fh = stats.wrap(out_fh)
+            for chunk in chunks:
+                out_fh.write(chunk)
+                meter.advance(len(chunk))
+        meter.finish()
+        if total and stats.counters['bytes_read'] < total:
+            log.append('Error, upload ended early')
+        if batch.has_errors(log):
+            error = next(line for line in log if line.startswith('Error'))
+        else:
+            os.replace(partial_path, output_path)
+            remove(output_path + virtual.SUFFIX)
+    except ValueError as e:
+        # A truncated or malformed upload.
+        log.append(str(e))
+        error = str(e)
+    except Exception as e:
+        log.append(traceback.format_exc())
+        error = str(e)
+    finally:
+        remove(partial_path)
+
+    finish(conn, job_id, output_filename, error, log, stats)
+    return job_id
+
+
+def events(job_ids, database=DATABASE):
+    """Yields Server-Sent Events with the state of jobs as it changes.
+
+    The stream ends once every job has finished.
+    """
+    conn = connect(database)
+    try:
+        sent = {}
+        last_event = time.time()
+        while True:
+            pending = False
+            for job_id in job_ids:
+                job = get(conn, job_id)
+                if job is None:
+                    job = {'id': job_id, 'status': ERROR, 'error': 'Unknown job'}
+                if job != sent.get(job_id):
+                    sent[job_id] = job
+                    last_event = time.time()
+                    yield f"data: {json.dumps(job)}\n\n"
+                pending = pending or job['status'] not in FINISHED
+            if not pending:
+                return
+            if time.time() - last_event > EVENTS_KEEPALIVE:
+                last_event = time.time()
+                yield ": keepalive\n\n"
+            time.sleep(POLL_INTERVAL)
+    finally:
+        conn.close()
+
+
+def progress_hook(conn, job_id):
+    """Returns a progress callback recording the progress of a job."""
+    def progress(written, total, mb_per_s):
+        # Called at most every mpeg.box.PROGRESS_INTERVAL seconds.
+        conn.execute(
+            'UPDATE jobs SET bytes_written = ?, total_bytes = ?, mb_per_s = ?, '
+            'updated = ? WHERE id = ?',
+            (written, total, mb_per_s, time.time(), job_id))
+    return progress
+
+
+def finish(conn, job_id, output_filename, error, log, stats):
+    """Records the result of a job and adds it to the metrics."""
+    status = ERROR if error else DONE
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        conn.execute(
+            'UPDATE jobs SET status = ?, output_filename = ?, error = ?, '
+            'logs = ?, stats = ?, updated = ? WHERE id = ?',
+            (status, None if error else output_filename, error,
+             json.dumps(log), json.dumps(stats.to_dict()), time.time(),
+             job_id))
+        add_metrics(conn, status, stats)
+        conn.execute('COMMIT')
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+
+
+def add_metrics(conn, status, stats):
+    """Adds a finished job to the metrics table."""
+    values = [('jobs_finished', status, 1)]
+    values += [('phase_seconds', name, seconds)
+               for name, seconds in stats.timings.items()]
+    values += [('counter', name, amount)
+               for name, amount in stats.counters.items()]
+    conn.executemany(
+        'INSERT INTO metrics (name, label, value) VALUES (?, ?, ?) '
+        'ON CONFLICT (name, label) DO UPDATE SET value = value + excluded.value',
+        values)
+
+
+def prometheus_metrics(conn):
+    """Returns the metrics of all jobs in the Prometheus text format."""
+    lines = [
+        '# HELP spatialmedia_jobs Jobs by status.',
+        '# TYPE spatialmedia_jobs gauge',
+    ]
+    counts = dict((status, 0) for status in (QUEUED, RUNNING, DONE, ERROR))
+    for row in conn.execute('SELECT status, COUNT(*) AS count FROM jobs GROUP BY status'):
+        counts[row['status']] = row['count']
+    lines += [f'spatialmedia_jobs{{status="{status}"}} {count}'
+              for status, count in sorted(counts.items())]
+
+    metrics = {}
+    for row in conn.execute('SELECT name, label, value FROM metrics ORDER BY name, label'):
+        metrics.setdefault(row['name'], []).append((row['label'], row['value']))
+
+    lines += [
+        '# HELP spatialmedia_jobs_finished_total Finished jobs by status.',
+        '# TYPE spatialmedia_jobs_finished_total counter',
+    ]
+    lines += [f'spatialmedia_jobs_finished_total{{status="{label}"}} {value:g}'
+              for label, value in metrics.get('jobs_finished', [])]
+    lines += [
+        '# HELP spatialmedia_phase_seconds_total Wall time spent per phase of parsing and injection.',
+        '# TYPE spatialmedia_phase_seconds_total counter',
+    ]
+    lines += [f'spatialmedia_phase_seconds_total{{phase="{label}"}} {value}'
+              for label, value in metrics.get('phase_seconds', [])]
+    for label, value in metrics.get('counter', []):
+        name = f'spatialmedia_{label}_total'
+        lines += [f'# TYPE {name} counter', f'{name} {value:g}']
+    return '\n'.join(lines) + '\n'
+
+
+def work(database, upload_folder):
+    """Worker process loop, runs queued jobs until killed."""
+    conn = connect(database)
+    parse_cache = cache.ParseCache(
+        max_size=int(os.getenv('PARSE_CACHE_SIZE', cache.DEFAULT_MAX_SIZE)),
+        directory=os.getenv('PARSE_CACHE_DIR') or None)
+    worker = os.getpid()
+    while True:
+        job = claim(conn, worker)
+        if job is None:
+            time.sleep(POLL_INTERVAL)
+            continue
+        run_job(conn, job, upload_folder, parse_cache)
+
+
+def serve(workers, database=DATABASE, upload_folder=UPLOAD_FOLDER):
+    """Runs a pool of worker processes, replacing the ones that die."""
+    conn = connect(database)
+    requeue(conn)
+    abandon_streams(conn)
+
+    def start():
+        process = multiprocessing.Process(target=work,
+                                          args=(database, upload_folder),
+                                          daemon=True)
+        process.start()
+        return process
+
+    processes = [start() for _ in range(workers)]
+    while True:
+        time.sleep(POLL_INTERVAL)
+        abandon_streams(conn)
+        for index, process in enumerate(processes):
+            if process.is_alive():
+                continue
+            requeue(conn, process.pid)
+            processes[index] = start()
+
+
+if __name__ == '__main__':
+    serve(int(os.getenv('JOB_WORKERS', os.cpu_count() or 1)))
@@ -1,4 +1,9 @@
 #!/bin/sh
+# Run the injection worker pool in the background, restarting it if it exits.
+# Queued jobs are kept in the job database and picked up again.
+(while true; do python /app/jobs.py; sleep 1; done) &
+
 # Run Gunicorn with the Flask app
 # app:app refers to module 'app' and callable 'app'
-exec gunicorn app:app -w 2 --threads 2 -b 0.0.0.0:5000
+# Job progress streams hold a thread each for as long as their jobs run.
+exec gunicorn app:app -w 2 --threads 8 -b 0.0.0.0:5000
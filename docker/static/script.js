@@ -7,15 +7,16 @@ document.addEventListener('DOMContentLoaded', () => {
     const sphericalCb = document.getElementById('spherical');
     const cb3d = document.getElementById('3d');
     const cbAudio = document.getElementById('spatial-audio');
+    const cbQueued = document.getElementById('queued');
     const statusMessage = document.getElementById('status-message');
     const resultsArea = document.getElementById('results-area');
     const downloadLinks = document.getElementById('download-links');
 
-    // Progress UI
-    const progressContainer = document.getElementById('progress-container');
-    const progressFill = document.getElementById('progress-fill');
-    const progressText = document.getElementById('progress-text');
-
+    // Files are kept in the browser until they are injected. By default each
+    // one is uploaded once to /stream, which writes the injected file
+    // directly. With "queued" checked they are uploaded to /upload and kept,
+    // then injected by the job workers of /inject (needed for virtual
+    // outputs), whose progress is followed with Server-Sent Events.
     let uploadedFiles = [];
 
     // Drag and Drop Logic
@@ -46,65 +47,158 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     });
 
-    async function handleFiles(files) {
-        const formData = new FormData();
-        // Append all files
-        for (let i = 0; i < files.length; i++) {
-            formData.append('files[]', files[i]);
+    function handleFiles(files) {
+        uploadedFiles = [...uploadedFiles, ...files];
+        updateFileList();
+        updateControlsState();
+        statusMessage.textContent = '';
+        controls.classList.remove('disabled');
+    }
+
+    function updateFileList() {
+        fileList.innerHTML = '';
+        uploadedFiles.forEach(file => {
+            const item = document.createElement('div');
+            item.classList.add('file-item');
+
+            item.innerHTML = `
+                <div class="file-info">
+                    <span class="file-name"></span>
+                    <span class="file-meta">Ready to process</span>
+                </div>
+            `;
+            item.querySelector('.file-name').textContent = file.name;
+            fileList.appendChild(item);
+        });
+    }
+
+    // UI Logic
+    sphericalCb.addEventListener('change', updateControlsState);
+
+    function updateControlsState() {
+        if (uploadedFiles.length === 0) {
+            controls.classList.add('disabled');
+            return;
+        }
+
+        if (sphericalCb.checked) {
+            cb3d.disabled = false;
+            cb3d.parentElement.style.opacity = '1';
+        } else {
+            cb3d.disabled = true;
+            cb3d.checked = false;
+            cb3d.parentElement.style.opacity = '0.5';
         }
 
-        statusMessage.textContent = 'Uploading and analyzing...';
-        progressContainer.classList.remove('hidden');
-        progressFill.style.width = '0%';
-        progressText.textContent = '0%';
+        // Auto-check spatial audio if any uploaded file supports it?
+        // For now, leave manual.
+    }
 
-        try {
-            const data = await uploadFilesValues(formData);
-
-            // Merge new files with existing list if you want cumulative upload, 
-            // but here we might just replace or add. Let's add.
-            data.files.forEach(f => {
-                if (f.logs && f.logs.length > 0) {
-                    // Check for errors in logs
-                    const errors = f.logs.filter(l => l.toLowerCase().includes('error') || l.toLowerCase().includes('warning'));
-                    if (errors.length > 0) {
-                        console.warn(`Logs for ${f.filename}:`, f.logs);
-                    }
-                }
-            });
-            uploadedFiles = [...uploadedFiles, ...data.files];
+    // Initial Sync
+    updateControlsState();
 
-            updateFileList();
-            updateControlsState();
-            statusMessage.textContent = '';
-            controls.classList.remove('disabled');
+    // Job progress
+    function addJobRow(filename) {
+        const row = document.createElement('div');
+        row.classList.add('job');
+        row.innerHTML = `
+            <div class="file-info">
+                <span class="file-name"></span>
+                <span class="file-meta">Queued</span>
+            </div>
+            <div class="progress-bar">
+                <div class="progress-fill" style="width: 0%"></div>
+            </div>
+        `;
+        row.querySelector('.file-name').textContent = filename;
+        downloadLinks.appendChild(row);
+        return row;
+    }
 
-        } catch (error) {
-            console.error(error);
-            statusMessage.textContent = 'Error uploading files.';
-        } finally {
-            progressContainer.classList.add('hidden');
+    function showError(parent, filename, error) {
+        const errorMsg = document.createElement('div');
+        errorMsg.style.color = 'var(--error)';
+        errorMsg.textContent = `Error processing ${filename}: ${error}`;
+        parent.appendChild(errorMsg);
+    }
+
+    function updateJobRow(row, job) {
+        const meta = row.querySelector('.file-meta');
+        const fill = row.querySelector('.progress-fill');
+        if (job.status === 'done') {
+            row.innerHTML = '';
+            const link = document.createElement('a');
+            link.href = job.output_url;
+            link.classList.add('download-link');
+            link.textContent = `Download ${job.filename}`;
+            row.appendChild(link);
+        } else if (job.status === 'error') {
+            row.innerHTML = '';
+            showError(row, job.filename || job.id, job.error);
+        } else if (job.status === 'running' && job.total_bytes > 0) {
+            const percent = (job.bytes_written / job.total_bytes) * 100;
+            fill.style.width = percent + '%';
+            meta.textContent = `${Math.round(percent)}% · ${job.mb_per_s.toFixed(1)} MB/s`;
+        } else {
+            meta.textContent = job.status === 'running' ? 'Processing' : 'Queued';
         }
     }
 
-    function uploadFilesValues(formData) {
+    // Uploads a file to /stream, which injects it as it arrives, showing the
+    // upload progress in row. Resolves with the finished job.
+    function streamFile(file, options, row) {
         return new Promise((resolve, reject) => {
+            const query = Object.entries(options)
+                .map(([name, value]) => `${name}=${value ? 1 : 0}`).join('&');
+            const xhr = new XMLHttpRequest();
+            xhr.open('PUT', `/stream/${encodeURIComponent(file.name)}?${query}`, true);
+            xhr.setRequestHeader('Content-Type', 'application/octet-stream');
+
+            const start = performance.now();
+            xhr.upload.onprogress = (e) => {
+                const seconds = (performance.now() - start) / 1000;
+                updateJobRow(row, {
+                    status: 'running',
+                    bytes_written: e.loaded,
+                    total_bytes: e.total,
+                    mb_per_s: seconds > 0 ? e.loaded / seconds / 1e6 : 0
+                });
+            };
+
+            xhr.onload = () => {
+                try {
+                    resolve(JSON.parse(xhr.responseText));
+                } catch (e) {
+                    reject(new Error(xhr.statusText));
+                }
+            };
+
+            xhr.onerror = () => reject(new Error('Network Error'));
+
+            xhr.send(file);
+        });
+    }
+
+    // Uploads files to /upload in one request, showing the progress in the
+    // status message. Resolves with the names the files were stored under.
+    function uploadFiles(files) {
+        return new Promise((resolve, reject) => {
+            const formData = new FormData();
+            files.forEach(file => formData.append('files[]', file));
             const xhr = new XMLHttpRequest();
             xhr.open('POST', '/upload', true);
 
             xhr.upload.onprogress = (e) => {
                 if (e.lengthComputable) {
-                    const percentComplete = (e.loaded / e.total) * 100;
-                    progressFill.style.width = percentComplete + '%';
-                    progressText.textContent = Math.round(percentComplete) + '%';
+                    const percent = Math.round((e.loaded / e.total) * 100);
+                    statusMessage.textContent = `Uploading... ${percent}%`;
                 }
             };
 
             xhr.onload = () => {
                 if (xhr.status === 200) {
                     try {
-                        const response = JSON.parse(xhr.responseText);
-                        resolve(response);
+                        resolve(JSON.parse(xhr.responseText).files.map(f => f.filename));
                     } catch (e) {
                         reject(e);
                     }
@@ -119,46 +213,83 @@ document.addEventListener('DOMContentLoaded', () => {
         });
     }
 
-    function updateFileList() {
-        fileList.innerHTML = '';
-        uploadedFiles.forEach(file => {
-            const item = document.createElement('div');
-            item.classList.add('file-item');
-
-            item.innerHTML = `
-                <div class="file-info">
-                    <span class="file-name">${file.filename}</span>
-                    <span class="file-meta">Ready to process</span>
-                </div>
-            `;
-            fileList.appendChild(item);
+    // Follows the jobs on a single Server-Sent Events stream until all of
+    // them have finished.
+    function followJobs(jobs) {
+        return new Promise(resolve => {
+            const pending = new Set(Object.keys(jobs));
+            const query = [...pending].map(id => 'id=' + encodeURIComponent(id)).join('&');
+            const source = new EventSource('/jobs/events?' + query);
+            source.onmessage = (e) => {
+                const job = JSON.parse(e.data);
+                const row = jobs[job.id];
+                if (!row || !pending.has(job.id)) return;
+                updateJobRow(row, job);
+                if (job.status === 'done' || job.status === 'error') {
+                    pending.delete(job.id);
+                    if (pending.size === 0) {
+                        source.close();
+                        resolve();
+                    }
+                }
+            };
+            // The browser reconnects on its own after network errors and
+            // the stream resends the current state of every job.
         });
     }
 
-    // UI Logic
-    sphericalCb.addEventListener('change', updateControlsState);
+    async function injectQueued(options) {
+        const filenames = await uploadFiles(uploadedFiles);
+        statusMessage.textContent = 'Injecting metadata...';
 
-    function updateControlsState() {
-        if (uploadedFiles.length === 0) {
-            controls.classList.add('disabled');
-            return;
-        }
+        const response = await fetch('/inject', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json'
+            },
+            body: JSON.stringify({
+                files: filenames,
+                options: options
+            })
+        });
 
-        if (sphericalCb.checked) {
-            cb3d.disabled = false;
-            cb3d.parentElement.style.opacity = '1';
-        } else {
-            cb3d.disabled = true;
-            cb3d.checked = false;
-            cb3d.parentElement.style.opacity = '0.5';
-        }
+        if (!response.ok) throw new Error('Injection failed');
 
-        // Auto-check spatial audio if any uploaded file supports it?
-        // For now, leave manual.
+        const data = await response.json();
+
+        resultsArea.classList.remove('hidden');
+
+        const jobs = {};
+        data.results.forEach(result => {
+            if (result.success) {
+                jobs[result.job_id] = addJobRow(result.filename);
+            } else {
+                showError(downloadLinks, result.filename, result.error);
+            }
+        });
+
+        if (Object.keys(jobs).length > 0) {
+            await followJobs(jobs);
+        }
     }
 
-    // Initial Sync
-    updateControlsState();
+    async function injectStreamed(options) {
+        resultsArea.classList.remove('hidden');
+        const rows = uploadedFiles.map(file => addJobRow(file.name));
+
+        // One upload at a time, each is injected as it arrives.
+        for (let i = 0; i < uploadedFiles.length; i++) {
+            try {
+                const job = await streamFile(uploadedFiles[i], options, rows[i]);
+                updateJobRow(rows[i], job.status ? job : {
+                    status: 'error', filename: uploadedFiles[i].name, error: job.error
+                });
+            } catch (error) {
+                rows[i].innerHTML = '';
+                showError(rows[i], uploadedFiles[i].name, error.message);
+            }
+        }
+    }
 
     // Inject Logic
     injectBtn.addEventListener('click', async () => {
@@ -174,41 +305,12 @@ document.addEventListener('DOMContentLoaded', () => {
             spatial_audio: cbAudio.checked
         };
 
-        const filesToProcess = uploadedFiles.map(f => f.filename);
-
         try {
-            const response = await fetch('/inject', {
-                method: 'POST',
-                headers: {
-                    'Content-Type': 'application/json'
-                },
-                body: JSON.stringify({
-                    files: filesToProcess,
-                    options: options
-                })
-            });
-
-            if (!response.ok) throw new Error('Injection failed');
-
-            const data = await response.json();
-
-            resultsArea.classList.remove('hidden');
-
-            data.results.forEach(result => {
-                if (result.success) {
-                    const link = document.createElement('a');
-                    link.href = result.output_url;
-                    link.classList.add('download-link');
-                    link.textContent = `Download ${result.filename}`;
-                    // link.download = result.filename; // handled by Content-Disposition usually
-                    downloadLinks.appendChild(link);
-                } else {
-                    const errorMsg = document.createElement('div');
-                    errorMsg.style.color = 'var(--error)';
-                    errorMsg.textContent = `Error processing ${result.filename}: ${result.error}`;
-                    downloadLinks.appendChild(errorMsg);
-                }
-            });
+            if (cbQueued.checked) {
+                await injectQueued(options);
+            } else {
+                await injectStreamed(options);
+            }
 
             statusMessage.textContent = 'Processing complete.';
 
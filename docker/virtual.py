@@ -0,0 +1,209 @@
+"""Virtual injected outputs.
+
+With VIRTUAL_OUTPUTS=1 the job workers do not write injected copies of the
+uploads. The output of a job is stored as injected_<name>.virtual instead: a
+JSON index on its first line, followed by the new data of the output (box
+headers and the rewritten moov). The index lists the segments of the output
+in order, each either a range of that new data or a range of the upload,
+which holds the media data. Downloads read the segments on the fly.
+
+The upload must stay in place for as long as the output is downloaded; a
+virtual file whose upload has been replaced or removed is stale.
+"""
+import json
+import os
+
+SUFFIX = '.virtual'
+
+# Size of the reads of a response spanning several segments.
+BLOCK_SIZE = 1024 * 1024
+
+DATA = 'data'
+SOURCE = 'source'
+
+
+class StaleError(Exception):
+    """The upload a virtual file refers to has changed or is gone."""
+
+
+class RangeError(Exception):
+    """A Range request starts past the end of the file."""
+
+
+def byte_range(header, size):
+    """Returns the bytes [start, stop) requested by a Range header.
+
+    Only single ranges are honored. Missing or malformed headers and
+    requests for several ranges are answered with the whole file.
+
+    Args:
+      header: string or None, value of the Range header.
+      size: int, size of the file.
+
+    Returns:
+      (start, stop) or None for the whole file.
+
+    Raises:
+      RangeError: the range cannot be satisfied.
+    """
+    unit, _, specs = (header or '').partition('=')
+    if unit.strip() != 'bytes' or ',' in specs:
+        return None
+    first, dash, last = specs.strip().partition('-')
+    if not dash or not (first or last):
+        return None
+    if (first and not first.isdigit()) or (last and not last.isdigit()):
+        return None
+    if not first:
+        # The last bytes of the file.
+        if int(last) == 0 or size == 0:
+            raise RangeError(header)
+        return max(size - int(last), 0), size
+    start = int(first)
+    stop = int(last) + 1 if last else size
+    if stop <= start and last:
+        return None
+    if start >= size:
+        raise RangeError(header)
+    return start, min(stop, size)
+
+
+def write(path, source, segments):
+    """Writes a virtual file.
+
+    Args:
+      path: string, virtual file to write.
+      source: string, upload the segments without data refer to, in the
+        same directory as path.
+      segments: list of mpeg.mpeg4_container.Segment, the output.
+    """
+    stat = os.stat(source)
+    index = []
+    data = []
+    data_size = 0
+    for segment in segments:
+        if segment.data is None:
+            index.append([SOURCE, segment.position, segment.size])
+        else:
+            index.append([DATA, data_size, segment.size])
+            data.append(segment.data)
+            data_size += segment.size
+    header = {
+        'source': os.path.basename(source),
+        'source_size': stat.st_size,
+        'source_mtime_ns': stat.st_mtime_ns,
+        'segments': index,
+    }
+
+    partial_path = path + '.part'
+    with open(partial_path, 'wb') as fh:
+        fh.write(json.dumps(header).encode('utf-8') + b'\n')
+        for chunk in data:
+            fh.write(chunk)
+    os.replace(partial_path, path)
+
+
+class VirtualFile(object):
+    """An opened virtual file."""
+
+    def __init__(self, path):
+        self.fh = open(path, 'rb')
+        self.source_fh = None
+        try:
+            line = self.fh.readline()
+            header = json.loads(line)
+            source = os.path.join(os.path.dirname(path), header['source'])
+            try:
+                self.source_fh = open(source, 'rb')
+            except FileNotFoundError:
+                raise StaleError(source)
+            stat = os.fstat(self.source_fh.fileno())
+            if (stat.st_size != header['source_size'] or
+                    stat.st_mtime_ns != header['source_mtime_ns']):
+                raise StaleError(source)
+        except BaseException:
+            self.close()
+            raise
+
+        # (file handle, offset in the file, size) of every segment.
+        self.segments = []
+        for kind, offset, size in header['segments']:
+            if kind == DATA:
+                self.segments.append((self.fh, len(line) + offset, size))
+            else:
+                self.segments.append((self.source_fh, offset, size))
+        self.size = sum(size for _, _, size in self.segments)
+        mtime_ns = os.fstat(self.fh.fileno()).st_mtime_ns
+        self.etag = f'{mtime_ns:x}-{self.size:x}'
+
+    def close(self):
+        self.fh.close()
+        if self.source_fh is not None:
+            self.source_fh.close()
+
+    def ranges(self, start, stop):
+        """Yields (file handle, offset, size) covering bytes [start, stop)."""
+        position = 0
+        for fh, offset, size in self.segments:
+            end = position + size
+            if end > start and position < stop:
+                first = max(start, position)
+                last = min(stop, end)
+                yield fh, offset + first - position, last - first
+            position = end
+
+    def body(self, start, stop, file_wrapper=None):
+        """Returns a WSGI response body of bytes [start, stop) and closes.
+
+        A range within a single segment is returned through file_wrapper
+        (the wsgi.file_wrapper of the server, if any), which gunicorn sends
+        with os.sendfile. Other ranges are read segment by segment. Both
+        read the files checked when this virtual file was opened.
+        """
+        ranges = list(self.ranges(start, stop))
+        if file_wrapper is not None and len(ranges) == 1:
+            fh, offset, size = ranges[0]
+            # A new descriptor of the same open file, not of its path, which
+            # may have been replaced since.
+            copy = os.fdopen(os.dup(fh.fileno()), 'rb')
+            self.close()
+            copy.seek(offset)
+            return file_wrapper(RangeFile(copy, size), BLOCK_SIZE)
+        return self.read_ranges(ranges)
+
+    def read_ranges(self, ranges):
+        try:
+            for fh, offset, size in ranges:
+                while size > 0:
+                    data = os.pread(fh.fileno(), min(size, BLOCK_SIZE), offset)
+                    if not data:
+                        return
+                    offset += len(data)
+                    size -= len(data)
+                    yield data
+        finally:
+            self.close()
+
+
+class RangeFile(object):
+    """File handle reading at most size bytes from the current position.
+
+    Keeps fileno() so that servers can send the range with os.sendfile.
+    """
+
+    def __init__(self, fh, size):
+        self.fh = fh
+        self.remaining = size
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.fh.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def fileno(self):
+        return self.fh.fileno()
+
+    def close(self):
+        self.fh.close()
@@ -20,6 +20,10 @@ Tool for examining and injecting spatial media metadata in MP4/MOV files.
 """
 
 import argparse
+import contextlib
+import copy
+import itertools
+import json
 import os
 import re
 import sys
@@ -27,6 +31,7 @@ import sys
 path = os.path.dirname(sys.modules[__name__].__file__)
 path = os.path.join(path, '..')
 sys.path.insert(0, path)
+from spatialmedia import batch
 from spatialmedia import metadata_utils
 
 
@@ -34,6 +39,45 @@ def console(contents):
   print(contents)
 
 
+def error_console(contents):
+  print(contents, file=sys.stderr)
+
+
+def inject_stream(args):
+  """Injects metadata reading from and / or writing to standard streams.
+
+  A file name of "-" stands for standard input or output. Progress and errors
+  are printed to standard error. Spatial audio is detected from the moov as
+  it is read. An output file is removed if the input could not be injected.
+  """
+  input_file, output_file = args.file
+  stream_args = copy.copy(args)
+  stream_args.spatial_audio = False
+
+  stdin = sys.stdin.buffer
+  stdout = sys.stdout.buffer
+  # The mpeg package prints its errors, keep them out of the output.
+  with contextlib.redirect_stdout(sys.stderr):
+    metadata = batch.create_metadata(stream_args, input_file, error_console)
+    if metadata is None:
+      return
+
+    in_fh = stdin if input_file == "-" else open(input_file, "rb")
+    out_fh = stdout if output_file == "-" else open(output_file, "wb")
+    success = False
+    try:
+      success = metadata_utils.inject_metadata_stream(
+          in_fh, out_fh, metadata, error_console, args.faststart,
+          args.padding, args.spatial_audio)
+    finally:
+      if in_fh is not stdin:
+        in_fh.close()
+      if out_fh is not stdout:
+        out_fh.close()
+        if not success:
+          os.remove(output_file)
+
+
 def main(main_args):
   """Main function for printing and injecting spatial media metadata."""
 
@@ -48,6 +92,66 @@ def main(main_args):
       help=
       "injects spatial media metadata into the first file specified (.mp4 or "
       ".mov) and saves the result to the second file specified")
+  parser.add_argument(
+      "--in-place",
+      action="store_true",
+      help=
+      "with --inject, rewrites only the metadata of the single file specified "
+      "instead of saving a copy; media data is left where it is")
+  parser.add_argument(
+      "--faststart",
+      action="store_true",
+      help=
+      "with --inject, moves the moov box ahead of the media data in the "
+      "saved file for progressive playback")
+  parser.add_argument(
+      "--padding",
+      action="store",
+      type=int,
+      default=0,
+      metavar="BYTES",
+      help=
+      "with --inject, leaves a free box of BYTES bytes after a moov box "
+      "ahead of the media data, so that later changes to the metadata can be "
+      "made with --in-place without moving the media")
+  parser.add_argument(
+      "--mmap",
+      action="store_true",
+      help=
+      "memory maps the input files instead of reading them. Standard input "
+      "cannot be mapped and is always read")
+  batch_group = parser.add_argument_group("Batch Processing")
+  batch_group.add_argument(
+      "--output-dir",
+      action="store",
+      default=None,
+      help=
+      "with --inject, injects metadata into every file specified and saves "
+      "the results under the same names in OUTPUT_DIR")
+  batch_group.add_argument(
+      "--batch",
+      action="store",
+      metavar="MANIFEST",
+      default=None,
+      help=
+      "with --inject, injects metadata into every input/output pair listed in "
+      "the CSV file MANIFEST")
+  batch_group.add_argument(
+      "-j",
+      "--jobs",
+      action="store",
+      type=int,
+      default=None,
+      help=
+      "number of files processed in parallel in batch mode or when printing "
+      "metadata (default: one per CPU). Batch injection prints one JSON "
+      "result per file")
+  batch_group.add_argument(
+      "--json",
+      action="store_true",
+      help=
+      "prints the metadata of each file specified as one JSON object per "
+      "line instead of text")
   parser.add_argument(
       "-2",
       "--v2",
@@ -98,52 +202,92 @@ def main(main_args):
       help=
       "spatial audio. First-order periphonic ambisonics with ACN channel "
       "ordering and SN3D normalization")
-  parser.add_argument("file", nargs="+", help="input/output files")
+  parser.add_argument("file", nargs="*", help="input/output files")
 
   args = parser.parse_args(main_args)
 
+  if args.padding and not 8 <= args.padding <= 0xFFFFFFFF:
+    console("Padding must be between 8 and 4294967295 bytes.")
+    return
+
+  if args.inject and (args.output_dir or args.batch):
+    errors = []
+    if args.batch:
+      tasks, errors = batch.read_manifest(args.batch)
+    else:
+      tasks = [(input_file,
+                os.path.join(args.output_dir, os.path.basename(input_file)))
+               for input_file in args.file]
+    duplicates = batch.find_duplicate_outputs(tasks)
+    if duplicates:
+      console("Error, more than one input would be written to: " +
+              ", ".join(duplicates))
+      return
+    if args.output_dir:
+      os.makedirs(args.output_dir, exist_ok=True)
+    tasks = [(input_file, output_file, args)
+             for input_file, output_file in tasks]
+    for result in itertools.chain(
+        errors, batch.run(batch.inject_file, tasks, args.jobs)):
+      print(json.dumps(result, sort_keys=True))
+      sys.stdout.flush()
+    return
+
   if args.inject:
-    if len(args.file) != 2:
+    if args.in_place:
+      if len(args.file) != 1:
+        console("Injecting metadata in place requires exactly one file.")
+        return
+      if args.faststart:
+        console("Injecting metadata in place cannot move the moov box, "
+                "use --faststart with an output file.")
+        return
+      if args.padding:
+        console("Injecting metadata in place reuses the existing free space, "
+                "use --padding with an output file.")
+        return
+    elif len(args.file) != 2:
       console("Injecting metadata requires both an input file and output file.")
       return
 
-    metadata = metadata_utils.Metadata(args.projection, args.stereo_mode, args.bounds)
-    if not args.v2:
-      metadata.projection = None
-      metadata.stereo_mode = None
-      metadata.video = metadata_utils.generate_spherical_xml(args.projection,
-                                                             args.stereo_mode,
-                                                             args.crop)
-
-    if args.spatial_audio:
-      parsed_metadata = metadata_utils.parse_metadata(args.file[0], console)
-      if not metadata.audio:
-        spatial_audio_description = metadata_utils.get_spatial_audio_description(
-            parsed_metadata.num_audio_channels)
-        if spatial_audio_description.is_supported:
-          metadata.audio = metadata_utils.get_spatial_audio_metadata(
-              spatial_audio_description.order,
-              spatial_audio_description.has_head_locked_stereo)
-        else:
-          console("Audio has %d channel(s) and is not a supported "
-                  "spatial audio format." % (parsed_metadata.num_audio_channels))
-          return
-
-    if metadata.video or metadata.projection or metadata.stereo_mode:
-      metadata_utils.inject_metadata(args.file[0], args.file[1], metadata,
-                                     console)
+    if not args.in_place and "-" in args.file:
+      inject_stream(args)
+      return
+
+    metadata = batch.create_metadata(args, args.file[0], console)
+    if metadata is None:
+      return
+
+    if args.in_place:
+      metadata_utils.inject_metadata_in_place(args.file[0], metadata, console)
     else:
-      console("Failed to generate metadata.")
+      metadata_utils.inject_metadata(args.file[0], args.file[1], metadata,
+                                     console, faststart=args.faststart,
+                                     padding=args.padding,
+                                     memory_map=args.mmap)
+    return
+
+  if len(args.file) > 0 and (args.json or args.jobs is not None):
+    tasks = [(input_file, args.mmap) for input_file in args.file]
+    for result in batch.run(batch.inspect_file, tasks, args.jobs):
+      if args.json:
+        print(json.dumps(result, sort_keys=True))
+      else:
+        for line in result.get("log") or [result["error"]]:
+          console(line)
+      sys.stdout.flush()
     return
 
   if len(args.file) > 0:
     for input_file in args.file:
       if args.spatial_audio:
-        parsed_metadata = metadata_utils.parse_metadata(input_file, console)
+        parsed_metadata = metadata_utils.parse_metadata(
+            input_file, console, memory_map=args.mmap)
         metadata.audio = metadata_utils.get_spatial_audio_description(
             parsed_metadata.num_channels)
 
-      metadata_utils.parse_metadata(input_file, console)
+      metadata_utils.parse_metadata(input_file, console,
+                                    memory_map=args.mmap)
     return
 
   parser.print_help()
@@ -0,0 +1,245 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2016 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Asyncio interface for parsing and injecting spatial media metadata.
+
+All file access runs on a bounded thread pool so the event loop is never
+blocked. Files are injected by metadata_utils.inject_metadata on the pool,
+keeping its parse cache and copy path, and can be cancelled between progress
+reports. Inputs that cannot seek, such as named pipes, go through the single
+pass stream pipeline (see mpeg.stream) instead, which hands every chunk of
+output to the pool separately:
+
+    async def handle(src, dest):
+        metadata = metadata_utils.Metadata("equirectangular")
+        return await aio.inject_metadata(src, dest, metadata, print,
+                                         progress=report)
+
+Console callbacks and progress hooks are called on the event loop thread.
+"""
+
+import asyncio
+import concurrent.futures
+import os
+import threading
+
+from spatialmedia import metadata_utils
+from spatialmedia import mpeg
+
+DEFAULT_MAX_WORKERS = 4
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """Returns the shared executor, creating it on first use."""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=DEFAULT_MAX_WORKERS,
+                thread_name_prefix="spatialmedia")
+        return _executor
+
+
+def set_executor(executor):
+    """Replaces the shared executor, e.g. to change the number of workers.
+
+    The previous executor is not shut down.
+    """
+    global _executor
+    with _executor_lock:
+        _executor = executor
+
+
+def loop_console(loop, console):
+    """Returns a console callback usable from worker threads.
+
+    Lines are delivered to console on the event loop thread.
+    """
+    def worker_console(line):
+        loop.call_soon_threadsafe(console, line)
+    return worker_console
+
+
+class Cancelled(Exception):
+    """Raised in a worker thread to stop a call whose caller was cancelled."""
+
+
+async def run(executor, function, *args, cancel=None):
+    """Runs function on executor and returns its result.
+
+    If the caller is cancelled the call still runs to completion before the
+    cancellation propagates, so that files it uses can be safely closed.
+
+    Args:
+      cancel: threading.Event or None, set when the caller is cancelled so
+        that function can stop early, e.g. by raising Cancelled.
+    """
+    loop = asyncio.get_running_loop()
+    future = loop.run_in_executor(executor, function, *args)
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        if cancel is not None:
+            cancel.set()
+        await asyncio.wait([future])
+        if not future.cancelled():
+            # Retrieved so that an error stopping the call is not logged.
+            future.exception()
+        raise
+
+
+async def parse_metadata(src, console, parse_cache=None, executor=None):
+    """Parses the spatial media metadata of a file.
+
+    Args:
+      src: string, file to parse.
+      console: function, output callback for progress and errors.
+      parse_cache: ParseCache or None, cache of parsed files.
+      executor: executor or None, where to run the parse, defaults to
+        get_executor().
+
+    Returns:
+      ParsedMetadata or None, as metadata_utils.parse_metadata.
+    """
+    loop = asyncio.get_running_loop()
+    return await run(executor or get_executor(),
+                     metadata_utils.parse_metadata, src,
+                     loop_console(loop, console), parse_cache)
+
+
+async def inject_metadata(src, dest, metadata, console, progress=None,
+                          faststart=False, padding=0, parse_cache=None,
+                          executor=None):
+    """Injects metadata into a copy of a file.
+
+    The output is written as it is produced. If the task is cancelled the
+    partially written output is removed.
+
+    Args:
+      src: string, file to read.
+      dest: string, file to write.
+      metadata: Metadata, video and audio metadata to inject.
+      console: function, output callback for progress and errors.
+      progress: function or None, called with the number of bytes written,
+        the expected total and the write speed in MB/s, at most every
+        mpeg.box.PROGRESS_INTERVAL seconds and once done. The total is the
+        size of the output, or the size of src for inputs that cannot seek,
+        as the output differs from it by the change in size of the moov box.
+      faststart: bool, whether to move the moov ahead of the media data.
+      padding: int, size of the free box to leave after the moov, see
+        metadata_utils.inject_metadata.
+      parse_cache: ParseCache or None, cache holding the moov of src.
+      executor: executor or None, where to run file access, defaults to
+        get_executor().
+
+    Returns:
+      String describing an error with the arguments, None otherwise (errors
+      processing the file are reported to console), as
+      metadata_utils.inject_metadata.
+    """
+    executor = executor or get_executor()
+    loop = asyncio.get_running_loop()
+    infile = os.path.abspath(src)
+    outfile = os.path.abspath(dest)
+
+    if infile == outfile:
+        return "Input and output cannot be the same"
+
+    extension = os.path.splitext(infile)[1].lower()
+    if extension not in metadata_utils.MPEG_FILE_EXTENSIONS:
+        console("Unknown file type")
+        return None
+
+    try:
+        in_fh = await run(executor, open, infile, "rb")
+    except OSError:
+        console("Error: " + infile +
+                " does not exist or we do not have permission")
+        return None
+
+    if in_fh.seekable():
+        in_fh.close()
+        return await inject_file(infile, outfile, metadata, console,
+                                 progress, faststart, padding, parse_cache,
+                                 executor)
+
+    console("Processing: " + infile)
+    out_fh = None
+    finished = False
+    chunks = None
+    try:
+        total = await run(executor, os.path.getsize, infile)
+        out_fh = await run(executor, open, outfile, "wb")
+        chunks = metadata_utils.inject_mpeg4_stream(
+            in_fh, metadata, loop_console(loop, console), faststart, padding)
+        meter = None
+        if progress is not None:
+            meter = mpeg.box.ProgressMeter(progress, total)
+        while True:
+            chunk = await run(executor, next, chunks, None)
+            if chunk is None:
+                break
+            await run(executor, out_fh.write, chunk)
+            if meter is not None:
+                meter.advance(len(chunk))
+        await run(executor, out_fh.flush)
+        if meter is not None:
+            meter.finish()
+        finished = True
+    except ValueError as e:
+        # The input is truncated or has no moov box.
+        console(str(e))
+    finally:
+        if chunks is not None:
+            chunks.close()
+        in_fh.close()
+        if out_fh is not None:
+            out_fh.close()
+            if not finished:
+                try:
+                    os.remove(outfile)
+                except OSError:
+                    pass
+    return None
+
+
+async def inject_file(infile, outfile, metadata, console, progress, faststart,
+                      padding, parse_cache, executor):
+    """Runs metadata_utils.inject_metadata for inject_metadata."""
+    loop = asyncio.get_running_loop()
+    cancel = threading.Event()
+
+    def worker_progress(done, total, mb_per_s):
+        if cancel.is_set():
+            raise Cancelled()
+        if progress is not None:
+            loop.call_soon_threadsafe(progress, done, total, mb_per_s)
+
+    try:
+        return await run(executor, metadata_utils.inject_metadata, infile,
+                         outfile, metadata, loop_console(loop, console),
+                         parse_cache, faststart, padding, worker_progress,
+                         cancel=cancel)
+    except asyncio.CancelledError:
+        try:
+            os.remove(outfile)
+        except OSError:
+            pass
+        raise
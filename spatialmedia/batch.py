@@ -0,0 +1,239 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2016 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Batch processing of spatial media files.
+
+Runs injection or inspection over many files with a pool of worker
+processes, producing one JSON serializable result per file.
+"""
+
+import collections
+import concurrent.futures
+import csv
+import itertools
+import os
+import time
+import traceback
+
+from spatialmedia import cache
+from spatialmedia import metadata_utils
+
+
+def create_metadata(options, input_file, console, parse_cache=None):
+    """Creates the metadata to inject into a file from command line options.
+
+    Args:
+      options: argparse.Namespace, parsed options (projection, stereo_mode,
+        crop, bounds, v2, spatial_audio and mmap).
+      input_file: string, file the metadata is for.
+      console: function, output callback for progress and errors.
+      parse_cache: ParseCache or None, cache for the spatial audio parse.
+
+    Returns:
+      Metadata or None if no metadata could be generated.
+    """
+    metadata = metadata_utils.Metadata(options.projection, options.stereo_mode,
+                                       options.bounds)
+    if not options.v2:
+        metadata.projection = None
+        metadata.stereo_mode = None
+        metadata.video = metadata_utils.generate_spherical_xml(
+            options.projection, options.stereo_mode, options.crop)
+
+    if options.spatial_audio:
+        parsed_metadata = metadata_utils.parse_metadata(
+            input_file, console, parse_cache, memory_map=options.mmap)
+        if not metadata.audio:
+            spatial_audio_description = \
+                metadata_utils.get_spatial_audio_description(
+                    parsed_metadata.num_audio_channels)
+            if spatial_audio_description.is_supported:
+                metadata.audio = metadata_utils.get_spatial_audio_metadata(
+                    spatial_audio_description.order,
+                    spatial_audio_description.has_head_locked_stereo)
+            else:
+                console("Audio has %d channel(s) and is not a supported "
+                        "spatial audio format." %
+                        (parsed_metadata.num_audio_channels))
+                return None
+
+    if not (metadata.video or metadata.projection or metadata.stereo_mode):
+        console("Failed to generate metadata.")
+        return None
+    return metadata
+
+
+def read_manifest(path):
+    """Reads (input, output) file pairs from a two column CSV manifest.
+
+    Empty lines, lines starting with "#" and an "input,output" header are
+    skipped.
+
+    Returns:
+      List of (input, output) pairs and list of error results, one for each
+      row without both an input and an output file.
+    """
+    pairs = []
+    errors = []
+    with open(path, newline="") as fh:
+        reader = csv.reader(fh)
+        for row in reader:
+            if not row or row[0].startswith("#"):
+                continue
+            row = [column.strip() for column in row]
+            if row == ["input", "output"]:
+                continue
+            if len(row) < 2 or not row[0] or not row[1]:
+                errors.append({
+                    "input": row[0], "status": "error",
+                    "error": "Error: %s line %d: expected input,output" %
+                             (path, reader.line_num)})
+                continue
+            pairs.append((row[0], row[1]))
+    return pairs, errors
+
+
+def find_duplicate_outputs(pairs):
+    """Returns the output files of (input, output) pairs named more than once.
+    """
+    outputs = collections.Counter(
+        os.path.normpath(output_file) for _, output_file in pairs)
+    return sorted(output for output, count in outputs.items() if count > 1)
+
+
+def has_errors(log):
+    """Returns whether a console log contains error messages."""
+    return any(line.startswith("Error") for line in log)
+
+
+def inject_file(input_file, output_file, options):
+    """Injects metadata into a single file.
+
+    Never raises, failures are reported in the result.
+
+    Args:
+      input_file: string, file to read.
+      output_file: string, file to write.
+      options: argparse.Namespace, options for create_metadata.
+
+    Returns:
+      Dictionary with the input and output files, status ("ok" or
+      "error"), bytes written, elapsed seconds, the metadata parsed back
+      from the output and the console log.
+    """
+    start = time.time()
+    log = []
+    result = {"input": input_file, "output": output_file, "status": "error"}
+    # Lets the injection reuse the moov read by the spatial audio parse.
+    parse_cache = cache.ParseCache()
+    try:
+        metadata = create_metadata(options, input_file, log.append,
+                                   parse_cache)
+        if metadata is not None:
+            error = metadata_utils.inject_metadata(
+                input_file, output_file, metadata, log.append, parse_cache,
+                options.faststart, options.padding, memory_map=options.mmap)
+            if error:
+                log.append("Error: " + error)
+            if not has_errors(log) and os.path.exists(output_file):
+                result["status"] = "ok"
+                result["bytes_written"] = os.path.getsize(output_file)
+                parsed_metadata = metadata_utils.parse_metadata(
+                    output_file, lambda line: None)
+                if parsed_metadata:
+                    result["metadata"] = parsed_metadata.to_dict()
+    except Exception:
+        log.append("Error: " + traceback.format_exc())
+    if result["status"] == "error":
+        result["error"] = next(
+            (line for line in log if line.startswith("Error")),
+            "Error: failed to inject metadata")
+    result["elapsed_seconds"] = time.time() - start
+    result["log"] = log
+    return result
+
+
+def inspect_file(input_file, memory_map=False):
+    """Parses the metadata of a single file.
+
+    Never raises, failures are reported in the result.
+
+    Args:
+      input_file: string, file to read.
+      memory_map: bool, whether to memory map the file.
+
+    Returns:
+      Dictionary with the input file, status ("ok" or "error"), elapsed
+      seconds, the parsed metadata and any error.
+    """
+    start = time.time()
+    log = []
+    result = {"input": input_file, "status": "error"}
+    try:
+        parsed_metadata = metadata_utils.parse_metadata(
+            input_file, log.append, memory_map=memory_map)
+        if parsed_metadata and not has_errors(log):
+            result["status"] = "ok"
+            result["metadata"] = parsed_metadata.to_dict()
+    except Exception:
+        log.append("Error: " + traceback.format_exc())
+    if result["status"] == "error":
+        result["error"] = next(
+            (line for line in log if line.startswith("Error")),
+            "Error: failed to parse metadata")
+    result["elapsed_seconds"] = time.time() - start
+    result["log"] = log
+    return result
+
+
+def run(function, tasks, jobs=None):
+    """Runs function over tasks, yielding results as they complete.
+
+    Args:
+      function: picklable function returning a result dictionary. Its first
+        argument is the input file.
+      tasks: iterable of argument tuples for function.
+      jobs: int or None, number of worker processes. None uses one per CPU,
+        1 runs everything in the calling process.
+    """
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+    if jobs <= 1:
+        for task in tasks:
+            yield function(*task)
+        return
+
+    # Only a few tasks per worker are submitted at a time so that batches of
+    # hundreds of thousands of files do not queue up as many futures.
+    tasks = iter(tasks)
+    window = jobs * 4
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = dict()
+        while True:
+            for task in itertools.islice(tasks, window - len(futures)):
+                futures[executor.submit(function, *task)] = task
+            if not futures:
+                return
+            done, _ = concurrent.futures.wait(
+                futures, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                task = futures.pop(future)
+                try:
+                    yield future.result()
+                except Exception as e:
+                    yield {"input": task[0], "status": "error",
+                           "error": "Error: worker failed: %s" % e}
@@ -0,0 +1,236 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2016 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Cache of parsed spatial media metadata.
+
+Entries are keyed on the identity of a file (path, size, modification time,
+device and inode), so a file that changes on disk is parsed again.
+"""
+
+import collections
+import hashlib
+import os
+import pickle
+import tempfile
+import threading
+import time
+
+DEFAULT_MAX_SIZE = 64 * 1024 * 1024
+DEFAULT_MAX_DISK_SIZE = 1024 * 1024 * 1024
+
+# Rough per entry bookkeeping cost added to the size of its contents.
+ENTRY_OVERHEAD = 512
+
+# Temporary files older than this are left over from interrupted writes.
+STALE_TEMP_AGE = 60 * 60
+
+
+def file_key(path):
+    """Returns the cache key identifying the current contents of a file.
+
+    Args:
+      path: string, path of the file.
+
+    Returns:
+      Tuple of absolute path, size, modification time, device and inode or
+      None if the file cannot be accessed.
+    """
+    path = os.path.abspath(path)
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (path, stat.st_size, stat.st_mtime_ns, stat.st_dev, stat.st_ino)
+
+
+def check_private(directory):
+    """Raises ValueError unless only the current user can write directory."""
+    if not hasattr(os, "getuid"):
+        return
+    stat = os.stat(directory)
+    if stat.st_uid != os.getuid():
+        raise ValueError("Cache directory %s is not owned by the current user"
+                         % directory)
+    if stat.st_mode & 0o022:
+        raise ValueError("Cache directory %s is writable by other users"
+                         % directory)
+
+
+class CacheEntry(object):
+    """Result of parsing a file.
+
+    Attributes:
+      metadata: ParsedMetadata, the parsed metadata. Shared by all lookups
+        and must not be modified.
+      log: list of strings, console output of the parse, replayed on hits.
+      moov: bytes or None, contents of the moov box, reused when the file is
+        loaded again for injection.
+    """
+
+    def __init__(self, metadata, log, moov=None):
+        self.metadata = metadata
+        self.log = log
+        self.moov = moov
+
+    def size(self):
+        """Approximate memory used by the entry in bytes."""
+        size = ENTRY_OVERHEAD + sum(len(line) for line in self.log)
+        if self.moov is not None:
+            size += len(self.moov)
+        return size
+
+
+class ParseCache(object):
+    """Least recently used cache of CacheEntry objects.
+
+    Entries are kept in memory up to max_size bytes and, when a directory is
+    given, pickled to files in it up to max_disk_size bytes so that they
+    survive restarts and are shared between processes. The least recently
+    used entries are evicted first. Safe to use from multiple threads.
+
+    Files in the directory are unpickled, so anyone able to write to it can
+    run code in the processes using the cache. The directory is created
+    with mode 0700 and must be owned by the current user and not writable
+    by anyone else, otherwise ValueError is raised.
+    """
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE, directory=None,
+                 max_disk_size=DEFAULT_MAX_DISK_SIZE):
+        self.max_size = max_size
+        self.directory = directory
+        self.max_disk_size = max_disk_size
+        self.entries = collections.OrderedDict()
+        self.current_size = 0
+        self.lock = threading.Lock()
+        if directory:
+            os.makedirs(directory, mode=0o700, exist_ok=True)
+            check_private(directory)
+
+    def get(self, path):
+        """Returns the CacheEntry for the current contents of path or None."""
+        key = file_key(path)
+        if key is None:
+            return None
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                return entry
+        entry = self.load(key)
+        if entry is not None:
+            self.remember(key, entry)
+        return entry
+
+    def put(self, path, entry):
+        """Stores the CacheEntry for the current contents of path."""
+        key = file_key(path)
+        if key is None:
+            return
+        self.remember(key, entry)
+        self.store(key, entry)
+
+    def clear(self):
+        """Drops all entries held in memory."""
+        with self.lock:
+            self.entries.clear()
+            self.current_size = 0
+
+    def remember(self, key, entry):
+        size = entry.size()
+        if size > self.max_size:
+            return
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.current_size -= previous.size()
+            self.entries[key] = entry
+            self.current_size += size
+            while self.current_size > self.max_size:
+                _, evicted = self.entries.popitem(last=False)
+                self.current_size -= evicted.size()
+
+    def entry_path(self, key):
+        digest = hashlib.sha1(repr(key).encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, digest + ".pickle")
+
+    def load(self, key):
+        if not self.directory:
+            return None
+        path = self.entry_path(key)
+        try:
+            with open(path, "rb") as fh:
+                stored_key, entry = pickle.load(fh)
+            os.utime(path)
+        except (OSError, EOFError, pickle.UnpicklingError, ValueError,
+                AttributeError, ImportError):
+            return None
+        if stored_key != key:
+            return None
+        return entry
+
+    def store(self, key, entry):
+        if not self.directory:
+            return
+        temp_path = None
+        try:
+            fd, temp_path = tempfile.mkstemp(dir=self.directory,
+                                             suffix=".tmp")
+            with os.fdopen(fd, "wb") as fh:
+                pickle.dump((key, entry), fh, pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_path, self.entry_path(key))
+            temp_path = None
+        except (OSError, pickle.PicklingError, TypeError, AttributeError,
+                ValueError, RecursionError):
+            return
+        finally:
+            if temp_path is not None:
+                try:
+                    os.remove(temp_path)
+                except OSError:
+                    pass
+        self.evict_disk()
+
+    def evict_disk(self):
+        """Removes the least recently used files above max_disk_size."""
+        files = []
+        total_size = 0
+        now = time.time()
+        for entry in os.scandir(self.directory):
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            if entry.name.endswith(".tmp"):
+                if now - stat.st_mtime > STALE_TEMP_AGE:
+                    try:
+                        os.remove(entry.path)
+                    except OSError:
+                        pass
+                continue
+            if not entry.name.endswith(".pickle"):
+                continue
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+            total_size += stat.st_size
+        files.sort()
+        for _, size, path in files:
+            if total_size <= self.max_disk_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total_size -= size
@@ -156,7 +156,7 @@ class Application(tk.Frame):
         console = Console()
         success_count = 0
         
-        for input_file in self.all_files:
+        for index, input_file in enumerate(self.all_files):
             split_filename = os.path.splitext(ntpath.basename(input_file))
             base_filename = split_filename[0]
             extension = split_filename[1]
@@ -169,14 +169,25 @@ class Application(tk.Frame):
                 f"{base_filename}_injected{extension}"
             )
             
+            name = ntpath.basename(input_file)
+            file_count = f"{index + 1}/{len(self.all_files)}"
+
+            def progress(written, total, mb_per_s):
+                self.show_progress(
+                    written, total,
+                    f"Processing {file_count}: {name} ({mb_per_s:.1f} MB/s)")
+
+            self.show_progress(0, 1, f"Processing {file_count}: {name}")
             try:
                 metadata_utils.inject_metadata(
-                    input_file, output_file, metadata, console.append
+                    input_file, output_file, metadata, console.append,
+                    progress=progress
                 )
                 success_count += 1
             except Exception as e:
                 console.append(f"Error processing {ntpath.basename(input_file)}: {str(e)}")
         
+        self.progress_bar["value"] = 0
         self.set_message(
             f"Successfully processed {success_count} out of {len(self.all_files)} files"
         )
@@ -241,6 +252,13 @@ class Application(tk.Frame):
         self.label_message["text"] = text
         self.label_message.config(fg="blue")
 
+    def show_progress(self, written, total, text):
+        """Updates the progress bar while a file is being written."""
+        self.progress_bar["value"] = 100.0 * written / max(total, 1)
+        self.set_message(text)
+        # Injection runs on the Tk thread, redraw before continuing.
+        self.update_idletasks()
+
     def create_widgets(self):
         """Sets up GUI contents."""
 
@@ -263,6 +281,14 @@ class Application(tk.Frame):
             sticky="w",
         )
 
+        row = row + 1
+        self.progress_bar = ttk.Progressbar(
+            self, orient="horizontal", mode="determinate", maximum=100
+        )
+        self.progress_bar.grid(
+            row=row, column=column, columnspan=2, padx=PAD_X, sticky="ew"
+        )
+
         row = row + 1
         separator = tk.Frame(self, relief=tk.GROOVE, bd=1, height=2, bg="white")
         separator.grid(columnspan=row, padx=PAD_X, pady=4, sticky="n" + "e" + "s" + "w")
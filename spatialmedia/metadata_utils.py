@@ -18,13 +18,14 @@
 """Utilities for examining/injecting spatial media metadata in MP4/MOV files."""
 
 import collections
+import copy
 import os
 import re
-import struct
 import traceback
 import xml.etree
 import xml.etree.ElementTree
 
+from spatialmedia import cache
 from spatialmedia import mpeg
 
 MPEG_FILE_EXTENSIONS = [".mp4", ".mov"]
@@ -109,9 +110,32 @@ class Metadata(object):
 class ParsedMetadata(object):
     def __init__(self):
         self.video = dict()
+        self.video_v2 = dict()
         self.audio = None
         self.num_audio_channels = 0
 
+    def to_dict(self):
+        """Returns the parsed metadata as JSON serializable values."""
+        audio = None
+        if self.audio:
+            audio = {
+                "ambisonic_type": self.audio.ambisonic_type_name(),
+                "head_locked_stereo": self.audio.head_locked_stereo,
+                "ambisonic_order": self.audio.ambisonic_order,
+                "ambisonic_channel_ordering":
+                    self.audio.ambisonic_channel_ordering_name(),
+                "ambisonic_normalization":
+                    self.audio.ambisonic_normalization_name(),
+                "num_channels": self.audio.num_channels,
+                "channel_map": list(self.audio.channel_map),
+            }
+        return {
+            "video": self.video,
+            "video_v2": self.video_v2,
+            "audio": audio,
+            "num_audio_channels": self.num_audio_channels,
+        }
+
 SPHERICAL_PREFIX = "{http://ns.google.com/videos/1.0/spherical/}"
 SPHERICAL_TAGS = dict()
 for tag in SPHERICAL_TAGS_LIST:
@@ -167,98 +191,61 @@ def mpeg4_add_spherical_xml_v1(mpeg4_file, in_fh, metadata):
       in_fh: file handle, Source for uncached file contents.
       metadata: string, xml metadata to inject into spherical tag.
     """
-    for element in mpeg4_file.moov_box.contents:
-        if element.name == mpeg.constants.TAG_TRAK:
-            added = False
-            element.remove(mpeg.constants.TAG_UUID)
-            for sub_element in element.contents:
-                if sub_element.name != mpeg.constants.TAG_MDIA:
-                    continue
-                for mdia_sub_element in sub_element.contents:
-                    if mdia_sub_element.name != mpeg.constants.TAG_HDLR:
-                        continue
-                    position = mdia_sub_element.content_start() + 8
-                    in_fh.seek(position)
-                    if in_fh.read(4) == mpeg.constants.TRAK_TYPE_VIDE:
-                        added = True
-                        break
-
-                if added:
-                    if not element.add(spherical_uuid(metadata)):
-                        return False
-                    break
+    for track in mpeg4_file.tracks:
+        track.trak.remove(mpeg.constants.TAG_UUID)
+        if track.is_video():
+            if not track.trak.add(spherical_uuid(metadata)):
+                return False
 
     mpeg4_file.resize()
     return True
 
 def mpeg4_add_spherical_v2(mpeg4_file, in_fh, projection, stereo_mode, bounds):
-    for element in mpeg4_file.moov_box.contents:
-        if element.name == mpeg.constants.TAG_TRAK:
-            for sub_element in element.contents:
-                if sub_element.name != mpeg.constants.TAG_MDIA:
-                    continue
-                for mdia_sub_element in sub_element.contents:
-                    if mdia_sub_element.name != mpeg.constants.TAG_HDLR:
-                        continue
-                    position = mdia_sub_element.content_start() + 8
-                    in_fh.seek(position)
-                    if in_fh.read(4) == mpeg.constants.TAG_VIDE:
-                        ret = inject_spatial_video_v2_atoms(
-                            in_fh, sub_element, projection, stereo_mode, bounds)
-                        mpeg4_file.resize()
-                        return ret
-
-
-def inject_spatial_video_v2_atoms(in_fh, video_media_atom, projection, stereo_mode, bounds):
-    """Adds spherical v2 boxes to an mpeg4 file for all video tracks.
+    for track in mpeg4_file.tracks:
+        if track.is_video():
+            ret = inject_spatial_video_v2_atoms(
+                in_fh, track, projection, stereo_mode, bounds)
+            mpeg4_file.resize()
+            return ret
+
+
+def inject_spatial_video_v2_atoms(in_fh, video_track, projection, stereo_mode, bounds):
+    """Adds spherical v2 boxes to the sample descriptions of a video track.
 
     Args:
       in_fh: file handle, Source for uncached file contents.
-      video_media_atom: parent media atom.
+      video_track: mpeg.Track, the video track.
       projection: the projection type.
       stereo_mode: stereo mode (if 3d), else none.
       bounds: equirect bounds.
     """
-    for atom in video_media_atom.contents:
-        if atom.name != mpeg.constants.TAG_MINF:
-            continue
-        for element in atom.contents:
-            if element.name != mpeg.constants.TAG_STBL:
-                continue
-            for sub_element in element.contents:
-                if sub_element.name != mpeg.constants.TAG_STSD:
-                    continue
-                for sample_description in sub_element.contents:
-                    if sample_description.name in\
-                            mpeg.constants.VIDEO_SAMPLE_DESCRIPTIONS:
-                        in_fh.seek(sample_description.position +
-                                   sample_description.header_size + 16)
-                        # Should remove any existing boxes...
-                        if stereo_mode:
-                            st3d_atom = mpeg.sv3d.ST3DBox.create()
-                            st3d_atom.name = mpeg.constants.TAG_ST3D
-                            st3d_atom.set_stereo_mode_from_string(stereo_mode)
+    for sample_description in video_track.video_sample_descriptions():
+        # Should remove any existing boxes...
+        if stereo_mode:
+            st3d_atom = mpeg.sv3d.ST3DBox.create()
+            st3d_atom.name = mpeg.constants.TAG_ST3D
+            st3d_atom.set_stereo_mode_from_string(stereo_mode)
 
-                            sample_description.remove(st3d_atom.name)
-                            sample_description.add(st3d_atom)
+            sample_description.remove(st3d_atom.name)
+            sample_description.add(st3d_atom)
 
-                        if projection:
-                            svhd_atom = mpeg.sv3d.SVHDBox.create()
+        if projection:
+            svhd_atom = mpeg.sv3d.SVHDBox.create()
 
-                            proj_atom = mpeg.container.Container(header_size=8)
-                            proj_atom.name = mpeg.constants.TAG_PROJ
+            proj_atom = mpeg.container.Container(header_size=8)
+            proj_atom.name = mpeg.constants.TAG_PROJ
 
-                            proj_atom.add(mpeg.sv3d.PRHDBox.create())
-                            proj_atom.add(mpeg.sv3d.EQUIBox.create(bounds=bounds))
+            proj_atom.add(mpeg.sv3d.PRHDBox.create())
+            proj_atom.add(mpeg.sv3d.EQUIBox.create(bounds=bounds))
 
-                            sv3d_atom = mpeg.container.Container(header_size=8)
-                            sv3d_atom.name = mpeg.constants.TAG_SV3D
+            sv3d_atom = mpeg.container.Container(header_size=8)
+            sv3d_atom.name = mpeg.constants.TAG_SV3D
 
-                            sv3d_atom.add(svhd_atom)
-                            sv3d_atom.add(proj_atom)
+            sv3d_atom.add(svhd_atom)
+            sv3d_atom.add(proj_atom)
 
-                            sample_description.remove(sv3d_atom.name)
-                            sample_description.add(sv3d_atom)
+            sample_description.remove(sv3d_atom.name)
+            sample_description.add(sv3d_atom)
 
     return True
 
@@ -274,19 +261,10 @@ def mpeg4_add_spatial_audio(mpeg4_file, in_fh, audio_metadata, console):
       'ambisonic_order': int, 'head_locked_stereo': Bool),
       Supports 'periphonic' ambisonic type only.
     """
-    for element in mpeg4_file.moov_box.contents:
-        if element.name == mpeg.constants.TAG_TRAK:
-            for sub_element in element.contents:
-                if sub_element.name != mpeg.constants.TAG_MDIA:
-                    continue
-                for mdia_sub_element in sub_element.contents:
-                    if mdia_sub_element.name != mpeg.constants.TAG_HDLR:
-                        continue
-                    position = mdia_sub_element.content_start() + 8
-                    in_fh.seek(position)
-                    if in_fh.read(4) == mpeg.constants.TAG_SOUN:
-                        return inject_spatial_audio_atom(
-                            in_fh, sub_element, audio_metadata, console)
+    for track in mpeg4_file.tracks:
+        if track.is_audio():
+            return inject_spatial_audio_atom(
+                in_fh, track, audio_metadata, console)
     return True
 
 def mpeg4_add_audio_metadata(mpeg4_file, in_fh, audio_metadata, console):
@@ -298,44 +276,30 @@ def mpeg4_add_audio_metadata(mpeg4_file, in_fh, audio_metadata, console):
     return mpeg4_add_spatial_audio(mpeg4_file, in_fh, audio_metadata, console)
 
 def inject_spatial_audio_atom(
-    in_fh, audio_media_atom, audio_metadata, console):
-    for atom in audio_media_atom.contents:
-        if atom.name != mpeg.constants.TAG_MINF:
-            continue
-        for element in atom.contents:
-            if element.name != mpeg.constants.TAG_STBL:
-                continue
-            for sub_element in element.contents:
-                if sub_element.name != mpeg.constants.TAG_STSD:
-                    continue
-                for sample_description in sub_element.contents:
-                    if sample_description.name in\
-                            mpeg.constants.SOUND_SAMPLE_DESCRIPTIONS:
-                        in_fh.seek(sample_description.position +
-                                   sample_description.header_size + 16)
-                        num_channels = get_num_audio_channels(
-                            sub_element, in_fh)
-                        expected_num_channels = \
-                            get_expected_num_audio_channels(
-                                audio_metadata["ambisonic_type"],
-                                audio_metadata["ambisonic_order"],
-                                audio_metadata["head_locked_stereo"])
-                        if num_channels != expected_num_channels:
-                            head_locked_stereo_msg = (" with head-locked stereo" if
-                                            audio_metadata["head_locked_stereo"] else "")
-                            err_msg = "Error: Found %d audio channel(s). "\
-                                  "Expected %d channel(s) for %s ambisonics "\
-                                  "of order %d%s."\
-                                % (num_channels,
-                                   expected_num_channels,
-                                   audio_metadata["ambisonic_type"],
-                                   audio_metadata["ambisonic_order"],
-                                   head_locked_stereo_msg)
-                            console(err_msg)
-                            return False
-                        sa3d_atom = mpeg.SA3DBox.create(
-                            num_channels, audio_metadata)
-                        sample_description.contents.append(sa3d_atom)
+    in_fh, audio_track, audio_metadata, console):
+    for sample_description in audio_track.sound_sample_descriptions():
+        num_channels = audio_track.num_audio_channels
+        expected_num_channels = \
+            get_expected_num_audio_channels(
+                audio_metadata["ambisonic_type"],
+                audio_metadata["ambisonic_order"],
+                audio_metadata["head_locked_stereo"])
+        if num_channels != expected_num_channels:
+            head_locked_stereo_msg = (" with head-locked stereo" if
+                            audio_metadata["head_locked_stereo"] else "")
+            err_msg = "Error: Found %d audio channel(s). "\
+                  "Expected %d channel(s) for %s ambisonics "\
+                  "of order %d%s."\
+                % (num_channels,
+                   expected_num_channels,
+                   audio_metadata["ambisonic_type"],
+                   audio_metadata["ambisonic_order"],
+                   head_locked_stereo_msg)
+            console(err_msg)
+            return False
+        sa3d_atom = mpeg.SA3DBox.create(
+            num_channels, audio_metadata)
+        sample_description.append(sa3d_atom)
     return True
 
 def parse_spherical_xml(contents, console):
@@ -380,6 +344,39 @@ def parse_spherical_xml(contents, console):
     return sphericalDictionary
 
 
+def parse_sv3d(sv3d_box):
+    """Returns the values of a spherical video v2 (sv3d) box.
+
+    Args:
+      sv3d_box: container, loaded sv3d box.
+
+    Returns:
+      Dictionary with the metadata source, projection, pose and bounds.
+    """
+    values = dict()
+    for element in sv3d_box.contents:
+        if element.name == mpeg.constants.TAG_SVHD:
+            values["metadata_source"] = element.metadata_source
+        if element.name != mpeg.constants.TAG_PROJ:
+            continue
+        for proj_element in element.contents:
+            if proj_element.name == mpeg.constants.TAG_PRHD:
+                values["pose"] = {
+                    "yaw": proj_element.pose_yaw_degrees,
+                    "pitch": proj_element.pose_pitch_degrees,
+                    "roll": proj_element.pose_roll_degrees,
+                }
+            elif proj_element.name == mpeg.constants.TAG_EQUI:
+                values["projection"] = "equirectangular"
+                values["bounds"] = {
+                    "top": proj_element.bounds_top,
+                    "bottom": proj_element.bounds_bottom,
+                    "left": proj_element.bounds_left,
+                    "right": proj_element.bounds_right,
+                }
+    return values
+
+
 def parse_spherical_mpeg4(mpeg4_file, fh, console):
     """Returns spherical metadata for a loaded mpeg4 file.
 
@@ -391,110 +388,334 @@ def parse_spherical_mpeg4(mpeg4_file, fh, console):
       Dictionary stored as (trackName, metadataDictionary)
     """
     metadata = ParsedMetadata()
-    track_num = 0
-    for element in mpeg4_file.moov_box.contents:
-        if element.name == mpeg.constants.TAG_TRAK:
-            trackName = "Track %d" % track_num
-            console("\t%s" % trackName)
-            track_num += 1
-            for sub_element in element.contents:
-                if sub_element.name == mpeg.constants.TAG_UUID:
+    for track_num, track in enumerate(mpeg4_file.tracks):
+        trackName = "Track %d" % track_num
+        console("\t%s" % trackName)
+        for sub_element in track.trak.contents:
+            if sub_element.name == mpeg.constants.TAG_UUID:
+                if sub_element.contents:
+                    sub_element_id = sub_element.contents[:16]
+                else:
+                    fh.seek(sub_element.content_start())
+                    sub_element_id = fh.read(16)
+
+                if sub_element_id == SPHERICAL_UUID_ID:
                     if sub_element.contents:
-                        sub_element_id = sub_element.contents[:16]
+                        contents = sub_element.contents[16:]
                     else:
-                        fh.seek(sub_element.content_start())
-                        sub_element_id = fh.read(16)
-
-                    if sub_element_id == SPHERICAL_UUID_ID:
-                        if sub_element.contents:
-                            contents = sub_element.contents[16:]
-                        else:
-                            contents = fh.read(sub_element.content_size - 16)
-                        metadata.video[trackName] = \
-                            parse_spherical_xml(contents.decode("utf-8"), console)
-
-                if sub_element.name == mpeg.constants.TAG_MDIA:
-                    for mdia_sub_element in sub_element.contents:
-                        if mdia_sub_element.name != mpeg.constants.TAG_MINF:
-                            continue
-                        for stbl_elem in mdia_sub_element.contents:
-                            if stbl_elem.name != mpeg.constants.TAG_STBL:
-                                continue
-                            for stsd_elem in stbl_elem.contents:
-                                if stsd_elem.name != mpeg.constants.TAG_STSD:
-                                    continue
-                                for sa3d_container_elem in stsd_elem.contents:
-                                    if sa3d_container_elem.name not in \
-                                            mpeg.constants.SOUND_SAMPLE_DESCRIPTIONS:
-                                        continue
-                                    metadata.num_audio_channels = \
-                                        get_num_audio_channels(stsd_elem, fh)
-                                    for sa3d_elem in sa3d_container_elem.contents:
-                                        if sa3d_elem.name == mpeg.constants.TAG_SA3D:
-                                            sa3d_elem.print_box(console)
-                                            metadata.audio = sa3d_elem
-
-                                for sv3d_container_elem in stsd_elem.contents:
-                                    if sv3d_container_elem.name not in \
-                                            mpeg.constants.VIDEO_SAMPLE_DESCRIPTIONS:
-                                        continue
-                                    for sub_elem in sv3d_container_elem.contents:
-                                        if sub_elem.name == mpeg.constants.TAG_SV3D:
-                                            console("\t\tSV3D {")
-                                            sub_elem.print_box(console)
-                                            console("\t\t}")
-                                        elif sub_elem.name == mpeg.constants.TAG_ST3D:
-                                            console("\t\tST3D {")
-                                            sub_elem.print_box(console)
-                                            console("\t\t} ")
+                        contents = fh.read(sub_element.content_size - 16)
+                    metadata.video[trackName] = \
+                        parse_spherical_xml(contents.decode("utf-8"), console)
+
+            if sub_element is not track.mdia:
+                continue
+            for sa3d_container_elem in track.sound_sample_descriptions():
+                metadata.num_audio_channels = track.num_audio_channels
+                for sa3d_elem in sa3d_container_elem.contents:
+                    if sa3d_elem.name == mpeg.constants.TAG_SA3D:
+                        sa3d_elem.print_box(console)
+                        metadata.audio = sa3d_elem
+
+            for sv3d_container_elem in track.video_sample_descriptions():
+                for sub_elem in sv3d_container_elem.contents:
+                    if sub_elem.name == mpeg.constants.TAG_SV3D:
+                        console("\t\tSV3D {")
+                        sub_elem.print_box(console)
+                        console("\t\t}")
+                        metadata.video_v2.setdefault(
+                            trackName, dict()).update(
+                                parse_sv3d(sub_elem))
+                    elif sub_elem.name == mpeg.constants.TAG_ST3D:
+                        console("\t\tST3D {")
+                        sub_elem.print_box(console)
+                        console("\t\t} ")
+                        metadata.video_v2.setdefault(
+                            trackName, dict())[
+                                "stereo_mode"] = \
+                            sub_elem.stereo_mode
 
     return metadata
 
-def parse_mpeg4(input_file, console):
+
+def parse_mpeg4(input_file, console, parse_cache=None, memory_map=False):
+    log = None
+    if parse_cache is not None:
+        entry = parse_cache.get(input_file)
+        if entry is not None:
+            mpeg.stats.count("parse_cache_hits")
+            for line in entry.log:
+                console(line)
+            return entry.metadata
+
+        log = []
+        print_line = console
+        def console(line):
+            log.append(line)
+            print_line(line)
+
+    stats = mpeg.stats.active()
     with open(input_file, "rb") as in_fh:
-        mpeg4_file = mpeg.load(in_fh)
+        if stats is not None:
+            in_fh = stats.wrap(in_fh)
+        with mpeg.stats.phase("load"):
+            mpeg4_file = mpeg.load(in_fh, lazy=True, memory_map=memory_map)
         if mpeg4_file is None:
             console("Error, file could not be opened.")
             return
 
         console("Loaded file...")
-        return parse_spherical_mpeg4(mpeg4_file, in_fh, console)
+        with mpeg.stats.phase("parse"):
+            metadata = parse_spherical_mpeg4(mpeg4_file, mpeg4_file.reader,
+                                             console)
+
+        if log is not None and not any(
+                line.startswith("Error") for line in log):
+            moov = bytes(mpeg.reader.read_at(
+                mpeg4_file.reader, mpeg4_file.moov_box.position,
+                mpeg4_file.moov_box.size()))
+            parse_cache.put(input_file, cache.CacheEntry(metadata, log, moov))
+        if memory_map:
+            mpeg4_file.close()
+        return metadata
 
     console("Error \"" + input_file + "\" does not exist or do not have "
             "permission.")
 
 
-def inject_mpeg4(input_file, output_file, metadata, console):
+def mpeg4_add_metadata(mpeg4_file, in_fh, metadata, console):
+    """Adds spherical video and spatial audio metadata to an mpeg4 file.
+
+    Args:
+      mpeg4_file: mpeg4, Mpeg4 file structure to add metadata.
+      in_fh: file handle, Source for uncached file contents.
+      metadata: Metadata, video and audio metadata to inject.
+      console: function, output callback for progress and errors.
+
+    Returns:
+      Bool, False if any of the metadata could not be added.
+    """
+    success = True
+    if metadata.video and not mpeg4_add_spherical_xml_v1(mpeg4_file, in_fh, metadata.video):
+        console("Error failed to insert spherical data")
+        success = False
+
+    if ((metadata.projection or metadata.stereo_mode)
+        and not mpeg4_add_spherical_v2(mpeg4_file, in_fh, metadata.projection,
+                                       metadata.stereo_mode, metadata.bounds)):
+        console("Error failed to insert spherical data v2")
+        success = False
+
+    if metadata.audio:
+        if not mpeg4_add_audio_metadata(
+            mpeg4_file, in_fh, metadata.audio, console):
+                console("Error failed to insert spatial audio data")
+                success = False
+    return success
+
+
+def load_injected_mpeg4(in_fh, input_file, metadata, console,
+                        parse_cache=None, faststart=False, padding=0,
+                        memory_map=False):
+    """Loads an mpeg4 file and adds metadata to it, ready to be saved.
+
+    Args:
+      in_fh: file handle, the opened input file.
+      input_file: string, path of the input file, for parse_cache.
+      metadata: Metadata, video and audio metadata to inject.
+      console: function, output callback for progress and errors.
+      parse_cache: ParseCache or None, cache holding the moov of the file.
+      faststart: bool, whether to move the moov ahead of the media data.
+      padding: int, size of the free box to leave after the moov.
+      memory_map: bool, whether to memory map in_fh (see mpeg.load).
+
+    Returns:
+      mpeg4, the modified file structure, its reader serving moov reads
+      from memory and everything else from in_fh, or None on error.
+    """
+    moov = None
+    if parse_cache is not None:
+        entry = parse_cache.get(input_file)
+        if entry is not None:
+            moov = entry.moov
+
+    with mpeg.stats.phase("load"):
+        mpeg4_file = mpeg.load(in_fh, memory_map=memory_map, moov=moov)
+    if mpeg4_file is None:
+        console("Error file could not be opened.")
+        return None
+
+    with mpeg.stats.phase("metadata"):
+        mpeg4_add_metadata(mpeg4_file, mpeg4_file.reader, metadata, console)
+
+        console("Saved file settings")
+        parse_spherical_mpeg4(mpeg4_file, mpeg4_file.reader, console)
+
+    if faststart and not mpeg4_file.faststart():
+        console("Error failed to move moov ahead of the media data")
+        return None
+    mpeg4_file.reserve_padding(padding)
+    return mpeg4_file
+
+
+def inject_mpeg4(input_file, output_file, metadata, console,
+                 parse_cache=None, faststart=False, padding=0, progress=None,
+                 memory_map=False):
+    stats = mpeg.stats.active()
     with open(input_file, "rb") as in_fh:
+        if stats is not None:
+            in_fh = stats.wrap(in_fh)
 
-        mpeg4_file = mpeg.load(in_fh)
+        mpeg4_file = load_injected_mpeg4(in_fh, input_file, metadata,
+                                         console, parse_cache, faststart,
+                                         padding, memory_map)
+        if mpeg4_file is None:
+            return
+
+        with mpeg.stats.phase("save"), open(output_file, "wb") as out_fh:
+            if stats is not None:
+                out_fh = stats.wrap(out_fh)
+            mpeg4_file.save(mpeg4_file.reader, out_fh, progress)
+        if memory_map:
+            mpeg4_file.close()
+
+
+def inject_mpeg4_segments(input_file, metadata, console, parse_cache=None,
+                          faststart=False, padding=0):
+    """Injects metadata into an mpeg4 file without writing the output.
+
+    Args:
+      input_file: string, file to read.
+      metadata: Metadata, video and audio metadata to inject.
+      console: function, output callback for progress and errors.
+      parse_cache: ParseCache or None, cache holding the moov of the file.
+      faststart: bool, whether to move the moov ahead of the media data.
+      padding: int, size of the free box to leave after the moov.
+
+    Returns:
+      List of mpeg.mpeg4_container.Segment describing the injected file in
+      terms of new data and ranges of input_file (see
+      Mpeg4Container.segments), or None on error.
+    """
+    stats = mpeg.stats.active()
+    with open(input_file, "rb") as in_fh:
+        if stats is not None:
+            in_fh = stats.wrap(in_fh)
+
+        mpeg4_file = load_injected_mpeg4(in_fh, input_file, metadata,
+                                         console, parse_cache, faststart,
+                                         padding)
+        if mpeg4_file is None:
+            return None
+
+        with mpeg.stats.phase("save"):
+            return mpeg4_file.segments(mpeg4_file.reader)
+
+
+def inject_mpeg4_in_place(input_file, metadata, console):
+    with open(input_file, "r+b") as fh:
+        mpeg4_file = mpeg.load(fh)
         if mpeg4_file is None:
             console("Error file could not be opened.")
+            return
 
-        if metadata.video and not mpeg4_add_spherical_xml_v1(mpeg4_file, in_fh, metadata.video):
-            console("Error failed to insert spherical data")
+        if not mpeg4_add_metadata(mpeg4_file, mpeg4_file.reader, metadata,
+                                  console):
+            console("Error, file left unchanged")
+            return
+
+        console("Saved file settings")
+        parse_spherical_mpeg4(mpeg4_file, mpeg4_file.reader, console)
+
+        if not mpeg4_file.save_in_place(fh):
+            console("Error failed to rewrite file in place")
 
-        if ((metadata.projection or metadata.stereo_mode)
-            and not mpeg4_add_spherical_v2(mpeg4_file, in_fh, metadata.projection,
-                                           metadata.stereo_mode, metadata.bounds)):
-            console("Error failed to insert spherical data v2")
+def detect_spatial_audio(mpeg4_file, console):
+    """Returns the spatial audio metadata matching the audio of a file.
 
-        if metadata.audio:
-            if not mpeg4_add_audio_metadata(
-                mpeg4_file, in_fh, metadata.audio, console):
-                    console("Error failed to insert spatial audio data")
+    Args:
+      mpeg4_file: mpeg4, loaded mpeg4 file contents.
+      console: function, output callback for progress and errors.
 
+    Returns:
+      Spatial audio metadata for the number of audio channels of the file,
+      or None if it is not a supported spatial audio format.
+    """
+    parsed_metadata = parse_spherical_mpeg4(mpeg4_file, mpeg4_file.reader,
+                                            lambda x: None)
+    description = get_spatial_audio_description(
+        parsed_metadata.num_audio_channels)
+    if not description.is_supported:
+        console("Audio has %d channel(s) and is not a supported "
+                "spatial audio format." % parsed_metadata.num_audio_channels)
+        return None
+    return get_spatial_audio_metadata(description.order,
+                                      description.has_head_locked_stereo)
+
+
+def inject_mpeg4_stream(in_fh, metadata, console, faststart=False,
+                        padding=0, spatial_audio=False):
+    """Injects metadata into an mpeg4 file read from a stream.
+
+    The input is read once, front to back, so it may be a pipe.
+
+    Args:
+      in_fh: file handle, input stream.
+      metadata: Metadata, video and audio metadata to inject.
+      console: function, output callback for progress and errors.
+      faststart: bool, whether to move the moov ahead of the media data.
+      padding: int, size of the free box to leave after the moov when it
+        is ahead of the media data and its free space cannot be reused.
+      spatial_audio: bool, whether to add the spatial audio metadata
+        matching the audio channels found in the moov, unless
+        metadata.audio is set.
+
+    Yields:
+      bytes, consecutive chunks of the output file.
+
+    Raises:
+      ValueError: the input is truncated or has no moov box. The chunks
+        yielded so far are an incomplete output.
+    """
+    def modify(mpeg4_file):
+        console("Loaded file...")
+        file_metadata = metadata
+        if spatial_audio and not metadata.audio:
+            file_metadata = copy.copy(metadata)
+            file_metadata.audio = detect_spatial_audio(mpeg4_file, console)
+        mpeg4_add_metadata(mpeg4_file, mpeg4_file.reader, file_metadata,
+                           console)
         console("Saved file settings")
-        parse_spherical_mpeg4(mpeg4_file, in_fh, console)
+        parse_spherical_mpeg4(mpeg4_file, mpeg4_file.reader, console)
 
-        with open(output_file, "wb") as out_fh:
-            mpeg4_file.save(in_fh, out_fh)
-        return
+    return mpeg.stream.save(in_fh, modify, faststart=faststart,
+                            padding=padding)
+
+
+def inject_metadata_stream(in_fh, out_fh, metadata, console,
+                           faststart=False, padding=0, spatial_audio=False):
+    """Injects metadata into a stream, writing the result to another one.
+
+    Neither stream needs to be seekable, so both may be pipes.
+
+    Returns:
+      Bool, False if the input could not be injected, in which case
+      out_fh holds an incomplete output.
+    """
+    console("Processing: stream")
+    try:
+        for chunk in inject_mpeg4_stream(in_fh, metadata, console, faststart,
+                                         padding, spatial_audio):
+            out_fh.write(chunk)
+    except ValueError as e:
+        console(str(e))
+        return False
+    finally:
+        out_fh.flush()
+    return True
 
-    console("Error file: \"" + input_file + "\" does not exist or do not have "
-            "permission.")
 
-def parse_metadata(src, console):
+def parse_metadata(src, console, parse_cache=None, stats=None,
+                   memory_map=False):
     infile = os.path.abspath(src)
 
     try:
@@ -508,13 +729,16 @@ def parse_metadata(src, console):
     extension = os.path.splitext(infile)[1].lower()
 
     if extension in MPEG_FILE_EXTENSIONS:
-        return parse_mpeg4(infile, console)
+        with mpeg.stats.recording(stats):
+            return parse_mpeg4(infile, console, parse_cache, memory_map)
 
     console("Unknown file type")
     return None
 
 
-def inject_metadata(src, dest, metadata, console):
+def inject_metadata(src, dest, metadata, console, parse_cache=None,
+                    faststart=False, padding=0, progress=None, stats=None,
+                    memory_map=False):
     infile = os.path.abspath(src)
     outfile = os.path.abspath(dest)
 
@@ -534,7 +758,32 @@ def inject_metadata(src, dest, metadata, console):
     extension = os.path.splitext(infile)[1].lower()
 
     if (extension in MPEG_FILE_EXTENSIONS):
-        inject_mpeg4(infile, outfile, metadata, console)
+        with mpeg.stats.recording(stats):
+            inject_mpeg4(infile, outfile, metadata, console, parse_cache,
+                         faststart, padding, progress, memory_map)
+        return
+
+    console("Unknown file type")
+
+
+def inject_metadata_in_place(src, metadata, console):
+    """Injects metadata into src by rewriting only its moov box."""
+    infile = os.path.abspath(src)
+
+    try:
+        in_fh = open(infile, "r+b")
+        in_fh.close()
+    except:
+        console("Error: " + infile +
+                " does not exist or we do not have permission")
+        return
+
+    console("Processing: " + infile)
+
+    extension = os.path.splitext(infile)[1].lower()
+
+    if (extension in MPEG_FILE_EXTENSIONS):
+        inject_mpeg4_in_place(infile, metadata, console)
         return
 
     console("Unknown file type")
@@ -613,18 +862,12 @@ def generate_spherical_xml(projection="equiretangular", stereo=None, crop=None):
     return spherical_xml
 
 
-def get_descriptor_length(in_fh):
-    """Derives the length of the MP4 elementary stream descriptor at the
-       current position in the input file.
-    """
-    descriptor_length = 0
-    for i in range(4):
-        size_byte = struct.unpack(">c", in_fh.read(1))[0]
-        descriptor_length = (descriptor_length << 7 |
-                             ord(size_byte) & int("0x7f", 0))
-        if (ord(size_byte) != int("0x80", 0)):
-            break
-    return descriptor_length
+# Audio channel parsing lives with the track index.
+get_descriptor_length = mpeg.track.get_descriptor_length
+get_num_audio_channels = mpeg.track.get_num_audio_channels
+get_sample_description_num_channels = \
+    mpeg.track.get_sample_description_num_channels
+get_aac_num_channels = mpeg.track.get_aac_num_channels
 
 
 def get_expected_num_audio_channels(
@@ -639,123 +882,9 @@ def get_expected_num_audio_channels(
     else:
         return -1
 
-def get_num_audio_channels(stsd, in_fh):
-    if stsd.name != mpeg.constants.TAG_STSD:
-        print("get_num_audio_channels should be given a STSD box")
-        return -1
-    for sample_description in stsd.contents:
-        if sample_description.name == mpeg.constants.TAG_MP4A:
-            return get_aac_num_channels(sample_description, in_fh)
-        elif sample_description.name in mpeg.constants.SOUND_SAMPLE_DESCRIPTIONS:
-            return get_sample_description_num_channels(sample_description, in_fh)
-    return -1
-
-def get_sample_description_num_channels(sample_description, in_fh):
-    """Reads the number of audio channels from a sound sample description.
-    """
-    p = in_fh.tell()
-    in_fh.seek(sample_description.content_start() + 8)
-
-    version = struct.unpack(">h", in_fh.read(2))[0]
-    revision_level = struct.unpack(">h", in_fh.read(2))[0]
-    vendor = struct.unpack(">i", in_fh.read(4))[0]
-    if version == 0:
-        num_audio_channels = struct.unpack(">h", in_fh.read(2))[0]
-        sample_size_bytes = struct.unpack(">h", in_fh.read(2))[0]
-    elif version == 1:
-        num_audio_channels = struct.unpack(">h", in_fh.read(2))[0]
-        sample_size_bytes = struct.unpack(">h", in_fh.read(2))[0]
-        samples_per_packet = struct.unpack(">i", in_fh.read(4))[0]
-        bytes_per_packet = struct.unpack(">i", in_fh.read(4))[0]
-        bytes_per_frame = struct.unpack(">i", in_fh.read(4))[0]
-        bytes_per_sample = struct.unpack(">i", in_fh.read(4))[0]
-    elif version == 2:
-        always_3 = struct.unpack(">h", in_fh.read(2))[0]
-        always_16 = struct.unpack(">h", in_fh.read(2))[0]
-        always_minus_2 = struct.unpack(">h", in_fh.read(2))[0]
-        always_0 = struct.unpack(">h", in_fh.read(2))[0]
-        always_65536 = struct.unpack(">i", in_fh.read(4))[0]
-        size_of_struct_only = struct.unpack(">i", in_fh.read(4))[0]
-        audio_sample_rate = struct.unpack(">d", in_fh.read(8))[0]
-        num_audio_channels = struct.unpack(">i", in_fh.read(4))[0]
-    else:
-        print("Unsupported version for " + sample_description.name + " box")
-        return -1
-
-    in_fh.seek(p)
-    return num_audio_channels
-
-def get_aac_num_channels(box, in_fh):
-    """Reads the number of audio channels from AAC's AudioSpecificConfig
-       descriptor within the esds child box of the input mp4a or wave box.
-    """
-    p = in_fh.tell()
-    if box.name not in [mpeg.constants.TAG_MP4A, mpeg.constants.TAG_WAVE]:
-        return -1
-
-    for element in box.contents:
-        if element.name == mpeg.constants.TAG_WAVE:
-            # Handle .mov with AAC audio, where the structure is:
-            #     stsd -> mp4a -> wave -> esds
-            channel_configuration = get_aac_num_channels(element, in_fh)
-            break
-
-        if element.name != mpeg.constants.TAG_ESDS:
-          continue
-        in_fh.seek(element.content_start() + 4)
-        descriptor_tag = struct.unpack(">c", in_fh.read(1))[0]
-
-        # Verify the read descriptor is an elementary stream descriptor
-        if ord(descriptor_tag) != 3:  # Not an MP4 elementary stream.
-            print("Error: failed to read elementary stream descriptor.")
-            return -1
-        get_descriptor_length(in_fh)
-        in_fh.seek(3, 1)  # Seek to the decoder configuration descriptor
-        config_descriptor_tag = struct.unpack(">c", in_fh.read(1))[0]
-
-        # Verify the read descriptor is a decoder config. descriptor.
-        if ord(config_descriptor_tag) != 4:
-            print("Error: failed to read decoder config. descriptor.")
-            return -1
-        get_descriptor_length(in_fh)
-        in_fh.seek(13, 1) # offset to the decoder specific config descriptor.
-        decoder_specific_descriptor_tag = struct.unpack(">c", in_fh.read(1))[0]
-
-        # Verify the read descriptor is a decoder specific info descriptor
-        if ord(decoder_specific_descriptor_tag) != 5:
-            print("Error: failed to read MP4 audio decoder specific config.")
-            return -1
-        audio_specific_descriptor_size = get_descriptor_length(in_fh)
-        assert audio_specific_descriptor_size >= 2
-        decoder_descriptor = struct.unpack(">h", in_fh.read(2))[0]
-        object_type = (int("F800", 16) & decoder_descriptor) >> 11
-        sampling_frequency_index = (int("0780", 16) & decoder_descriptor) >> 7
-        if sampling_frequency_index == 0:
-            # TODO: If the sample rate is 96kHz an additional 24 bit offset
-            # value here specifies the actual sample rate.
-            print("Error: Greater than 48khz audio is currently not supported.")
-            return -1
-        channel_configuration = (int("0078", 16) & decoder_descriptor) >> 3
-    in_fh.seek(p)
-    return channel_configuration
-
-
 def get_num_audio_tracks(mpeg4_file, in_fh):
     """ Returns the number of audio track in the input mpeg4 file. """
-    num_audio_tracks = 0
-    for element in mpeg4_file.moov_box.contents:
-        if (element.name == mpeg.constants.TAG_TRAK):
-            for sub_element in element.contents:
-                if (sub_element.name != mpeg.constants.TAG_MDIA):
-                    continue
-                for mdia_sub_element in sub_element.contents:
-                    if (mdia_sub_element.name != mpeg.constants.TAG_HDLR):
-                        continue
-                    position = mdia_sub_element.content_start() + 8
-                    in_fh.seek(position)
-                    if (in_fh.read(4) == mpeg.constants.TAG_SOUN):
-                        num_audio_tracks += 1
-    return num_audio_tracks
+    return sum(1 for track in mpeg4_file.tracks if track.is_audio())
 
 
 def get_spatial_audio_metadata(ambisonic_order, head_locked_stereo):
@@ -19,13 +19,24 @@ import spatialmedia.mpeg.sa3d
 import spatialmedia.mpeg.box
 import spatialmedia.mpeg.constants
 import spatialmedia.mpeg.container
+import spatialmedia.mpeg.fragment
 import spatialmedia.mpeg.mpeg4_container
+import spatialmedia.mpeg.reader
+import spatialmedia.mpeg.stats
+import spatialmedia.mpeg.stream
+import spatialmedia.mpeg.track
 
 load = mpeg4_container.load
 
 Box = box.Box
 SA3DBox = sa3d.SA3DBox
 Container = container.Container
+MoofBox = fragment.MoofBox
+MfraBox = fragment.MfraBox
 Mpeg4Container = mpeg4_container.Mpeg4Container
+BufferReader = reader.BufferReader
+Stats = stats.Stats
+Track = track.Track
 
-__all__ = ["box", "mpeg4", "container", "constants", "sa3d"]
+__all__ = ["box", "mpeg4", "container", "constants", "fragment", "reader",
+           "sa3d", "stats", "stream", "track"]
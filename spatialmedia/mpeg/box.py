@@ -20,17 +20,82 @@
 Tool for loading mpeg4 files and manipulating atoms.
 """
 
-import io
+import array
+import os
 import struct
+import sys
+import time
 
 from spatialmedia.mpeg import constants
+from spatialmedia.mpeg import reader
+from spatialmedia.mpeg import stats
 
-def load(fh, position, end):
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# array typecodes of the unsigned integers used for stco / co64 entries.
+INDEX_TYPECODES = {
+    4: "I" if array.array("I").itemsize == 4 else "L",
+    8: "Q",
+}
+
+MAX_STCO_OFFSET = 0xFFFFFFFF
+
+# On 32-bit systems reading / writing is limited to 2GB chunks.
+# To prevent overflow, read/write 64 MB chunks.
+COPY_BLOCK_SIZE = 64 * 1024 * 1024
+
+# Copies smaller than this are not worth flushing the output for.
+MIN_KERNEL_COPY_SIZE = 1024 * 1024
+
+# Copies reporting progress report after every block of this size.
+PROGRESS_BLOCK_SIZE = 16 * 1024 * 1024
+
+# Minimum number of seconds between two progress reports.
+PROGRESS_INTERVAL = 0.25
+
+# ioctl request sharing extents between files on btrfs / XFS (linux/fs.h).
+FICLONERANGE = 0x4020940d
+
+def read_header(fh, position):
+    """Reads the header of the box at position with a single read.
+
+    Args:
+      fh: file handle, input file handle.
+      position: int, file position of the box.
+
+    Returns:
+      (size, name, header_size) of the box or None past the end of file.
+    """
+    data = reader.read_at(fh, position, 16)
+    if len(data) < 8:
+        return None
+    size, name = struct.unpack_from(">I4s", data)
+    header_size = 8
+    if size == 1:
+        if len(data) < 16:
+            return None
+        size = struct.unpack_from(">Q", data, 8)[0]
+        header_size = 16
+    return size, name, header_size
+
+
+def load(fh, position, end, header=None):
     """Loads the box located at a position in a mp4 file.
 
     Args:
       fh: file handle, input file handle.
       position: int or None, current file position.
+      end: int, end of the enclosing box or file.
+      header: (size, name, header_size) or None, the box header if it has
+        already been read.
 
     Returns:
       box: box, box from loaded file location or None.
@@ -38,14 +103,12 @@ def load(fh, position, end):
     if position is None:
         position = fh.tell()
 
-    fh.seek(position)
-    header_size = 8
-    size = struct.unpack(">I", fh.read(4))[0]
-    name = fh.read(4)
-
-    if size == 1:
-        size = struct.unpack(">Q", fh.read(8))[0]
-        header_size = 16
+    if header is None:
+        header = read_header(fh, position)
+    if header is None:
+        print("Error, truncated box header at {}".format(position))
+        return None
+    size, name, header_size = header
 
     if size < 8:
         print("Error, invalid size {} in {} at {}".format(size, name, position))
@@ -66,7 +129,19 @@ def load(fh, position, end):
 
 
 class Box(object):
-    """MPEG4 box contents and behaviour true for all boxes."""
+    """MPEG4 box contents and behaviour true for all boxes.
+
+    Boxes and their subclasses declare their attributes in __slots__: a
+    loaded moov can hold tens of thousands of boxes and slots keep each one
+    a fraction of the size of an object with a __dict__.
+
+    parent is the container holding the box, if any. Edits made through
+    set() and the Container methods flag the ancestors of the box as dirty,
+    so that Container.resize() only recomputes the sizes along that chain.
+    """
+
+    __slots__ = ("name", "position", "header_size", "content_size",
+                 "contents", "parent")
 
     def __init__(self):
         self.name = ""
@@ -74,6 +149,31 @@ class Box(object):
         self.header_size = 0
         self.content_size = 0
         self.contents = None
+        self.parent = None
+
+    def __getstate__(self):
+        # Boxes are pickled (e.g. in a parse cache) without the tree above
+        # them, nor the file handle lazily loaded containers load from (see
+        # Container.__getstate__).
+        state = {}
+        for cls in type(self).__mro__:
+            for name in getattr(cls, "__slots__", ()):
+                # The slot itself, not a property of a subclass over it.
+                try:
+                    state[name] = cls.__dict__[name].__get__(self, cls)
+                except AttributeError:
+                    pass
+        state["parent"] = None
+        if "source" in state:
+            state["source"] = None
+        return None, state
+
+    def mark_dirty(self):
+        """Flags the containers above this box as needing a resize."""
+        parent = self.parent
+        while parent is not None and not parent.dirty:
+            parent.dirty = True
+            parent = parent.parent
 
     def content_start(self):
         return self.position + self.header_size
@@ -86,13 +186,7 @@ class Box(object):
           out_fh: file handle, destination for written box contents.
           delta: int, index update amount.
         """
-        if self.header_size == 16:
-            out_fh.write(struct.pack(">I", 1))
-            out_fh.write(self.name)
-            out_fh.write(struct.pack(">Q", self.size()))
-        elif self.header_size == 8:
-            out_fh.write(struct.pack(">I", self.size()))
-            out_fh.write(self.name)
+        self.save_header(out_fh)
 
         if self.content_start():
             in_fh.seek(self.content_start())
@@ -106,10 +200,18 @@ class Box(object):
         else:
             tag_copy(in_fh, out_fh, self.content_size)
 
+    def save_header(self, out_fh):
+        """Writes the box header, in the large form if header_size is 16."""
+        if self.header_size == 16:
+            pack(out_fh, ">I4sQ", 1, self.name, self.size())
+        elif self.header_size == 8:
+            pack(out_fh, ">I4s", self.size(), self.name)
+
     def set(self, new_contents):
         """Sets / overwrites the box contents."""
         self.contents = new_contents
-        self.content_size = len(contents)
+        self.content_size = len(new_contents)
+        self.mark_dirty()
 
     def size(self):
         """Total size of a box.
@@ -126,18 +228,133 @@ class Box(object):
         print("{0} {1} [{2}, {3}]".format(indent, self.name, size1, size2))
 
 
-def tag_copy(in_fh, out_fh, size):
+class BoxWriter(object):
+    """Preallocated in-memory output for saving boxes.
+
+    Boxes saved to a BoxWriter pack their fields directly into one buffer
+    (see pack()), so that a rewritten moov is written out with a single
+    call rather than one per header and field.
+    """
+
+    def __init__(self, size):
+        """Args:
+          size: int, expected size of the output. The buffer grows if more
+            is written.
+        """
+        self.buffer = bytearray(size)
+        self.position = 0
+
+    def write(self, data):
+        end = self.position + len(data)
+        self.buffer[self.position:end] = data
+        self.position = end
+        return len(data)
+
+    def pack(self, fmt, *values):
+        """Packs values at the current position, as struct.pack_into."""
+        end = self.position + struct.calcsize(fmt)
+        if end > len(self.buffer):
+            self.buffer.extend(bytes(end - len(self.buffer)))
+        struct.pack_into(fmt, self.buffer, self.position, *values)
+        self.position = end
+
+    def tell(self):
+        return self.position
+
+    def getvalue(self):
+        """Returns the buffer holding what has been written."""
+        del self.buffer[self.position:]
+        return self.buffer
+
+
+def pack(out_fh, fmt, *values):
+    """Writes values packed with the struct format fmt to out_fh."""
+    if isinstance(out_fh, BoxWriter):
+        out_fh.pack(fmt, *values)
+    else:
+        out_fh.write(struct.pack(fmt, *values))
+
+
+class ProgressMeter(object):
+    """Throttled progress reports with throughput.
+
+    Reports are made at most every interval seconds, and always once the
+    total has been reached.
+    """
+
+    def __init__(self, callback, total, interval=None):
+        """Args:
+          callback: function, called with the number of bytes done, the
+            total and the throughput in MB/s since the previous report.
+          total: int, expected number of bytes.
+          interval: float or None, minimum number of seconds between
+            reports, defaults to PROGRESS_INTERVAL.
+        """
+        self.callback = callback
+        self.total = total
+        self.interval = PROGRESS_INTERVAL if interval is None else interval
+        self.done = 0
+        self.reported = 0
+        self.last_time = time.monotonic()
+
+    def advance(self, count):
+        """Adds count bytes done and reports if it is time to."""
+        self.done += count
+        now = time.monotonic()
+        if self.done < self.total and now - self.last_time < self.interval:
+            return
+        self.report(now)
+
+    def finish(self):
+        """Reports the bytes done since the last report, if any."""
+        if self.done != self.reported:
+            self.report(time.monotonic())
+
+    def report(self, now):
+        elapsed = now - self.last_time
+        mb_per_s = 0.0
+        if elapsed > 0:
+            mb_per_s = (self.done - self.reported) / elapsed / (1024 * 1024)
+        self.reported = self.done
+        self.last_time = now
+        self.callback(self.done, self.total, mb_per_s)
+
+
+def tag_copy(in_fh, out_fh, size, progress=None):
     """Copies a block of data from in_fh to out_fh.
 
+    Large copies between real files are done in the kernel, other streams
+    (such as io.BytesIO) are copied in chunks.
+
     Args:
       in_fh: file handle, source of uncached file contents.
       out_fh: file handle, destination for saved file.
       size: int, amount of data to copy.
+      progress: function or None, called with the number of bytes copied
+        after every PROGRESS_BLOCK_SIZE bytes (e.g. ProgressMeter.advance).
     """
+    if progress is not None:
+        while size > 0:
+            count = min(size, PROGRESS_BLOCK_SIZE)
+            tag_copy(in_fh, out_fh, count)
+            progress(count)
+            size -= count
+        return
+
+    if size >= MIN_KERNEL_COPY_SIZE:
+        size -= kernel_copy(in_fh, out_fh, size)
+
+    block_size = COPY_BLOCK_SIZE
+    position = in_fh.tell()
+    if (isinstance(in_fh, reader.BufferReader) and
+            in_fh.contains(position, size)):
+        # Write slices of the mapped file without copying them first.
+        for offset in range(0, size, block_size):
+            out_fh.write(in_fh.read_at(position + offset,
+                                       min(block_size, size - offset)))
+        in_fh.seek(position + size)
+        return
 
-    # On 32-bit systems reading / writing is limited to 2GB chunks.
-    # To prevent overflow, read/write 64 MB chunks.
-    block_size = 64 * 1024 * 1024
     while (size > block_size):
         contents = in_fh.read(block_size)
         out_fh.write(contents)
@@ -147,34 +364,229 @@ def tag_copy(in_fh, out_fh, size):
     out_fh.write(contents)
 
 
-def index_copy(in_fh, out_fh, box, mode, mode_length, delta=0):
+def file_descriptor(fh):
+    """Returns the OS file descriptor of fh or None for in-memory streams."""
+    try:
+        return fh.fileno()
+    except (AttributeError, OSError, ValueError):
+        return None
+
+
+def kernel_copy(in_fh, out_fh, size):
+    """Copies data between two files without passing it through Python.
+
+    Tries a reflink clone, os.copy_file_range and os.sendfile in that
+    order, each one picking up where the previous one stopped. Both file
+    handles are left positioned after the copied data.
+
+    Args:
+      in_fh: file handle, source of uncached file contents.
+      out_fh: file handle, destination for saved file.
+      size: int, amount of data to copy.
+
+    Returns:
+      Int, amount of data copied. The caller copies the remainder.
+    """
+    in_fd = file_descriptor(in_fh)
+    out_fd = file_descriptor(out_fh)
+    if in_fd is None or out_fd is None or not out_fh.seekable():
+        return 0
+
+    out_fh.flush()
+    in_position = in_fh.tell()
+    out_position = out_fh.tell()
+    copied = 0
+    for copy in (reflink_copy, copy_range, sendfile_copy):
+        copied += copy(in_fd, out_fd, in_position + copied,
+                       out_position + copied, size - copied)
+        if copied == size:
+            break
+
+    in_fh.seek(in_position + copied)
+    out_fh.seek(out_position + copied)
+    stats.count("kernel_copy_bytes", copied)
+    stats.count("bytes_read", copied)
+    stats.count("bytes_written", copied)
+    return copied
+
+
+def reflink_copy(in_fd, out_fd, in_position, out_position, size):
+    """Shares the whole blocks of a block aligned range between files."""
+    if fcntl is None:
+        return 0
+    block_size = os.fstat(out_fd).st_blksize
+    if in_position % block_size or out_position % block_size:
+        return 0
+    size -= size % block_size
+    if size == 0:
+        return 0
+    try:
+        fcntl.ioctl(out_fd, FICLONERANGE, struct.pack(
+            "=qQQQ", in_fd, in_position, size, out_position))
+    except OSError:
+        return 0
+    return size
+
+
+def copy_range(in_fd, out_fd, in_position, out_position, size):
+    """Copies a range between files with os.copy_file_range."""
+    if not hasattr(os, "copy_file_range"):
+        return 0
+    copied = 0
+    try:
+        while copied < size:
+            count = os.copy_file_range(
+                in_fd, out_fd, min(size - copied, COPY_BLOCK_SIZE),
+                in_position + copied, out_position + copied)
+            if count == 0:
+                break
+            copied += count
+    except OSError:
+        pass
+    return copied
+
+
+def sendfile_copy(in_fd, out_fd, in_position, out_position, size):
+    """Copies a range between files with os.sendfile."""
+    if not hasattr(os, "sendfile"):
+        return 0
+    copied = 0
+    try:
+        os.lseek(out_fd, out_position, os.SEEK_SET)
+        while copied < size:
+            count = os.sendfile(out_fd, in_fd, in_position + copied,
+                                min(size - copied, COPY_BLOCK_SIZE))
+            if count == 0:
+                break
+            copied += count
+    except OSError:
+        pass
+    return copied
+
+
+def read_index(in_fh, box):
+    """Reads the header and entry table of a stco/co64 box.
+
+    Args:
+      in_fh: file handle, source to read index table from.
+      box: box, stco/co64 box to read.
+
+    Returns:
+      (header, table), the 8 byte version/count header and the packed table
+      as bytes, or as memoryviews when fh is a BufferReader.
+    """
+    fh = in_fh
+    if box.contents:
+        fh = reader.BufferReader(box.contents, box.content_start())
+
+    header = reader.read_at(fh, box.content_start(), 8)
+    values = struct.unpack_from(">I", header, 4)[0]
+    mode_length = 8 if box.name == constants.TAG_CO64 else 4
+    table = reader.read_at(fh, box.content_start() + 8, values * mode_length)
+    return header, table
+
+
+def unpack_index(table, mode_length):
+    """Unpacks a big endian index table into native unsigned integers.
+
+    Returns a numpy array when numpy is available, otherwise an array.array.
+    """
+    if numpy is not None:
+        return numpy.frombuffer(table, dtype=">u%d" % mode_length)
+    values = array.array(INDEX_TYPECODES[mode_length])
+    values.frombytes(table)
+    if sys.byteorder == "little":
+        values.byteswap()
+    return values
+
+
+def pack_index(values, mode_length):
+    """Packs unsigned integers from unpack_index into a big endian table."""
+    if numpy is not None:
+        return values.astype(">u%d" % mode_length).tobytes()
+    if values.typecode != INDEX_TYPECODES[mode_length]:
+        values = array.array(INDEX_TYPECODES[mode_length], values)
+    if sys.byteorder == "little":
+        values.byteswap()
+    return values.tobytes()
+
+
+def shift_index(table, mode_length, delta):
+    """Adds delta to every entry of a packed big endian index table.
+
+    Args:
+      table: bytes, packed stco/co64 entries.
+      mode_length: int, number of bytes for index entries.
+      delta: int, offset change for index entries.
+
+    Returns:
+      bytes, the updated table.
+    """
+    if delta == 0 or not table:
+        return table
+
+    # Unsigned arithmetic wraps, so adding delta modulo 2^bits also
+    # handles negative deltas.
+    wrapped_delta = delta % (1 << (8 * mode_length))
+    values = unpack_index(table, mode_length)
+    if numpy is not None:
+        values = values + numpy.array(wrapped_delta, dtype=values.dtype)
+    else:
+        mask = (1 << (8 * mode_length)) - 1
+        values = array.array(
+            values.typecode, [(value + wrapped_delta) & mask for value in values])
+    return pack_index(values, mode_length)
+
+
+def index_copy(in_fh, out_fh, box, mode_length, delta=0):
     """Update and copy index table for stco/co64 files.
 
+    The whole table is read with a single call and shifted in one
+    vectorized operation.
+
     Args:
       in_fh: file handle, source to read index table from.
       out_fh: file handle, destination for index file.
       box: box, stco/co64 box to copy.
-      mode: string, bit packing mode for index entries.
       mode_length: int, number of bytes for index entires.
       delta: int, offset change for index entries.
     """
-    fh = in_fh
-    if not box.contents:
-        fh.seek(box.content_start())
-    else:
-        fh = io.BytesIO(box.contents)
+    with stats.phase("chunk_offsets"):
+        header, table = read_index(in_fh, box)
+        out_fh.write(header)
+        out_fh.write(shift_index(table, mode_length, delta))
+        if delta:
+            stats.count("chunk_offsets_rewritten", len(table) // mode_length)
+
+
+def promote_stco(in_fh, box, delta):
+    """Converts a stco box to co64 if delta would overflow its entries.
 
-    header = struct.unpack(">I", fh.read(4))[0]
-    values = struct.unpack(">I", fh.read(4))[0]
+    The promoted box keeps the original (unshifted) offsets as cached
+    contents, delta is still applied when the box is saved.
 
-    new_contents = []
-    new_contents.append(struct.pack(">I", header))
-    new_contents.append(struct.pack(">I", values))
-    for i in range(values):
-        content = fh.read(mode_length)
-        content = struct.unpack(mode, content)[0] + delta
-        new_contents.append(struct.pack(mode, content))
-    out_fh.write(b"".join(new_contents))
+    Args:
+      in_fh: file handle, source to read index table from.
+      box: box, stco box to check.
+      delta: int, offset change for index entries.
+
+    Returns:
+      Bool, whether the box was promoted to co64.
+    """
+    header, table = read_index(in_fh, box)
+    if not table:
+        return False
+    values = unpack_index(table, 4)
+    largest = values.max() if numpy is not None else max(values)
+    if int(largest) + delta <= MAX_STCO_OFFSET:
+        return False
+
+    box.name = constants.TAG_CO64
+    box.contents = bytes(header) + pack_index(values, 8)
+    box.content_size = len(box.contents)
+    box.mark_dirty()
+    stats.count("stco_promoted")
+    return True
 
 
 def stco_copy(in_fh, out_fh, box, delta=0):
@@ -186,7 +598,7 @@ def stco_copy(in_fh, out_fh, box, delta=0):
       box: box, stco box to copy.
       delta: int, offset change for index entries.
     """
-    index_copy(in_fh, out_fh, box, ">I", 4, delta)
+    index_copy(in_fh, out_fh, box, 4, delta)
 
 
 def co64_copy(in_fh, out_fh, box, delta=0):
@@ -198,4 +610,4 @@ def co64_copy(in_fh, out_fh, box, delta=0):
       box: box, co64 box to copy.
       delta: int, offset change for index entries.
     """
-    index_copy(in_fh, out_fh, box, ">Q", 8, delta)
+    index_copy(in_fh, out_fh, box, 8, delta)
@@ -23,15 +23,39 @@ TRAK_TYPE_VIDE = b"vide"
 TAG_STCO = b"stco"
 TAG_CO64 = b"co64"
 TAG_FREE = b"free"
+TAG_SKIP = b"skip"
 TAG_MDAT = b"mdat"
 TAG_XML = b"xml "
 TAG_HDLR = b"hdlr"
+TAG_TKHD = b"tkhd"
 TAG_FTYP = b"ftyp"
 TAG_ESDS = b"esds"
 TAG_SOUN = b"soun"
 TAG_VIDE = b"vide"
 TAG_SA3D = b"SA3D"
 
+# Boxes whose contents may be discarded or overwritten.
+FREE_SPACE_TAGS = frozenset([
+    TAG_FREE,
+    TAG_SKIP,
+    ])
+
+# Movie fragment types.
+TAG_MVEX = b"mvex"
+TAG_MOOF = b"moof"
+TAG_MFHD = b"mfhd"
+TAG_TRAF = b"traf"
+TAG_TFHD = b"tfhd"
+TAG_TFDT = b"tfdt"
+TAG_TRUN = b"trun"
+TAG_SIDX = b"sidx"
+TAG_MFRA = b"mfra"
+TAG_TFRA = b"tfra"
+TAG_MFRO = b"mfro"
+
+# tfhd flag signalling an absolute base data offset.
+TFHD_BASE_DATA_OFFSET_PRESENT = 0x000001
+
 TAG_PRHD = b"prhd"
 TAG_EQUI = b"equi"
 TAG_SVHD = b"svhd"
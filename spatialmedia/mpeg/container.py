@@ -24,17 +24,36 @@ import struct
 
 from spatialmedia.mpeg import box
 from spatialmedia.mpeg import constants
+from spatialmedia.mpeg import fragment
+from spatialmedia.mpeg import reader
 from spatialmedia.mpeg import sa3d
+from spatialmedia.mpeg import stats
 from spatialmedia.mpeg import sv3d
 
-def load(fh, position, end):
+def load(fh, position, end, lazy=False, header=None):
+    """Loads the box located at a position in a mp4 file.
+
+    Args:
+      fh: file handle, input file handle.
+      position: int or None, current file position.
+      end: int, end of the enclosing box or file.
+      lazy: bool, whether to defer loading the children of containers until
+        they are first accessed.
+      header: (size, name, header_size) or None, the box header if it has
+        already been read.
+
+    Returns:
+      box: box, box from loaded file location or None.
+    """
     if position is None:
         position = fh.tell()
 
-    fh.seek(position)
-    header_size = 8
-    size = struct.unpack(">I", fh.read(4))[0]
-    name = fh.read(4)
+    if header is None:
+        header = box.read_header(fh, position)
+    if header is None:
+        print("Error, truncated box header at", position)
+        return None
+    size, name, header_size = header
     is_box = name not in constants.CONTAINERS_LIST
     # Handle the mp4a decompressor setting (wave -> mp4a).
     if name == constants.TAG_MP4A and size == 12:
@@ -44,11 +63,9 @@ def load(fh, position, end):
             return sa3d.load(fh, position, end)
         if sv3d.is_supported_box_name(name):
             return sv3d.load(fh, position, end)
-        return box.load(fh, position, end)
-
-    if size == 1:
-        size = struct.unpack(">Q", fh.read(8))[0]
-        header_size = 16
+        if fragment.is_supported_box_name(name):
+            return fragment.load(fh, position, end, header)
+        return box.load(fh, position, end, header)
 
     if size < 8:
         print("Error, invalid size", size, "in", name, "at", position)
@@ -58,14 +75,34 @@ def load(fh, position, end):
         print("Error: Container box size exceeds bounds.")
         return None
 
+    new_box = Container()
+    new_box.name = name
+    new_box.position = position
+    new_box.header_size = header_size
+    new_box.content_size = size - header_size
+    new_box.source = fh
+    new_box.contents = None
+
+    if not lazy and not new_box.load_contents(lazy=False):
+        return None
+
+    return new_box
+
+
+def load_padding(fh, name, position):
+    """Returns the size of the fields preceding the children of a container.
+
+    Args:
+      fh: file handle, input file handle.
+      name: bytes, name of the container.
+      position: int, start of the container contents.
+    """
     padding = 0
     if name == constants.TAG_STSD:
         padding = 8
     if name in constants.SOUND_SAMPLE_DESCRIPTIONS:
-        current_pos = fh.tell()
-        fh.seek(current_pos + 8)
-        sample_description_version = struct.unpack(">h", fh.read(2))[0]
-        fh.seek(current_pos)
+        sample_description_version = struct.unpack_from(
+            ">h", reader.read_at(fh, position + 8, 2))[0]
 
         if sample_description_version == 0:
             padding = 28
@@ -77,62 +114,125 @@ def load(fh, position, end):
             print("Unsupported sample description version:",
                   sample_description_version)
     if name in constants.VIDEO_SAMPLE_DESCRIPTIONS:
-        current_pos = fh.tell()
-        fh.seek(current_pos + 8)
-        sample_description_version = struct.unpack(">h", fh.read(2))[0]
-        fh.seek(current_pos)
+        sample_description_version = struct.unpack_from(
+            ">h", reader.read_at(fh, position + 8, 2))[0]
 
         padding = 78
         if sample_description_version > 0:
             print("Warning: video sample description version > 0:",
                   sample_description_version)
+    return padding
 
-    new_box = Container()
-    new_box.name = name
-    new_box.position = position
-    new_box.header_size = header_size
-    new_box.content_size = size - header_size
-    new_box.padding = padding
-    new_box.contents = load_multiple(
-        fh, position + header_size + padding, position + size)
-
-    if new_box.contents is None:
-        return None
 
-    return new_box
-
-
-def load_multiple(fh, position=None, end=None):
+def load_multiple(fh, position=None, end=None, lazy=False):
     loaded = list()
     while (position + 4 < end):
-        new_box = load(fh, position, end)
+        new_box = load(fh, position, end, lazy)
         if new_box is None:
             print("Error, failed to load box.")
             return None
         loaded.append(new_box)
         position = new_box.position + new_box.size()
 
+    stats.count("boxes_parsed", len(loaded))
     return loaded
 
 
 class Container(box.Box):
-    """MPEG4 container box contents / behaviour."""
+    """MPEG4 container box contents / behaviour.
+
+    A container is dirty when boxes below it have been edited since its
+    size was last computed by resize().
+    """
+
+    # contents and padding are properties over _contents and _padding.
+    __slots__ = ("source", "_contents", "_padding", "dirty")
 
     def __init__(self, padding=0, header_size=0):
         self.name = ""
         self.position = 0
         self.header_size = header_size
-        self.content_size = 0
-        self.contents = list()
-        self.padding = padding
+        self.content_size = padding
+        self.parent = None
+        self.source = None
+        self.dirty = False
+        self._contents = list()
+        self._padding = padding
+
+    @property
+    def contents(self):
+        """Child boxes, loaded on first access for lazily loaded containers."""
+        if self._contents is None:
+            self.load_contents()
+        return self._contents
+
+    @contents.setter
+    def contents(self, contents):
+        self._contents = contents
+        if contents is not None:
+            for element in contents:
+                element.parent = self
+            self.mark_dirty()
+
+    @property
+    def padding(self):
+        if self._contents is None:
+            self.load_contents()
+        return self._padding
+
+    @padding.setter
+    def padding(self, padding):
+        self._padding = padding
+        self.mark_dirty()
+
+    def __getstate__(self):
+        # The children of a lazily loaded container are loaded before it is
+        # pickled, as its source file handle is not.
+        if self._contents is None:
+            self.load_contents(lazy=False)
+        return box.Box.__getstate__(self)
+
+    def mark_dirty(self):
+        """Flags this container and the ones above it as needing a resize."""
+        if not self.dirty:
+            self.dirty = True
+            box.Box.mark_dirty(self)
+
+    def load_contents(self, lazy=True):
+        """Loads the padding and children of the container from its source.
+
+        Args:
+          lazy: bool, whether children containers are loaded lazily too.
+
+        Returns:
+          Bool, whether the children were loaded successfully.
+        """
+        fh = self.source
+        self.source = None
+        self._padding = load_padding(fh, self.name, self.content_start())
+        self._contents = load_multiple(
+            fh, self.content_start() + self._padding,
+            self.position + self.size(), lazy)
+        if self._contents is None:
+            print("Error, failed to load contents of", self.name)
+            self._contents = list()
+            return False
+        for element in self._contents:
+            element.parent = self
+        return True
 
     def resize(self):
-        """Recomputes the box size and recurses on contents."""
+        """Recomputes the box size and recurses on dirty contents.
+
+        Containers that are not dirty keep their size, so after an edit only
+        the ancestors of the edited box are visited.
+        """
         self.content_size = self.padding
         for element in self.contents:
-            if isinstance(element, Container):
+            if isinstance(element, Container) and element.dirty:
                 element.resize()
             self.content_size += element.size()
+        self.dirty = False
 
     def print_box(self, console):
         for child in self.contents:
@@ -160,17 +260,26 @@ class Container(box.Box):
             element = self.contents[i]
             element.print_structure(next_indent)
 
+    def find_all(self, name):
+        """Returns all boxes with a given name below this container."""
+        found = []
+        for element in self.contents:
+            if element.name == name:
+                found.append(element)
+            if isinstance(element, Container):
+                found.extend(element.find_all(name))
+        return found
+
     def remove(self, tag):
         """Removes a tag recursively from all containers."""
         new_contents = []
-        self.content_size = 0
         for element in self.contents:
             if element.name != tag:
                 new_contents.append(element)
                 if isinstance(element, Container):
                     element.remove(tag)
-                self.content_size += element.size()
-        self.contents = new_contents
+        if len(new_contents) != len(self.contents):
+            self.contents = new_contents
 
     def add(self, element):
         """Adds an element, merging with containers of the same type.
@@ -180,14 +289,20 @@ class Container(box.Box):
         """
         for content in self.contents:
             if content.name == element.name:
-                if isinstance(content, container_leaf):
+                if isinstance(content, Container):
                     return content.merge(element)
                 print("Error, cannot merge leafs.")
                 return False
 
-        self.contents.append(element)
+        self.append(element)
         return True
 
+    def append(self, element):
+        """Appends an element to the contents."""
+        self.contents.append(element)
+        element.parent = self
+        self.mark_dirty()
+
     def merge(self, element):
         """Merges structure with container.
 
@@ -195,7 +310,7 @@ class Container(box.Box):
           Int, increased size of container.
         """
         assert(self.name == element.name)
-        assert(isinstance(element, container_box))
+        assert(isinstance(element, Container))
         for sub_element in element.contents:
             if not self.add(sub_element):
                 return False
@@ -210,13 +325,7 @@ class Container(box.Box):
           out_fh: file_hande, destination for saved file.
           delta: int, file change size for updating stco and co64 files.
         """
-        if self.header_size == 16:
-            out_fh.write(struct.pack(">I", 1))
-            out_fh.write(self.name)
-            out_fh.write(struct.pack(">Q", self.size()))
-        elif self.header_size == 8:
-            out_fh.write(struct.pack(">I", self.size()))
-            out_fh.write(self.name)
+        self.save_header(out_fh)
 
         if self.padding > 0:
             in_fh.seek(self.content_start())
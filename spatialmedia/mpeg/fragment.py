@@ -0,0 +1,224 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2016 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""MPEG movie fragment box processing classes.
+
+Fragmented files (moof + mdat pairs following the moov) address their media
+data with a few absolute file offsets that have to move with the data:
+
+  tfhd base_data_offset, when the base-data-offset-present flag is set.
+  tfra moof_offset, the position of every fragment listed in the mfra.
+
+trun data offsets are relative to the base data offset or the moof and
+sidx references are relative to the sidx, so neither changes when all
+fragments move by the same amount. Fragment boxes are not held in memory,
+each one is read, patched and written out when it is saved.
+"""
+
+import struct
+
+from spatialmedia.mpeg import box
+from spatialmedia.mpeg import constants
+from spatialmedia.mpeg import reader
+
+
+def is_supported_box_name(name):
+    """Returns true if the box name is a fragment box with file offsets."""
+    return name == constants.TAG_MOOF or name == constants.TAG_MFRA
+
+
+def load(fh, position=None, end=None, header=None):
+    """Loads the moof or mfra box located at position in an mp4 file.
+
+    Only the header of the box is read.
+
+    Args:
+      fh: file handle, input file handle.
+      position: int or None, current file position.
+      end: int, end of the enclosing box or file.
+      header: (size, name, header_size) or None, the box header if it has
+        already been read.
+
+    Returns:
+      new_box: box, fragment box loaded from the file location or None.
+    """
+    if position is None:
+        position = fh.tell()
+
+    if header is None:
+        header = box.read_header(fh, position)
+    if header is None:
+        print("Error: truncated fragment box.")
+        return None
+    size, name, header_size = header
+
+    if name == constants.TAG_MOOF:
+        new_box = MoofBox()
+    elif name == constants.TAG_MFRA:
+        new_box = MfraBox()
+    else:
+        print("Error: box is not a supported fragment box.")
+        return None
+
+    if size < header_size or position + size > end:
+        print("Error: fragment box size exceeds bounds.")
+        return None
+
+    new_box.position = position
+    new_box.header_size = header_size
+    new_box.content_size = size - header_size
+    return new_box
+
+
+def child_boxes(data, start, end):
+    """Yields (name, content start, content end) of the boxes in a buffer.
+
+    Args:
+      data: bytes, buffer holding the boxes.
+      start: int, position of the first box in data.
+      end: int, end of the boxes in data.
+    """
+    position = start
+    while position + 8 <= end:
+        size, name = struct.unpack_from(">I4s", data, position)
+        header_size = 8
+        if size == 1 and position + 16 <= end:
+            size = struct.unpack_from(">Q", data, position + 8)[0]
+            header_size = 16
+        elif size == 0:
+            size = end - position
+        if size < header_size or position + size > end:
+            return
+        yield name, position + header_size, position + size
+        position += size
+
+
+def patch_moof(data, delta):
+    """Adds delta to the base data offsets of the track fragments of a moof.
+
+    Args:
+      data: bytearray, moof box contents, updated in place.
+      delta: int, offset change of the file contents following the moov.
+
+    Returns:
+      Int, number of offsets updated.
+    """
+    patched = 0
+    for name, start, end in child_boxes(data, 0, len(data)):
+        if name != constants.TAG_TRAF:
+            continue
+        for traf_name, traf_start, traf_end in child_boxes(data, start, end):
+            if traf_name != constants.TAG_TFHD or traf_end - traf_start < 16:
+                continue
+            flags = struct.unpack_from(">I", data, traf_start)[0] & 0xFFFFFF
+            if not flags & constants.TFHD_BASE_DATA_OFFSET_PRESENT:
+                continue
+            offset = struct.unpack_from(">Q", data, traf_start + 8)[0]
+            struct.pack_into(">Q", data, traf_start + 8, offset + delta)
+            patched += 1
+    return patched
+
+
+def patch_mfra(data, delta):
+    """Adds delta to the moof offsets of the tfra boxes of a mfra.
+
+    Args:
+      data: bytearray, mfra box contents, updated in place.
+      delta: int, offset change of the file contents following the moov.
+
+    Returns:
+      Int, number of offsets updated.
+    """
+    patched = 0
+    for name, start, end in child_boxes(data, 0, len(data)):
+        if name != constants.TAG_TFRA or end - start < 16:
+            continue
+        version = data[start]
+        lengths = struct.unpack_from(">I", data, start + 8)[0]
+        entries = struct.unpack_from(">I", data, start + 12)[0]
+        field_size = 8 if version == 1 else 4
+        entry_size = (2 * field_size + ((lengths >> 4) & 3) + 1 +
+                      ((lengths >> 2) & 3) + 1 + (lengths & 3) + 1)
+        mode = ">Q" if version == 1 else ">I"
+        position = start + 16
+        for _ in range(entries):
+            if position + entry_size > end:
+                break
+            offset = struct.unpack_from(
+                mode, data, position + field_size)[0] + delta
+            if version != 1 and offset > 0xFFFFFFFF:
+                print("Error: tfra moof offset overflow, the fragment index "
+                      "is no longer valid.")
+                return patched
+            struct.pack_into(mode, data, position + field_size, offset)
+            position += entry_size
+            patched += 1
+    return patched
+
+
+class FragmentBox(box.Box):
+    """Box holding absolute file offsets, patched when it is saved."""
+
+    __slots__ = ()
+
+    def patch(self, data, delta):
+        return 0
+
+    def save(self, in_fh, out_fh, delta):
+        """Save box contents with file offsets moved by delta.
+
+        Args:
+          in_fh: file handle, source to read box contents from.
+          out_fh: file handle, destination for written box contents.
+          delta: int, offset change of the file contents following the moov.
+        """
+        if delta == 0 or self.contents:
+            box.Box.save(self, in_fh, out_fh, delta)
+            return
+
+        self.save_header(out_fh)
+
+        data = bytearray(reader.read_at(in_fh, self.content_start(),
+                                        self.content_size))
+        self.patch(data, delta)
+        out_fh.write(data)
+
+
+class MoofBox(FragmentBox):
+    """Movie fragment box."""
+
+    __slots__ = ()
+
+    def __init__(self):
+        box.Box.__init__(self)
+        self.name = constants.TAG_MOOF
+
+    def patch(self, data, delta):
+        return patch_moof(data, delta)
+
+
+class MfraBox(FragmentBox):
+    """Movie fragment random access box."""
+
+    __slots__ = ()
+
+    def __init__(self):
+        box.Box.__init__(self)
+        self.name = constants.TAG_MFRA
+
+    def patch(self, data, delta):
+        return patch_mfra(data, delta)
@@ -20,26 +20,41 @@
 Functions for loading MP4/MOV files and manipulating boxes.
 """
 
+import collections
+import struct
+
 from spatialmedia.mpeg import box
 from spatialmedia.mpeg import constants
 from spatialmedia.mpeg import container
+from spatialmedia.mpeg import reader
+from spatialmedia.mpeg import stats
+from spatialmedia.mpeg import track
 
 
-def load(fh):
+def load(fh, lazy=False, memory_map=False, moov=None):
     """Load the mpeg4 file structure of a file.
 
     Args:
       fh: file handle, input file handle.
-      position: int, current file position.
-      size: int, maximum size. This is used to ensure correct box sizes.
+      lazy: bool, whether to only read the top-level box headers up front
+        and load the children of containers when they are first accessed.
+        fh must stay open for as long as the structure is used.
+      memory_map: bool, whether to memory map fh and parse (and later copy)
+        the file from the mapping instead of reading it. Falls back to
+        reading when fh cannot be mapped.
+      moov: bytes or None, contents of the moov box of fh read earlier,
+        used instead of reading the moov box again.
 
     return:
       mpeg4, the loaded mpeg4 structure.
     """
 
+    if memory_map:
+        fh = reader.map_file(fh) or fh
+
     fh.seek(0, 2)
     size = fh.tell()
-    contents = container.load_multiple(fh, 0, size)
+    contents, moov_reader = load_top_level(fh, size, lazy, moov)
 
     if not contents:
         print("Error, failed to load .mp4 file.")
@@ -48,8 +63,34 @@ def load(fh):
         print("Error, no boxes found.")
         return None
 
+    loaded_mpeg4 = build(contents, moov_reader)
+
+    if not loaded_mpeg4.moov_box:
+        print("Error, file does not contain moov box.")
+        return None
+
+    if (loaded_mpeg4.first_mdat_box is None and
+            not loaded_mpeg4.is_fragmented()):
+        # Only initialization segments of fragmented files have no media.
+        print("Error, file does not contain mdat box.")
+        return None
+
+    return loaded_mpeg4
+
+
+def build(contents, moov_reader=None):
+    """Creates the mpeg4 structure holding loaded top-level boxes.
+
+    Args:
+      contents: list of boxes, the top-level boxes.
+      moov_reader: file handle or None, reader of the file contents.
+
+    Returns:
+      mpeg4, the mpeg4 structure.
+    """
     loaded_mpeg4 = Mpeg4Container()
     loaded_mpeg4.contents = contents
+    loaded_mpeg4.reader = moov_reader
 
     for element in loaded_mpeg4.contents:
         if (element.name == constants.TAG_MOOV):
@@ -62,18 +103,11 @@ def load(fh):
         if (element.name == constants.TAG_FTYP):
             loaded_mpeg4.ftyp_box = element
 
-    if not loaded_mpeg4.moov_box:
-        print("Error, file does not contain moov box.")
-        return None
-
-    if not loaded_mpeg4.first_mdat_box:
-        print("Error, file does not contain mdat box.")
-        return None
-
-    loaded_mpeg4.first_mdat_position = \
-        loaded_mpeg4.first_mdat_box.position
-    loaded_mpeg4.first_mdat_position += \
-        loaded_mpeg4.first_mdat_box.header_size
+    if loaded_mpeg4.first_mdat_box:
+        loaded_mpeg4.first_mdat_position = \
+            loaded_mpeg4.first_mdat_box.position
+        loaded_mpeg4.first_mdat_position += \
+            loaded_mpeg4.first_mdat_box.header_size
 
     loaded_mpeg4.content_size = 0
     for element in loaded_mpeg4.contents:
@@ -82,11 +116,68 @@ def load(fh):
     return loaded_mpeg4
 
 
+def load_top_level(fh, size, lazy=False, moov=None):
+    """Loads the top-level boxes of a file, reading moov in one piece.
+
+    Only the headers of the top-level boxes are read from fh. The moov box
+    is read with a single read and its subtree is parsed from memory.
+
+    Args:
+      fh: file handle, input file handle.
+      size: int, size of the file.
+      lazy: bool, whether to load container children on first access.
+      moov: bytes or None, contents of the moov box read earlier.
+
+    Returns:
+      (contents, moov_reader), the loaded boxes or None on error and a
+      reader serving the moov from memory and the rest of the file from fh.
+      When fh already is an in-memory reader it is used for everything.
+    """
+    moov_reader = fh
+    if not isinstance(fh, reader.BufferReader):
+        moov_reader = reader.BufferReader(b"", 0, fh)
+    contents = list()
+    position = 0
+    while (position + 4 < size):
+        source = fh
+        header = box.read_header(fh, position)
+        if header is not None and header[0] == 0:
+            # A size of 0 extends the last box to the end of the file.
+            header = (size - position, header[1], header[2])
+        if (header is not None and header[1] == constants.TAG_MOOV
+                and 8 <= header[0] and position + header[0] <= size):
+            if not isinstance(fh, reader.BufferReader):
+                data = moov
+                if data is None or len(data) != header[0]:
+                    data = reader.read_at(fh, position, header[0])
+                moov_reader = reader.BufferReader(data, position, fh)
+            source = moov_reader
+        new_box = container.load(source, position, size, lazy, header)
+        if new_box is None:
+            print("Error, failed to load box.")
+            return None, moov_reader
+        contents.append(new_box)
+        position = new_box.position + new_box.size()
+    stats.count("boxes_parsed", len(contents))
+    return contents, moov_reader
+
+
+# Part of a saved file: data, or when data is None, size bytes of the source
+# file at position.
+Segment = collections.namedtuple("Segment", "data position size")
+
+
 class Mpeg4Container(container.Container):
     """Specialized behaviour for the root mpeg4 container."""
 
+    __slots__ = ("moov_box", "free_box", "first_mdat_box", "ftyp_box",
+                 "first_mdat_position", "reader", "_tracks")
+
     def __init__(self):
-        self.contents = list()
+        self.parent = None
+        self.source = None
+        self.dirty = False
+        self._contents = list()
         self.content_size = 0
         self.header_size = 0
         self.moov_box = None
@@ -94,7 +185,116 @@ class Mpeg4Container(container.Container):
         self.first_mdat_box = None
         self.ftyp_box = None
         self.first_mdat_position = None
-        self.padding = 0
+        self._padding = 0
+        self.reader = None
+        self._tracks = None
+
+    @property
+    def tracks(self):
+        """List of track.Track, the index of the traks of the moov.
+
+        Built on first access, the handler types and channel counts are
+        read once per file.
+        """
+        if self._tracks is None:
+            self._tracks = track.index_tracks(self.moov_box, self.reader)
+        return self._tracks
+
+    def close(self):
+        """Releases the in-memory copy or memory map of the file."""
+        if self.reader is not None:
+            self.reader.close()
+            self.reader = None
+
+    def is_fragmented(self):
+        """Returns whether the file holds or announces movie fragments."""
+        for element in self.contents:
+            if element.name == constants.TAG_MOOF:
+                return True
+        for element in self.moov_box.contents:
+            if element.name == constants.TAG_MVEX:
+                return True
+        return False
+
+    def faststart(self):
+        """Moves the moov box ahead of the media data for progressive playback.
+
+        The moov is placed right before the first mdat, the offset shift is
+        applied to chunk offsets when saving.
+
+        Returns:
+          Bool, whether the moov is now ahead of the media data. Files with
+          media data on both sides of the moov are left unchanged.
+        """
+        moov_index = self.contents.index(self.moov_box)
+        media = [index for index, element in enumerate(self.contents)
+                 if element.name in (constants.TAG_MDAT, constants.TAG_MOOF)]
+        if not media or media[0] > moov_index:
+            return True
+        if media[-1] > moov_index:
+            print("Error, media data on both sides of the moov box.")
+            return False
+
+        self.contents.remove(self.moov_box)
+        self.contents.insert(media[0], self.moov_box)
+        return True
+
+    def reserve_padding(self, size):
+        """Sets the free space kept after a moov box ahead of the media.
+
+        Free boxes following the moov are resized to absorb the change in
+        size of the moov when they can, so the media data and the chunk
+        offsets stay where they are. Otherwise they are replaced by a single
+        free box of size bytes, leaving room for later changes to the moov
+        to be written in place. Call once, after the moov has been modified.
+
+        Args:
+          size: int, size of the free box added when the existing free
+            space cannot be reused, 0 to keep the existing boxes.
+
+        Returns:
+          Bool, whether the media data keeps its position.
+        """
+        index = self.contents.index(self.moov_box)
+        for element in self.contents[:index]:
+            if element.name in (constants.TAG_MDAT, constants.TAG_MOOF):
+                # Media ahead of the moov does not move, nor would padding
+                # after the moov help rewriting it in place.
+                return True
+
+        self.resize()
+        last = index
+        while (last + 1 < len(self.contents) and
+               self.contents[last + 1].name in constants.FREE_SPACE_TAGS):
+            last += 1
+        if last > index:
+            end = self.contents[last].position + self.contents[last].size()
+        elif last + 1 < len(self.contents):
+            end = self.contents[last + 1].position
+        else:
+            end = None
+
+        padding = None
+        if end is not None:
+            available = end - sum(element.size()
+                                  for element in self.contents[:index + 1])
+            if available == 0 or available >= 8:
+                padding = available
+        kept = padding is not None
+        if padding is None:
+            if size == 0:
+                return False
+            padding = size
+
+        free_space = None
+        if kept and padding:
+            free_space = resize_free_space(self.contents[index + 1:last + 1],
+                                           padding)
+        if free_space is None:
+            free_space = [free_box(padding)] if padding else []
+        self.contents[index + 1:last + 1] = free_space
+        self.resize()
+        return kept
 
     def merge(self, element):
         """Mpeg4 containers do not support merging."""
@@ -113,21 +313,339 @@ class Mpeg4Container(container.Container):
 
             self.contents[i].print_structure(next_indent)
 
-    def save(self, in_fh, out_fh):
+    def save(self, in_fh, out_fh, progress=None):
         """Save mpeg4 filecontent to file.
 
         Args:
           in_fh: file handle, source file handle for uncached contents.
           out_fh: file handle, destination file hand for saved file.
+          progress: function or None, called with the number of bytes
+            written, the size of the saved file and the write speed in MB/s
+            as the file is written, at most every box.PROGRESS_INTERVAL
+            seconds and once the file is complete.
+        """
+        delta = self.prepare_save(in_fh)
+
+        meter = None
+        if progress is not None:
+            meter = box.ProgressMeter(progress, self.content_size)
+        # Runs of boxes held in memory are packed and written together.
+        buffered = []
+        for element in self.contents:
+            if is_buffered(element):
+                buffered.append(element)
+                continue
+            write_boxes(buffered, in_fh, out_fh, delta, meter)
+            buffered = []
+            with stats.phase("media_copy"):
+                if meter is not None and not element.contents:
+                    save_media(element, in_fh, out_fh, meter.advance)
+                else:
+                    element.save(in_fh, out_fh, delta)
+                    if meter is not None:
+                        meter.advance(element.size())
+        write_boxes(buffered, in_fh, out_fh, delta, meter)
+        if meter is not None:
+            meter.finish()
+
+    def segments(self, in_fh):
+        """Returns the contents of the saved file without copying the media.
+
+        The file is described as the new data of the boxes ahead of, between
+        and after the mdat boxes, which are referenced in the source file:
+        concatenating the segments gives the output of save().
+
+        Args:
+          in_fh: file handle, source file handle for uncached contents.
+
+        Returns:
+          List of Segment, in file order.
         """
+        delta = self.prepare_save(in_fh)
+
+        segments = []
+        saved = []
+        for element in self.contents:
+            if element.name != constants.TAG_MDAT or element.contents:
+                saved.append(element)
+                continue
+            out_fh = save_boxes(saved, in_fh, delta, element.header_size)
+            out_fh.write(box_header(element))
+            data = out_fh.getvalue()
+            segments.append(Segment(data, None, len(data)))
+            segments.append(Segment(None, element.content_start(),
+                                    element.content_size))
+            saved = []
+        data = save_boxes(saved, in_fh, delta).getvalue()
+        if data:
+            segments.append(Segment(data, None, len(data)))
+        return segments
+
+    def prepare_save(self, in_fh):
+        """Updates box sizes for saving, returns the chunk offset change."""
+        in_fh.seek(0, 2)
+        file_size = in_fh.tell()
         self.resize()
+        delta = self.mdat_delta()
+        while self.promote_chunk_offsets(in_fh, delta, file_size):
+            self.resize()
+            delta = self.mdat_delta()
+        return delta
+
+    def mdat_delta(self):
+        """Returns how far the first mdat payload moves when saved."""
+        if self.first_mdat_position is None:
+            return 0
         new_position = 0
         for element in self.contents:
             if element.name == constants.TAG_MDAT:
                 new_position += element.header_size
                 break
             new_position += element.size()
-        delta = new_position - self.first_mdat_position
+        return new_position - self.first_mdat_position
 
-        for element in self.contents:
-            element.save(in_fh, out_fh, delta)
+    def promote_chunk_offsets(self, in_fh, delta, file_size=None):
+        """Promotes stco boxes to co64 where delta would overflow them.
+
+        Args:
+          in_fh: file handle, source file handle for uncached contents.
+          delta: int, offset change for chunk offsets.
+          file_size: int or None, size of the source file. No table is read
+            when no offset within it can overflow. None checks every table.
+
+        Returns:
+          Bool, whether any box was promoted (and sizes have changed).
+        """
+        if delta <= 0:
+            return False
+        if (file_size is not None and
+                file_size + delta <= box.MAX_STCO_OFFSET):
+            return False
+
+        promoted = False
+        for stco_box in self.moov_box.find_all(constants.TAG_STCO):
+            if box.promote_stco(in_fh, stco_box, delta):
+                promoted = True
+        return promoted
+
+    def save_in_place(self, fh):
+        """Rewrites the moov box of a file without moving any mdat data.
+
+        The new moov is written over the region taken by the old moov and
+        any free boxes directly around it, with the remaining space kept as
+        a free box. A moov at the end of the file is simply rewritten. If
+        the new moov does not fit, it is appended to the end of the file and
+        the old moov is turned into a free box, except for fragmented files
+        which need the moov ahead of their fragments. A last box stored
+        with a size of 0 (extending to the end of the file) is given its
+        explicit size first, or the file is left untouched if that size
+        does not fit its header.
+
+        Args:
+          fh: file handle, file opened for both reading and writing.
+
+        Returns:
+          Bool, whether the file was written.
+        """
+        self.resize()
+        moov_data = save_boxes([self.moov_box], fh, 0).getvalue()
+
+        index = self.contents.index(self.moov_box)
+        first = index
+        while (first > 0 and
+               self.contents[first - 1].name in constants.FREE_SPACE_TAGS):
+            first -= 1
+        last = index
+        while (last + 1 < len(self.contents) and
+               self.contents[last + 1].name in constants.FREE_SPACE_TAGS):
+            last += 1
+
+        fh.seek(0, 2)
+        file_size = fh.tell()
+        start = self.contents[first].position
+        if last + 1 < len(self.contents):
+            end = self.contents[last + 1].position
+        else:
+            end = file_size
+        available = end - start
+        remaining = available - len(moov_data)
+
+        if end == file_size:
+            fh.seek(start)
+            fh.write(moov_data)
+            fh.truncate()
+        elif len(moov_data) == available:
+            fh.seek(start)
+            fh.write(moov_data)
+        elif remaining >= 8 and remaining >= len(free_header(remaining)):
+            fh.seek(start)
+            moov_data += free_header(remaining)
+            fh.write(moov_data)
+        elif self.is_fragmented():
+            return False
+        else:
+            if not self.fix_open_ended_box(fh):
+                return False
+            fh.seek(file_size)
+            fh.write(moov_data)
+            fh.seek(self.moov_box.position + 4)
+            fh.write(constants.TAG_FREE)
+        fh.flush()
+        return True
+
+    def fix_open_ended_box(self, fh):
+        """Writes the size of a last box stored as extending to the end.
+
+        Args:
+          fh: file handle, file opened for both reading and writing.
+
+        Returns:
+          Bool, False if the size does not fit the header of the box.
+        """
+        last_box = self.contents[-1]
+        header = box.read_header(fh, last_box.position)
+        if header is None or header[0] != 0:
+            return True
+        if last_box.header_size == 16:
+            fh.seek(last_box.position + 8)
+            fh.write(struct.pack(">Q", last_box.size()))
+        elif last_box.size() > 0xFFFFFFFF:
+            return False
+        else:
+            fh.seek(last_box.position)
+            fh.write(struct.pack(">I", last_box.size()))
+        return True
+
+
+def is_buffered(element):
+    """Returns whether a top-level box is saved through a BoxWriter.
+
+    Containers and boxes up to box.COPY_BLOCK_SIZE are; media data and other
+    large boxes are copied straight to the output.
+    """
+    if element.name == constants.TAG_MDAT and not element.contents:
+        return False
+    return (isinstance(element, container.Container) or
+            element.size() <= box.COPY_BLOCK_SIZE)
+
+
+def save_boxes(elements, in_fh, delta, reserve=0):
+    """Saves boxes into a box.BoxWriter sized to hold them.
+
+    Args:
+      elements: list of box, boxes to save, in order.
+      in_fh: file handle, source file handle for uncached contents.
+      delta: int, offset change for chunk offsets.
+      reserve: int, extra room to leave for data written afterwards.
+
+    Returns:
+      box.BoxWriter, holding the saved boxes.
+    """
+    out_fh = box.BoxWriter(
+        sum(element.size() for element in elements) + reserve)
+    for element in elements:
+        element.save(in_fh, out_fh, delta)
+    return out_fh
+
+
+def write_boxes(elements, in_fh, out_fh, delta, meter=None):
+    """Saves boxes to out_fh with a single write.
+
+    Args:
+      elements: list of box, boxes to save, in order.
+      in_fh: file handle, source file handle for uncached contents.
+      out_fh: file handle, destination file handle.
+      delta: int, offset change for chunk offsets.
+      meter: box.ProgressMeter or None, advanced by the amount written.
+    """
+    if not elements:
+        return
+    data = save_boxes(elements, in_fh, delta).getvalue()
+    out_fh.write(data)
+    if meter is not None:
+        meter.advance(len(data))
+
+
+def save_media(element, in_fh, out_fh, progress):
+    """Copies an mdat box, reporting progress as the copy proceeds.
+
+    Args:
+      element: box, the mdat box.
+      in_fh: file handle, source file handle.
+      out_fh: file handle, destination file handle.
+      progress: function, called with the number of bytes written.
+    """
+    out_fh.write(box_header(element))
+    progress(element.header_size)
+
+    in_fh.seek(element.content_start())
+    box.tag_copy(in_fh, out_fh, element.content_size, progress)
+
+
+def box_header(element):
+    """Returns the header of a box as saved."""
+    if element.header_size == 16:
+        return struct.pack(">I4sQ", 1, element.name, element.size())
+    if element.header_size == 8:
+        return struct.pack(">I4s", element.size(), element.name)
+    return b""
+
+
+def free_header(size):
+    """Returns the header of a free box spanning size bytes."""
+    if size > 0xFFFFFFFF:
+        return struct.pack(">I4sQ", 1, constants.TAG_FREE, size)
+    return struct.pack(">I4s", size, constants.TAG_FREE)
+
+
+def resize_free_space(elements, size):
+    """Resizes free boxes to span size bytes, changing only the first one.
+
+    The first box keeps a prefix of its contents when it shrinks, and is
+    followed by a new zero filled free box when it grows, so that large free
+    boxes are copied from the source rather than held in memory.
+
+    Args:
+      elements: list of box, consecutive free boxes.
+      size: int, total size to give them.
+
+    Returns:
+      List of box spanning size bytes, or None if the first box cannot be
+      resized.
+    """
+    if not elements:
+        return None
+    first = elements[0]
+    rest = elements[1:]
+    first_size = size - sum(element.size() for element in rest)
+    growth = first_size - first.size()
+    if growth == 0:
+        return elements
+    if 0 < growth < 8:
+        # Too little for a box of its own, move 8 bytes of the first box
+        # into the new one.
+        growth += 8
+        first_size -= growth
+    if first_size < max(first.header_size, 8) or (
+            first.header_size == 8 and first_size > 0xFFFFFFFF):
+        return None
+    if first_size < first.size():
+        content_size = first_size - first.header_size
+        if first.contents is not None:
+            first.set(first.contents[:content_size])
+        else:
+            first.content_size = content_size
+            first.mark_dirty()
+    if growth > 0:
+        return [first, free_box(growth)] + rest
+    return [first] + rest
+
+
+def free_box(size):
+    """Returns a zero filled free box of size bytes."""
+    new_box = box.Box()
+    new_box.name = constants.TAG_FREE
+    new_box.header_size = 8
+    new_box.contents = bytes(size - new_box.header_size)
+    new_box.content_size = len(new_box.contents)
+    return new_box
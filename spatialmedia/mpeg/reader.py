@@ -0,0 +1,144 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2016 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""MPEG file readers.
+
+File handles serving parts of a file from memory.
+"""
+
+import mmap
+
+
+def read_at(fh, position, size):
+    """Reads size bytes at position from a file handle.
+
+    Args:
+      fh: file handle, input file handle.
+      position: int, file position to read from.
+      size: int, number of bytes to read.
+
+    Returns:
+      bytes or memoryview, the data read. In-memory handles return a view
+      of their buffer instead of a copy.
+    """
+    if isinstance(fh, BufferReader):
+        return fh.read_at(position, size)
+    fh.seek(position)
+    return fh.read(size)
+
+
+def map_file(fh):
+    """Memory maps a file for reading.
+
+    Args:
+      fh: file handle, input file handle backed by a real file.
+
+    Returns:
+      BufferReader over the whole file, or None if it cannot be mapped
+      (empty files, pipes, in-memory streams).
+    """
+    try:
+        mapped = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+    except (AttributeError, OSError, ValueError):
+        return None
+    return BufferReader(mapped, 0, fh)
+
+
+class BufferReader(object):
+    """Read only file handle over a region of a file held in memory.
+
+    Positions are file positions, the buffer holding the file contents
+    starting at base. Reads outside of the buffer are passed on to the
+    fallback file handle, if any.
+    """
+
+    def __init__(self, buffer, base=0, fallback=None):
+        self.buffer = buffer
+        self.view = memoryview(buffer)
+        self.base = base
+        self.end = base + len(self.view)
+        self.fallback = fallback
+        self.position = base
+
+    def contains(self, position, size):
+        """Returns whether a range of the file is held in memory."""
+        return self.base <= position and position + size <= self.end
+
+    def read_at(self, position, size):
+        """Reads size bytes at position without moving the file position.
+
+        Without a fallback, a read running past the end of the buffer
+        returns the bytes up to it, as at the end of a file, and a read
+        starting outside of the buffer returns no bytes.
+        """
+        if self.contains(position, size):
+            return self.view[position - self.base:position - self.base + size]
+        if self.fallback is not None:
+            self.fallback.seek(position)
+            return self.fallback.read(size)
+        if self.base <= position < self.end:
+            return self.view[position - self.base:]
+        return b""
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = max(self.size() - self.position, 0)
+        data = bytes(self.read_at(self.position, size))
+        self.position += len(data)
+        return data
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.position
+        elif whence == 2:
+            offset += self.size()
+        self.position = offset
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def size(self):
+        """Size of the underlying file."""
+        if self.fallback is not None:
+            position = self.fallback.tell()
+            self.fallback.seek(0, 2)
+            size = self.fallback.tell()
+            self.fallback.seek(position)
+            return size
+        return self.end
+
+    def seekable(self):
+        return True
+
+    def fileno(self):
+        if self.fallback is None:
+            raise OSError("in-memory reader has no file descriptor")
+        return self.fallback.fileno()
+
+    def close(self):
+        """Releases the buffer. The fallback file handle is not closed.
+
+        Memory maps still referenced by views handed out by read_at are
+        unmapped once the last view is garbage collected.
+        """
+        try:
+            self.view.release()
+            if isinstance(self.buffer, mmap.mmap):
+                self.buffer.close()
+        except BufferError:
+            pass
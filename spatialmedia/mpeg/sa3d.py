@@ -25,6 +25,7 @@ import struct
 
 from spatialmedia.mpeg import box
 from spatialmedia.mpeg import constants
+from spatialmedia.mpeg import reader
 
 
 def load(fh, position=None, end=None):
@@ -40,11 +41,11 @@ def load(fh, position=None, end=None):
     if position is None:
         position = fh.tell()
 
-    fh.seek(position)
-    new_box = SA3DBox()
-    new_box.position = position
-    size = struct.unpack(">I", fh.read(4))[0]
-    name = fh.read(4)
+    header = box.read_header(fh, position)
+    if header is None:
+        print("Error: truncated SA3D box.")
+        return None
+    size, name, header_size = header
 
     if (name != constants.TAG_SA3D):
         print("Error: box is not an SA3D box.")
@@ -54,22 +55,29 @@ def load(fh, position=None, end=None):
         print("Error: SA3D box size exceeds bounds.")
         return None
 
+    new_box = SA3DBox()
+    new_box.position = position
+    new_box.header_size = header_size
     new_box.content_size = size - new_box.header_size
-    new_box.version = struct.unpack(">B", fh.read(1))[0]
-    new_box.ambisonic_type = struct.unpack(">B", fh.read(1))[0]
-    new_box.head_locked_stereo = (new_box.ambisonic_type & int('10000000', 2) != 0)
-    new_box.ambisonic_type = new_box.ambisonic_type & int('01111111', 2)
-    new_box.ambisonic_order = struct.unpack(">I", fh.read(4))[0]
-    new_box.ambisonic_channel_ordering = struct.unpack(">B", fh.read(1))[0]
-    new_box.ambisonic_normalization = struct.unpack(">B", fh.read(1))[0]
-    new_box.num_channels = struct.unpack(">I", fh.read(4))[0]
-    for i in range(0, new_box.num_channels):
-        new_box.channel_map.append(
-            struct.unpack(">I", fh.read(4))[0])
+    data = reader.read_at(fh, position + header_size, new_box.content_size)
+    (new_box.version,
+     ambisonic_type,
+     new_box.ambisonic_order,
+     new_box.ambisonic_channel_ordering,
+     new_box.ambisonic_normalization,
+     new_box.num_channels) = struct.unpack_from(">BBIBBI", data)
+    new_box.head_locked_stereo = (ambisonic_type & int('10000000', 2) != 0)
+    new_box.ambisonic_type = ambisonic_type & int('01111111', 2)
+    new_box.channel_map = list(struct.unpack_from(
+        ">%dI" % new_box.num_channels, data, 12))
     return new_box
 
 
 class SA3DBox(box.Box):
+    __slots__ = ("version", "ambisonic_type", "head_locked_stereo",
+                 "ambisonic_order", "ambisonic_channel_ordering",
+                 "ambisonic_normalization", "num_channels", "channel_map")
+
     ambisonic_types = {'periphonic': 0}
     ambisonic_orderings = {'ACN': 0}
     ambisonic_normalizations = {'SN3D': 0}
@@ -154,23 +162,14 @@ class SA3DBox(box.Box):
         return metadata
 
     def save(self, in_fh, out_fh, delta):
-        if (self.header_size == 16):
-            out_fh.write(struct.pack(">I", 1))
-            out_fh.write(struct.pack(">Q", self.size()))
-            out_fh.write(self.name)
-        elif(self.header_size == 8):
-            out_fh.write(struct.pack(">I", self.size()))
-            out_fh.write(self.name)
+        self.save_header(out_fh)
 
         ambisonic_type = (
             self.ambisonic_type | int('10000000', 2) if
             self.head_locked_stereo else self.ambisonic_type & int('01111111', 2))
-        out_fh.write(struct.pack(">B", self.version))
-        out_fh.write(struct.pack(">B", ambisonic_type))
-        out_fh.write(struct.pack(">I", self.ambisonic_order))
-        out_fh.write(struct.pack(">B", self.ambisonic_channel_ordering))
-        out_fh.write(struct.pack(">B", self.ambisonic_normalization))
-        out_fh.write(struct.pack(">I", self.num_channels))
-        for i in self.channel_map:
-            if (i != None):
-                out_fh.write(struct.pack(">I", int(i)))
+        channel_map = [int(i) for i in self.channel_map if i != None]
+        box.pack(out_fh, ">BBIBBI%dI" % len(channel_map),
+                 self.version, ambisonic_type, self.ambisonic_order,
+                 self.ambisonic_channel_ordering,
+                 self.ambisonic_normalization, self.num_channels,
+                 *channel_map)
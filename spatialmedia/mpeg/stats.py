@@ -0,0 +1,150 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2016 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Optional instrumentation of parsing and saving.
+
+A Stats object made active for the current thread with recording() collects
+the wall time of named phases and counters incremented along the way:
+
+    stats = Stats()
+    with recording(stats):
+        ...
+    stats.to_dict()
+
+When no Stats object is active, phase() and count() do nothing. Counters:
+
+  boxes_parsed: boxes loaded, at any depth.
+  bytes_read, bytes_written, reads, writes, seeks: file access through
+    handles wrapped with Stats.wrap, plus data copied by the kernel.
+  kernel_copy_bytes: data copied between files by the kernel.
+  chunk_offsets_rewritten: stco / co64 entries shifted when saved.
+  stco_promoted: stco boxes converted to co64.
+  bytes_uploaded, server_copy_bytes: output uploaded and copied within
+    object storage by storage.inject_metadata.
+"""
+
+import collections
+import contextlib
+import threading
+import time
+
+_local = threading.local()
+
+_NO_PHASE = contextlib.nullcontext()
+
+
+class Stats(object):
+    """Per-phase wall times and counters of one or more operations."""
+
+    def __init__(self):
+        self.timings = collections.OrderedDict()
+        self.counters = collections.Counter()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Adds the wall time of the block to the phase name.
+
+        Phases may be nested, the time of an inner phase is also counted in
+        the outer one.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] = (self.timings.get(name, 0.0) +
+                                  time.perf_counter() - start)
+
+    def count(self, name, amount=1):
+        self.counters[name] += amount
+
+    def merge(self, other):
+        """Adds the timings and counters of other."""
+        for name, seconds in other.timings.items():
+            self.timings[name] = self.timings.get(name, 0.0) + seconds
+        self.counters.update(other.counters)
+
+    def wrap(self, fh):
+        """Returns fh wrapped to count its reads, writes and seeks."""
+        return CountingFile(fh, self)
+
+    def to_dict(self):
+        return {"timings": dict(self.timings),
+                "counters": dict(self.counters)}
+
+
+class CountingFile(object):
+    """File handle counting the data read and written and seeks made."""
+
+    def __init__(self, fh, stats):
+        self.fh = fh
+        self.stats = stats
+
+    def read(self, size=-1):
+        data = self.fh.read(size)
+        self.stats.counters["reads"] += 1
+        self.stats.counters["bytes_read"] += len(data)
+        return data
+
+    def write(self, data):
+        self.stats.counters["writes"] += 1
+        self.stats.counters["bytes_written"] += len(data)
+        return self.fh.write(data)
+
+    def seek(self, offset, whence=0):
+        self.stats.counters["seeks"] += 1
+        return self.fh.seek(offset, whence)
+
+    def __getattr__(self, name):
+        return getattr(self.fh, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.fh.close()
+
+
+def active():
+    """Returns the Stats object recording on this thread, or None."""
+    return getattr(_local, "stats", None)
+
+
+@contextlib.contextmanager
+def recording(stats):
+    """Makes stats (if not None) the active Stats object of this thread."""
+    previous = active()
+    if stats is not None:
+        _local.stats = stats
+    try:
+        yield stats
+    finally:
+        _local.stats = previous
+
+
+def phase(name):
+    """Times the block as phase name of the active Stats, if any."""
+    stats = active()
+    if stats is None:
+        return _NO_PHASE
+    return stats.phase(name)
+
+
+def count(name, amount=1):
+    """Increments a counter of the active Stats, if any."""
+    stats = getattr(_local, "stats", None)
+    if stats is not None:
+        stats.counters[name] += amount
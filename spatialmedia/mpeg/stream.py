@@ -0,0 +1,318 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2016 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""MPEG4 stream processing.
+
+Rewrites the moov box of a file read from a non-seekable stream in a single
+forward pass. Only the boxes up to the first media box and the moov are held
+in memory, media data is passed through in chunks:
+
+  moov before the media: the boxes ahead of the first mdat / moof are
+    buffered, modified and written, everything after them moves by the
+    change in their size (fragment offsets are patched on the way).
+  moov after the media: the media does not move, so it is passed through
+    and the modified moov is written in place of the old one. For
+    faststart output the media is spooled instead and written after the
+    moov, moved by the size of the moov.
+
+A stream that is truncated or holds no moov box raises ValueError, possibly
+after part of the output has been yielded, which must then be discarded.
+"""
+
+import struct
+import tempfile
+
+from spatialmedia.mpeg import constants
+from spatialmedia.mpeg import container
+from spatialmedia.mpeg import fragment
+from spatialmedia.mpeg import mpeg4_container
+from spatialmedia.mpeg import reader
+
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+# Media spooled to move the moov ahead of it is kept in memory up to this
+# size, beyond it the spool is a temporary file.
+SPOOL_MEMORY_SIZE = 64 * 1024 * 1024
+
+# Top-level boxes passed through without being buffered.
+MEDIA_TAGS = frozenset([
+    constants.TAG_MDAT,
+    constants.TAG_MOOF,
+    ])
+
+
+class StreamReader(object):
+    """Forward only reader keeping track of the stream position."""
+
+    def __init__(self, fh):
+        self.fh = fh
+        self.position = 0
+
+    def read(self, size):
+        """Reads size bytes, fewer only at the end of the stream."""
+        chunks = []
+        remaining = size
+        while remaining > 0:
+            data = self.fh.read(remaining)
+            if not data:
+                break
+            chunks.append(data)
+            remaining -= len(data)
+        data = b"".join(chunks)
+        self.position += len(data)
+        return data
+
+    def read_header(self):
+        """Reads the header of the next box.
+
+        Returns:
+          (size, name, header_size, data) with the raw header data, or None
+          at the end of the stream. size is None for a box extending to the
+          end of the stream.
+
+        Raises:
+          ValueError: the header is truncated or invalid.
+        """
+        data = self.read(8)
+        if len(data) < 8:
+            if data:
+                raise ValueError("Error, truncated box header at %d" %
+                                 self.position)
+            return None
+        size, name = struct.unpack(">I4s", data)
+        header_size = 8
+        if size == 1:
+            data += self.read(8)
+            if len(data) < 16:
+                raise ValueError("Error, truncated box header at %d" %
+                                 self.position)
+            size = struct.unpack_from(">Q", data, 8)[0]
+            header_size = 16
+        if size == 0:
+            size = None
+        elif size < header_size:
+            raise ValueError("Error, invalid size %d in %r at %d" %
+                             (size, name, self.position - header_size))
+        return size, name, header_size, data
+
+    def chunks(self, size, chunk_size=STREAM_CHUNK_SIZE):
+        """Yields the next size bytes, or the rest if size is None.
+
+        Raises:
+          ValueError: the stream ends before size bytes.
+        """
+        while size is None or size > 0:
+            count = chunk_size if size is None else min(chunk_size, size)
+            data = self.read(count)
+            if not data:
+                if size is not None:
+                    raise ValueError("Error, stream ended %d bytes early." %
+                                     size)
+                return
+            if size is not None:
+                size -= len(data)
+            yield data
+
+
+def load_boxes(data, position):
+    """Loads the mpeg4 structure of boxes held in memory.
+
+    Args:
+      data: bytes, consecutive top-level boxes.
+      position: int, file position of data.
+
+    Returns:
+      mpeg4, the structure with a reader over data, or None on error.
+    """
+    buffer_reader = reader.BufferReader(data, position)
+    contents = container.load_multiple(buffer_reader, position,
+                                       position + len(data))
+    if not contents:
+        return None
+    return mpeg4_container.build(contents, buffer_reader)
+
+
+def save_boxes(mpeg4_file, delta):
+    """Returns the boxes of an mpeg4 structure saved with delta."""
+    return mpeg4_container.save_boxes(
+        mpeg4_file.contents, mpeg4_file.reader, delta).getvalue()
+
+
+def modify_boxes(data, position, modify, media_offset, padding=0):
+    """Loads buffered boxes holding a moov, modifies and saves them.
+
+    Args:
+      data: bytes, consecutive top-level boxes including the moov.
+      position: int, file position of data.
+      modify: function, called with the mpeg4 structure to change.
+      media_offset: int or None, amount of data written ahead of the media
+        by these boxes before they were modified: their size when they
+        precede the media, 0 when they are moved ahead of it. The offset
+        change for chunk offsets is their new size minus media_offset.
+        None when the boxes follow the media, which does not move.
+      padding: int, size of the free box left after a moov ahead of the
+        media when its free space cannot absorb the change in its size.
+
+    Returns:
+      (data, delta), the saved boxes and the offset change applied.
+
+    Raises:
+      ValueError: the boxes cannot be loaded or hold no moov.
+    """
+    mpeg4_file = load_boxes(data, position)
+    if mpeg4_file is None or mpeg4_file.moov_box is None:
+        raise ValueError("Error, failed to load moov box.")
+    modify(mpeg4_file)
+
+    mpeg4_file.resize()
+    if media_offset is None:
+        return save_boxes(mpeg4_file, 0), 0
+
+    mpeg4_file.reserve_padding(padding)
+
+    delta = mpeg4_file.content_size - media_offset
+    while mpeg4_file.promote_chunk_offsets(mpeg4_file.reader, delta):
+        mpeg4_file.resize()
+        delta = mpeg4_file.content_size - media_offset
+    return save_boxes(mpeg4_file, delta), delta
+
+
+def spooled_chunks(spool, chunk_size):
+    """Yields the contents of a spool file and closes it."""
+    spool.seek(0)
+    while True:
+        data = spool.read(chunk_size)
+        if not data:
+            break
+        yield data
+    spool.close()
+
+
+def save(fh, modify, chunk_size=STREAM_CHUNK_SIZE, faststart=False,
+         spool_size=SPOOL_MEMORY_SIZE, padding=0):
+    """Yields the contents of a stream with its moov box modified.
+
+    Args:
+      fh: file handle, input stream read once from its current position.
+      modify: function, called with the mpeg4 structure holding the moov
+        before it is written.
+      chunk_size: int, largest chunk of media data yielded at once.
+      faststart: bool, whether to move a moov found after the media ahead
+        of it. The media is spooled until the moov has been read.
+      spool_size: int, amount of spooled media held in memory before the
+        spool moves to a temporary file.
+      padding: int, size of the free box to leave after a moov written
+        ahead of the media, see Mpeg4Container.reserve_padding.
+
+    Yields:
+      bytes, consecutive chunks of the output.
+
+    Raises:
+      ValueError: the stream is truncated, malformed or holds no moov box.
+    """
+    stream = StreamReader(fh)
+
+    # Buffers the boxes up to the first media box.
+    prefix = []
+    moov_found = False
+    header = stream.read_header()
+    while (header is not None and header[0] is not None and
+           header[1] not in MEDIA_TAGS):
+        size, name, header_size, data = header
+        data += stream.read(size - header_size)
+        if len(data) < size:
+            raise ValueError("Error, truncated %r box." % name)
+        prefix.append(data)
+        moov_found = moov_found or name == constants.TAG_MOOV
+        header = stream.read_header()
+    prefix = b"".join(prefix)
+
+    delta = 0
+    if moov_found:
+        prefix, delta = modify_boxes(prefix, 0, modify, len(prefix),
+                                     padding)
+    if prefix:
+        yield prefix
+
+    spool = None
+    moved = False
+    if faststart and not moov_found:
+        spool = tempfile.SpooledTemporaryFile(max_size=spool_size)
+
+    def output(chunk):
+        if spool is None:
+            return [chunk]
+        spool.write(chunk)
+        return []
+
+    while header is not None:
+        size, name, header_size, data = header
+        if size is None:
+            # The last box extends to the end of the stream.
+            for chunk in output(data):
+                yield chunk
+            for data in stream.chunks(None, chunk_size):
+                for chunk in output(data):
+                    yield chunk
+            break
+
+        if name == constants.TAG_MOOV and not moov_found:
+            position = stream.position - header_size
+            data += stream.read(size - header_size)
+            if len(data) < size:
+                raise ValueError("Error, truncated moov box.")
+            data, _ = modify_boxes(data, position, modify,
+                                   0 if spool is not None else None,
+                                   padding)
+            moov_found = True
+            yield data
+            if spool is not None:
+                for chunk in spooled_chunks(spool, chunk_size):
+                    yield chunk
+                spool = None
+                moved = True
+        elif moved and name in MEDIA_TAGS:
+            print("Error, media data on both sides of the moov box, chunk "
+                  "offsets into", name, "at", stream.position - header_size,
+                  "are wrong.")
+            moved = False
+            yield data
+            for chunk in stream.chunks(size - header_size, chunk_size):
+                yield chunk
+        elif delta and fragment.is_supported_box_name(name):
+            content = bytearray(stream.read(size - header_size))
+            if len(content) < size - header_size:
+                raise ValueError("Error, truncated %r box." % name)
+            if name == constants.TAG_MOOF:
+                fragment.patch_moof(content, delta)
+            else:
+                fragment.patch_mfra(content, delta)
+            yield data
+            yield bytes(content)
+        else:
+            for chunk in output(data):
+                yield chunk
+            for data in stream.chunks(size - header_size, chunk_size):
+                for chunk in output(data):
+                    yield chunk
+        header = stream.read_header()
+
+    if spool is not None:
+        for chunk in spooled_chunks(spool, chunk_size):
+            yield chunk
+    if not moov_found:
+        raise ValueError("Error, stream does not contain moov box.")
@@ -25,6 +25,7 @@ import struct
 
 from spatialmedia.mpeg import box
 from spatialmedia.mpeg import constants
+from spatialmedia.mpeg import reader
 
 
 def is_supported_box_name(name):
@@ -48,31 +49,37 @@ def load(fh, position=None, end=None):
     if position is None:
         position = fh.tell()
 
-    fh.seek(position)
-    size = struct.unpack(">I", fh.read(4))[0]
-    name = fh.read(4)
+    header = box.read_header(fh, position)
+    if header is None:
+        print("Error: truncated SV3D sub-box.")
+        return None
+    size, name, header_size = header
 
     if name == constants.TAG_SVHD:
-        box = SVHDBox()
+        new_box = SVHDBox()
     elif name == constants.TAG_PRHD:
-        box = PRHDBox()
+        new_box = PRHDBox()
     elif name == constants.TAG_EQUI:
-        box = EQUIBox()
+        new_box = EQUIBox()
     elif name == constants.TAG_ST3D:
-        box = ST3DBox()
+        new_box = ST3DBox()
     else:
         print("Error: box is not a supported SV3D sub-box.")
         return None
 
-    box.position = position
-    box.content_size = size - box.header_size
-    box.load_content(fh)
-    return box
+    new_box.position = position
+    new_box.header_size = header_size
+    new_box.content_size = size - new_box.header_size
+    new_box.load_content(reader.read_at(fh, position + header_size,
+                                        new_box.content_size))
+    return new_box
 
 
 class SVHDBox(box.Box):
     """Spherical Video Header (svhd) FullBox; mandatory first child of sv3d per v2 RFC."""
 
+    __slots__ = ("metadata_source",)
+
     def __init__(self, metadata_source="Spherical Metadata Tool"):
         box.Box.__init__(self)
         self.name = constants.TAG_SVHD
@@ -94,19 +101,12 @@ class SVHDBox(box.Box):
         console("\t\t\t}")
 
     def save(self, in_fh, out_fh, delta):
-        if self.header_size == 16:
-            out_fh.write(struct.pack(">I", 1))
-            out_fh.write(struct.pack(">Q", self.size()))
-            out_fh.write(self.name)
-        elif self.header_size == 8:
-            out_fh.write(struct.pack(">I", self.size()))
-            out_fh.write(self.name)
-        out_fh.write(struct.pack(">I", 0))  # Version and flags
+        self.save_header(out_fh)
+        box.pack(out_fh, ">I", 0)  # Version and flags
         out_fh.write(self._metadata_source_bytes() + b"\0")
 
-    def load_content(self, in_fh):
-        in_fh.read(4)  # Version and flags
-        raw = in_fh.read(self.content_size - 4)
+    def load_content(self, data):
+        raw = bytes(data[4:self.content_size])  # Skip version and flags
         if raw.endswith(b"\0"):
             raw = raw[:-1]
         self.metadata_source = raw.decode("utf-8")
@@ -114,6 +114,8 @@ class SVHDBox(box.Box):
 
 
 class PRHDBox(box.Box):
+    __slots__ = ("pose_yaw_degrees", "pose_pitch_degrees", "pose_roll_degrees")
+
     def __init__(self):
         box.Box.__init__(self)
         self.name = constants.TAG_PRHD
@@ -141,26 +143,21 @@ class PRHDBox(box.Box):
                 (self.pose_yaw_degrees, self.pose_pitch_degrees, self.pose_roll_degrees))
 
     def save(self, in_fh, out_fh, delta):
-        if (self.header_size == 16):
-            out_fh.write(struct.pack(">I", 1))
-            out_fh.write(struct.pack(">Q", self.size()))
-            out_fh.write(self.name)
-        elif(self.header_size == 8):
-            out_fh.write(struct.pack(">I", self.size()))
-            out_fh.write(self.name)
-        out_fh.write(struct.pack(">I", 0)) # Version and flags
-        out_fh.write(struct.pack(">I", self.pose_yaw_degrees))
-        out_fh.write(struct.pack(">I", self.pose_pitch_degrees))
-        out_fh.write(struct.pack(">I", self.pose_roll_degrees))
-
-    def load_content(self, in_fh):
-        in_fh.read(4) # Version and flags
-        self.pose_yaw_degress = struct.unpack(">I", in_fh.read(4))[0]
-        self.pose_pitch_degrees = struct.unpack(">I", in_fh.read(4))[0]
-        self.pose_roll_degrees = struct.unpack(">I", in_fh.read(4))[0]
+        self.save_header(out_fh)
+        # Version and flags, then the pose.
+        box.pack(out_fh, ">IIII", 0, self.pose_yaw_degrees,
+                 self.pose_pitch_degrees, self.pose_roll_degrees)
+
+    def load_content(self, data):
+        # Skip version and flags
+        (self.pose_yaw_degrees,
+         self.pose_pitch_degrees,
+         self.pose_roll_degrees) = struct.unpack_from(">III", data, 4)
 
 
 class EQUIBox(box.Box):
+    __slots__ = ("bounds_top", "bounds_bottom", "bounds_left", "bounds_right")
+
     def __init__(self, bounds=None):
         box.Box.__init__(self)
         self.name = constants.TAG_EQUI
@@ -190,28 +187,22 @@ class EQUIBox(box.Box):
             % (self.bounds_top, self.bounds_bottom, self.bounds_left, self.bounds_right))
 
     def save(self, in_fh, out_fh, delta):
-        if (self.header_size == 16):
-            out_fh.write(struct.pack(">I", 1))
-            out_fh.write(struct.pack(">Q", self.size()))
-            out_fh.write(self.name)
-        elif(self.header_size == 8):
-            out_fh.write(struct.pack(">I", self.size()))
-            out_fh.write(self.name)
-        out_fh.write(struct.pack(">I", 0)) # Version and flags
-        out_fh.write(struct.pack(">I", self.bounds_top))
-        out_fh.write(struct.pack(">I", self.bounds_bottom))
-        out_fh.write(struct.pack(">I", self.bounds_left))
-        out_fh.write(struct.pack(">I", self.bounds_right))
-
-    def load_content(self, in_fh):
-        in_fh.read(4) # Version and flags
-        self.bounds_top = struct.unpack(">I", in_fh.read(4))[0]
-        self.bounds_bottom = struct.unpack(">I", in_fh.read(4))[0]
-        self.bounds_left = struct.unpack(">I", in_fh.read(4))[0]
-        self.bounds_right = struct.unpack(">I", in_fh.read(4))[0]
+        self.save_header(out_fh)
+        # Version and flags, then the bounds.
+        box.pack(out_fh, ">IIIII", 0, self.bounds_top, self.bounds_bottom,
+                 self.bounds_left, self.bounds_right)
+
+    def load_content(self, data):
+        # Skip version and flags
+        (self.bounds_top,
+         self.bounds_bottom,
+         self.bounds_left,
+         self.bounds_right) = struct.unpack_from(">IIII", data, 4)
 
 
 class ST3DBox(box.Box):
+    __slots__ = ("stereo_mode",)
+
     def __init__(self):
         box.Box.__init__(self)
         self.name = constants.TAG_ST3D
@@ -242,16 +233,10 @@ class ST3DBox(box.Box):
         return "Stereo Mode: %d" % self.stereo_mode
 
     def save(self, in_fh, out_fh, delta):
-        if (self.header_size == 16):
-            out_fh.write(struct.pack(">I", 1))
-            out_fh.write(struct.pack(">Q", self.size()))
-            out_fh.write(self.name)
-        elif(self.header_size == 8):
-            out_fh.write(struct.pack(">I", self.size()))
-            out_fh.write(self.name)
-        out_fh.write(struct.pack(">I", 0)) # Version and flags
-        out_fh.write(struct.pack(">B", self.stereo_mode))
-
-    def load_content(self, in_fh):
-        in_fh.read(4) # Version and flags
-        self.stereo_mode = int(struct.unpack(">B", in_fh.read(1))[0])
+        self.save_header(out_fh)
+        # Version and flags, then the stereo mode.
+        box.pack(out_fh, ">IB", 0, self.stereo_mode)
+
+    def load_content(self, data):
+        # Skip version and flags
+        self.stereo_mode = struct.unpack_from(">B", data, 4)[0]
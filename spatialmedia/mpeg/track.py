@@ -0,0 +1,266 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2016 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""MPEG4 track index.
+
+Locates the boxes of every trak of a moov once, so that adding and reading
+metadata does not walk moov -> trak -> mdia -> minf -> stbl -> stsd and read
+the handler type again for each kind of metadata.
+"""
+
+import io
+import struct
+
+from spatialmedia.mpeg import constants
+from spatialmedia.mpeg import container
+from spatialmedia.mpeg import reader
+
+
+class Track(object):
+    """Boxes and properties of a trak.
+
+    The boxes located and the values read when indexing are kept, the
+    properties listing metadata boxes (uuid, sv3d, st3d, SA3D) are looked up
+    in memory when accessed, so they reflect metadata added since.
+
+    Attributes:
+      trak: container, the trak box.
+      track_id: int or None, track_ID of the tkhd box.
+      handler_type: bytes or None, handler type of the hdlr box, e.g.
+        constants.TAG_VIDE or constants.TAG_SOUN.
+      mdia: container or None, the mdia box.
+      stsd: container or None, the stsd box.
+      sample_descriptions: list of boxes, the children of stsd.
+      codec: bytes or None, name of the first sample description.
+      num_audio_channels: int, channel count of the audio, -1 if the track
+        has no sound sample description.
+    """
+
+    __slots__ = ("trak", "track_id", "handler_type", "mdia", "stsd",
+                 "sample_descriptions", "codec", "num_audio_channels")
+
+    def __init__(self, trak, in_fh):
+        self.trak = trak
+        self.track_id = None
+        self.handler_type = None
+        self.mdia = None
+        self.stsd = None
+        self.sample_descriptions = list()
+        self.codec = None
+        self.num_audio_channels = -1
+
+        for element in trak.contents:
+            if element.name == constants.TAG_TKHD:
+                self.track_id = read_track_id(element, in_fh)
+            elif element.name == constants.TAG_MDIA and self.mdia is None:
+                self.mdia = element
+
+        if self.mdia is None:
+            return
+        for element in self.mdia.contents:
+            if element.name == constants.TAG_HDLR:
+                self.handler_type = bytes(reader.read_at(
+                    in_fh, element.content_start() + 8, 4))
+            elif element.name == constants.TAG_MINF:
+                self.stsd = find_stsd(element)
+        if self.stsd is not None:
+            self.sample_descriptions = list(self.stsd.contents)
+        if self.sample_descriptions:
+            self.codec = self.sample_descriptions[0].name
+        if self.sound_sample_descriptions():
+            self.num_audio_channels = get_num_audio_channels(self.stsd, in_fh)
+
+    def is_video(self):
+        return self.handler_type == constants.TAG_VIDE
+
+    def is_audio(self):
+        return self.handler_type == constants.TAG_SOUN
+
+    def video_sample_descriptions(self):
+        return [element for element in self.sample_descriptions
+                if element.name in constants.VIDEO_SAMPLE_DESCRIPTIONS]
+
+    def sound_sample_descriptions(self):
+        return [element for element in self.sample_descriptions
+                if element.name in constants.SOUND_SAMPLE_DESCRIPTIONS]
+
+    def sample_description_children(self, name):
+        """Returns the children called name of all sample descriptions."""
+        return [child
+                for sample_description in self.sample_descriptions
+                if isinstance(sample_description, container.Container)
+                for child in sample_description.contents
+                if child.name == name]
+
+    @property
+    def sv3d(self):
+        return self.sample_description_children(constants.TAG_SV3D)
+
+    @property
+    def st3d(self):
+        return self.sample_description_children(constants.TAG_ST3D)
+
+    @property
+    def sa3d(self):
+        return self.sample_description_children(constants.TAG_SA3D)
+
+    @property
+    def uuid(self):
+        return [element for element in self.trak.contents
+                if element.name == constants.TAG_UUID]
+
+
+def index_tracks(moov_box, in_fh):
+    """Returns a Track for every trak of a moov box, in file order.
+
+    Args:
+      moov_box: container, the moov box.
+      in_fh: file handle, source for uncached contents of the moov.
+    """
+    return [Track(element, in_fh) for element in moov_box.contents
+            if element.name == constants.TAG_TRAK]
+
+
+def find_stsd(minf):
+    """Returns the stsd box of a minf box, or None."""
+    for element in minf.contents:
+        if element.name != constants.TAG_STBL:
+            continue
+        for stbl_element in element.contents:
+            if stbl_element.name == constants.TAG_STSD:
+                return stbl_element
+    return None
+
+
+def read_track_id(tkhd, in_fh):
+    """Returns the track_ID of a tkhd box, None if it is truncated."""
+    # Version, flags and creation and modification times, 32 bit in
+    # version 0 and 64 bit in version 1.
+    data = reader.read_at(in_fh, tkhd.content_start(), 24)
+    if len(data) < 4:
+        return None
+    offset = 20 if data[0] == 1 else 12
+    if len(data) < offset + 4:
+        return None
+    return struct.unpack_from(">I", data, offset)[0]
+
+
+def get_descriptor_length(in_fh):
+    """Derives the length of the MP4 elementary stream descriptor at the
+       current position in the input file.
+    """
+    descriptor_length = 0
+    for i in range(4):
+        size_byte = struct.unpack(">c", in_fh.read(1))[0]
+        descriptor_length = (descriptor_length << 7 |
+                             ord(size_byte) & int("0x7f", 0))
+        if (ord(size_byte) != int("0x80", 0)):
+            break
+    return descriptor_length
+
+
+def get_num_audio_channels(stsd, in_fh):
+    if stsd.name != constants.TAG_STSD:
+        print("get_num_audio_channels should be given a STSD box")
+        return -1
+    for sample_description in stsd.contents:
+        if sample_description.name == constants.TAG_MP4A:
+            return get_aac_num_channels(sample_description, in_fh)
+        elif sample_description.name in constants.SOUND_SAMPLE_DESCRIPTIONS:
+            return get_sample_description_num_channels(sample_description, in_fh)
+    return -1
+
+def get_sample_description_num_channels(sample_description, in_fh):
+    """Reads the number of audio channels from a sound sample description.
+    """
+    p = in_fh.tell()
+    data = reader.read_at(
+        in_fh, sample_description.content_start() + 8, 36)
+
+    # Fields: version, revision level and vendor, followed by either
+    # (version 0 and 1) num_audio_channels and sample_size_bytes, or
+    # (version 2) always_3, always_16, always_minus_2, always_0,
+    # always_65536, size_of_struct_only, audio_sample_rate and
+    # num_audio_channels.
+    version = struct.unpack_from(">h", data)[0]
+    if version == 0 or version == 1:
+        num_audio_channels = struct.unpack_from(">h", data, 8)[0]
+    elif version == 2:
+        num_audio_channels = struct.unpack_from(">i", data, 32)[0]
+    else:
+        print("Unsupported version for " + sample_description.name + " box")
+        return -1
+
+    in_fh.seek(p)
+    return num_audio_channels
+
+def get_aac_num_channels(box, in_fh):
+    """Reads the number of audio channels from AAC's AudioSpecificConfig
+       descriptor within the esds child box of the input mp4a or wave box.
+    """
+    p = in_fh.tell()
+    if box.name not in [constants.TAG_MP4A, constants.TAG_WAVE]:
+        return -1
+
+    for element in box.contents:
+        if element.name == constants.TAG_WAVE:
+            # Handle .mov with AAC audio, where the structure is:
+            #     stsd -> mp4a -> wave -> esds
+            channel_configuration = get_aac_num_channels(element, in_fh)
+            break
+
+        if element.name != constants.TAG_ESDS:
+          continue
+        # Parse the descriptors from a single read of the esds contents.
+        esds_fh = io.BytesIO(reader.read_at(
+            in_fh, element.content_start(), element.content_size))
+        esds_fh.seek(4)
+        descriptor_tag = struct.unpack(">c", esds_fh.read(1))[0]
+
+        # Verify the read descriptor is an elementary stream descriptor
+        if ord(descriptor_tag) != 3:  # Not an MP4 elementary stream.
+            print("Error: failed to read elementary stream descriptor.")
+            return -1
+        get_descriptor_length(esds_fh)
+        esds_fh.seek(3, 1)  # Seek to the decoder configuration descriptor
+        config_descriptor_tag = struct.unpack(">c", esds_fh.read(1))[0]
+
+        # Verify the read descriptor is a decoder config. descriptor.
+        if ord(config_descriptor_tag) != 4:
+            print("Error: failed to read decoder config. descriptor.")
+            return -1
+        get_descriptor_length(esds_fh)
+        esds_fh.seek(13, 1) # offset to the decoder specific config descriptor.
+        decoder_specific_descriptor_tag = struct.unpack(">c", esds_fh.read(1))[0]
+
+        # Verify the read descriptor is a decoder specific info descriptor
+        if ord(decoder_specific_descriptor_tag) != 5:
+            print("Error: failed to read MP4 audio decoder specific config.")
+            return -1
+        audio_specific_descriptor_size = get_descriptor_length(esds_fh)
+        assert audio_specific_descriptor_size >= 2
+        decoder_descriptor = struct.unpack(">h", esds_fh.read(2))[0]
+        object_type = (int("F800", 16) & decoder_descriptor) >> 11
+        sampling_frequency_index = (int("0780", 16) & decoder_descriptor) >> 7
+        if sampling_frequency_index == 0:
+            # TODO: If the sample rate is 96kHz an additional 24 bit offset
+            # value here specifies the actual sample rate.
+            print("Error: Greater than 48khz audio is currently not supported.")
+            return -1
+        channel_configuration = (int("0078", 16) & decoder_descriptor) >> 3
+    in_fh.seek(p)
+    return channel_configuration
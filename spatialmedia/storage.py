@@ -0,0 +1,484 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2016 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Spatial media metadata injection for files in object storage.
+
+Injecting into a copy of an object reads only the box headers and the moov
+of the source, with ranged reads. The output is written as a multipart
+upload whose media data parts are copied server side from the source
+(UploadPartCopy), so only the new moov is transferred:
+
+    s3 = storage.S3Storage("masters")
+    storage.inject_metadata(s3, "in.mp4", "out.mp4", metadata, print)
+
+Every read and copy of the source is made on the condition that it still is
+the version whose moov was read (its ETag), so an object overwritten during
+the injection makes it fail instead of mixing the old moov with new media.
+
+Backends subclass Storage and implement its abstract methods. LocalStorage
+keeps the objects in a local directory and enforces the part size rules of
+S3, as a stand-in for tests and development.
+"""
+
+import abc
+import hashlib
+import os
+import shutil
+import tempfile
+
+from spatialmedia import metadata_utils
+from spatialmedia import mpeg
+from spatialmedia.mpeg.mpeg4_container import Segment
+
+try:
+    import boto3
+except ImportError:
+    boto3 = None
+
+# Smallest size of the parts of a multipart upload, except for the last.
+MIN_PART_SIZE = 5 * 1024 * 1024
+
+# Largest size of a part, uploaded or copied.
+MAX_PART_SIZE = 5 * 1024 * 1024 * 1024
+
+# Smallest ranged read made by ObjectFile.
+READ_BLOCK_SIZE = 64 * 1024
+
+# Size of the blocks LocalStorage copies files with.
+COPY_BLOCK_SIZE = 1024 * 1024
+
+
+class ChangedError(Exception):
+    """An object is no longer the version it was expected to be."""
+
+
+class Storage(abc.ABC):
+    """Interface of an object store.
+
+    Objects are named by keys and their versions identified by ETags. Reads
+    and copies given a version raise ChangedError if the object is no longer
+    that version. Multipart uploads are identified by the value returned by
+    create_upload and completed with the values returned for each of their
+    parts. Backends implement every abstract method.
+    """
+
+    # Smallest size of the parts of an upload, except for the last.
+    min_part_size = MIN_PART_SIZE
+
+    @abc.abstractmethod
+    def head(self, key):
+        """Returns the size and ETag of an object."""
+
+    def size(self, key):
+        """Returns the size of an object."""
+        return self.head(key)[0]
+
+    @abc.abstractmethod
+    def read(self, key, start, stop, version=None):
+        """Returns bytes [start, stop) of an object."""
+
+    @abc.abstractmethod
+    def create_upload(self, key):
+        """Starts a multipart upload of key and returns its id."""
+
+    @abc.abstractmethod
+    def upload_part(self, key, upload, number, data):
+        """Uploads data as part number (from 1) of an upload."""
+
+    @abc.abstractmethod
+    def upload_part_copy(self, key, upload, number, source_key, start, stop,
+                         version=None):
+        """Copies bytes [start, stop) of source_key as part number."""
+
+    @abc.abstractmethod
+    def complete_upload(self, key, upload, parts):
+        """Completes an upload from the results of its parts, in order."""
+
+    @abc.abstractmethod
+    def abort_upload(self, key, upload):
+        """Discards an upload and the parts uploaded so far."""
+
+
+class S3Storage(Storage):
+    """Objects of an S3 (or S3 compatible) bucket."""
+
+    def __init__(self, bucket, client=None):
+        """Args:
+          bucket: string, name of the bucket.
+          client: boto3 S3 client or None to create one, which requires
+            boto3.
+        """
+        if client is None:
+            if boto3 is None:
+                raise ImportError("S3Storage requires boto3 or a client")
+            client = boto3.client("s3")
+        self.bucket = bucket
+        self.client = client
+
+    def head(self, key):
+        response = self.client.head_object(Bucket=self.bucket, Key=key)
+        return response["ContentLength"], response["ETag"]
+
+    def read(self, key, start, stop, version=None):
+        arguments = {}
+        if version is not None:
+            arguments["IfMatch"] = version
+        try:
+            response = self.client.get_object(
+                Bucket=self.bucket, Key=key,
+                Range="bytes=%d-%d" % (start, stop - 1), **arguments)
+        except Exception as e:
+            if precondition_failed(e):
+                raise ChangedError(key) from e
+            raise
+        return response["Body"].read()
+
+    def create_upload(self, key):
+        response = self.client.create_multipart_upload(
+            Bucket=self.bucket, Key=key)
+        return response["UploadId"]
+
+    def upload_part(self, key, upload, number, data):
+        response = self.client.upload_part(
+            Bucket=self.bucket, Key=key, UploadId=upload, PartNumber=number,
+            Body=bytes(data))
+        return response["ETag"]
+
+    def upload_part_copy(self, key, upload, number, source_key, start, stop,
+                         version=None):
+        arguments = {}
+        if version is not None:
+            arguments["CopySourceIfMatch"] = version
+        try:
+            response = self.client.upload_part_copy(
+                Bucket=self.bucket, Key=key, UploadId=upload,
+                PartNumber=number,
+                CopySource={"Bucket": self.bucket, "Key": source_key},
+                CopySourceRange="bytes=%d-%d" % (start, stop - 1),
+                **arguments)
+        except Exception as e:
+            if precondition_failed(e):
+                raise ChangedError(source_key) from e
+            raise
+        return response["CopyPartResult"]["ETag"]
+
+    def complete_upload(self, key, upload, parts):
+        self.client.complete_multipart_upload(
+            Bucket=self.bucket, Key=key, UploadId=upload,
+            MultipartUpload={"Parts": [
+                {"ETag": etag, "PartNumber": number}
+                for number, etag in enumerate(parts, 1)]})
+
+    def abort_upload(self, key, upload):
+        self.client.abort_multipart_upload(
+            Bucket=self.bucket, Key=key, UploadId=upload)
+
+
+def precondition_failed(error):
+    """Returns whether a boto3 client error is a failed If-Match."""
+    response = getattr(error, "response", None) or {}
+    return (response.get("Error", {}).get("Code") == "PreconditionFailed" or
+            response.get("ResponseMetadata", {}).get("HTTPStatusCode") == 412)
+
+
+class LocalStorage(Storage):
+    """Objects stored as files in a directory.
+
+    Uploads follow the rules of S3: completing one with a part other than
+    the last smaller than min_part_size fails. ETags are made of the size
+    and modification time of the files.
+    """
+
+    def __init__(self, directory, min_part_size=MIN_PART_SIZE):
+        self.directory = directory
+        self.min_part_size = min_part_size
+
+    def path(self, key):
+        return os.path.join(self.directory, key)
+
+    def head(self, key):
+        stat = os.stat(self.path(key))
+        return stat.st_size, "%x-%x" % (stat.st_size, stat.st_mtime_ns)
+
+    def check_version(self, key, version):
+        if version is not None and self.head(key)[1] != version:
+            raise ChangedError(key)
+
+    def read(self, key, start, stop, version=None):
+        self.check_version(key, version)
+        with open(self.path(key), "rb") as fh:
+            fh.seek(start)
+            return fh.read(stop - start)
+
+    def create_upload(self, key):
+        return tempfile.mkdtemp(prefix=".upload-", dir=self.directory)
+
+    def upload_part(self, key, upload, number, data):
+        with open(os.path.join(upload, "%05d" % number), "wb") as fh:
+            fh.write(data)
+        return hashlib.md5(data).hexdigest()
+
+    def upload_part_copy(self, key, upload, number, source_key, start, stop,
+                         version=None):
+        self.check_version(source_key, version)
+        if stop > self.size(source_key):
+            raise ValueError("Invalid range %d-%d of %s" %
+                             (start, stop - 1, source_key))
+        digest = hashlib.md5()
+        with open(self.path(source_key), "rb") as in_fh, \
+                open(os.path.join(upload, "%05d" % number), "wb") as out_fh:
+            in_fh.seek(start)
+            size = stop - start
+            while size > 0:
+                data = in_fh.read(min(size, COPY_BLOCK_SIZE))
+                digest.update(data)
+                out_fh.write(data)
+                size -= len(data)
+        return digest.hexdigest()
+
+    def complete_upload(self, key, upload, parts):
+        names = sorted(os.listdir(upload))
+        if len(names) != len(parts):
+            raise ValueError("Upload of %s has %d parts, not %d" %
+                             (key, len(names), len(parts)))
+        for name in names[:-1]:
+            if os.path.getsize(os.path.join(upload, name)) < self.min_part_size:
+                raise ValueError("Part %d of %s is too small" %
+                                 (int(name), key))
+
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        partial_path = os.path.join(upload, "complete")
+        with open(partial_path, "wb") as out_fh:
+            for name in names:
+                with open(os.path.join(upload, name), "rb") as in_fh:
+                    shutil.copyfileobj(in_fh, out_fh, COPY_BLOCK_SIZE)
+        os.replace(partial_path, path)
+        shutil.rmtree(upload)
+
+    def abort_upload(self, key, upload):
+        shutil.rmtree(upload, ignore_errors=True)
+
+
+class ObjectFile(object):
+    """Read only file handle over an object, read with ranged reads.
+
+    Reads are at least READ_BLOCK_SIZE long and the last block read is
+    kept, so the headers of neighbouring boxes come from a single request.
+    All reads are of the version of the object current when it was opened
+    (ChangedError is raised otherwise).
+    """
+
+    def __init__(self, storage, key):
+        self.storage = storage
+        self.key = key
+        self.length, self.version = storage.head(key)
+        self.position = 0
+        self.block = b""
+        self.block_start = 0
+
+    def read(self, size=-1):
+        remaining = max(self.length - self.position, 0)
+        if size is None or size < 0 or size > remaining:
+            size = remaining
+        if size == 0:
+            return b""
+        start = self.position - self.block_start
+        if start < 0 or start + size > len(self.block):
+            stop = min(self.position + max(size, READ_BLOCK_SIZE), self.length)
+            self.block = self.storage.read(self.key, self.position, stop,
+                                           self.version)
+            self.block_start = self.position
+            start = 0
+        data = bytes(self.block[start:start + size])
+        self.position += len(data)
+        return data
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.position
+        elif whence == 2:
+            offset += self.length
+        self.position = offset
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def seekable(self):
+        return True
+
+    def readable(self):
+        return True
+
+    def close(self):
+        self.block = b""
+
+
+def plan_parts(segments, min_part_size=MIN_PART_SIZE,
+               max_part_size=MAX_PART_SIZE):
+    """Splits the segments of an output into the parts of an upload.
+
+    Ranges of the source of at least min_part_size are copied server side,
+    split into parts of at most max_part_size. New data is uploaded,
+    completed with the start of the following range (or the whole range if
+    it is too short to be copied) up to min_part_size.
+
+    Args:
+      segments: list of Segment, the output (see Mpeg4Container.segments).
+      min_part_size: int, smallest size of all parts but the last.
+      max_part_size: int, largest size of a copied part.
+
+    Returns:
+      List of parts, each a list of Segment. Parts made of a single range
+      of the source are copied, the others are uploaded.
+    """
+    parts = []
+    current = []
+    current_size = 0
+    for segment in segments:
+        if segment.data is not None:
+            current.append(segment)
+            current_size += segment.size
+        else:
+            position, size = segment.position, segment.size
+            if current and current_size < min_part_size:
+                count = min(size, min_part_size - current_size)
+                current.append(Segment(None, position, count))
+                current_size += count
+                position += count
+                size -= count
+            if size >= min_part_size:
+                if current:
+                    parts.append(current)
+                    current = []
+                    current_size = 0
+                count = -(-size // max_part_size)
+                for index in range(count):
+                    start = size * index // count
+                    stop = size * (index + 1) // count
+                    parts.append([Segment(None, position + start,
+                                          stop - start)])
+                continue
+            if size > 0:
+                current.append(Segment(None, position, size))
+                current_size += size
+        if current_size >= min_part_size:
+            parts.append(current)
+            current = []
+            current_size = 0
+    if current:
+        parts.append(current)
+    return parts
+
+
+def upload_segments(storage, key, segments, source_key, version=None):
+    """Writes an output described by segments as a multipart upload.
+
+    The upload is aborted if any part fails, including when source_key is
+    no longer version.
+
+    Args:
+      storage: Storage, where source_key is and key is written.
+      key: string, object to write.
+      segments: list of Segment, the output, ranges referring to source_key.
+      source_key: string, object the ranges of segments are copied from.
+      version: string or None, ETag source_key must still have.
+    """
+    upload = storage.create_upload(key)
+    try:
+        results = []
+        for number, part in enumerate(
+                plan_parts(segments, storage.min_part_size), 1):
+            if len(part) == 1 and part[0].data is None:
+                segment = part[0]
+                results.append(storage.upload_part_copy(
+                    key, upload, number, source_key, segment.position,
+                    segment.position + segment.size, version))
+                mpeg.stats.count("server_copy_bytes", segment.size)
+                continue
+            data = []
+            for segment in part:
+                if segment.data is None:
+                    segment = segment._replace(data=storage.read(
+                        source_key, segment.position,
+                        segment.position + segment.size, version))
+                    mpeg.stats.count("bytes_read", segment.size)
+                data.append(segment.data)
+            data = b"".join(data)
+            results.append(storage.upload_part(key, upload, number, data))
+            mpeg.stats.count("bytes_uploaded", len(data))
+        storage.complete_upload(key, upload, results)
+    except BaseException:
+        storage.abort_upload(key, upload)
+        raise
+
+
+def inject_metadata(storage, src, dest, metadata, console, faststart=False,
+                    padding=0, stats=None):
+    """Injects metadata into a copy of an object.
+
+    Args:
+      storage: Storage, holding src and where dest is written.
+      src: string, key of the object to read.
+      dest: string, key of the object to write.
+      metadata: Metadata, video and audio metadata to inject.
+      console: function, output callback for progress and errors.
+      faststart: bool, whether to move the moov ahead of the media data.
+      padding: int, size of the free box to leave after the moov, see
+        metadata_utils.inject_metadata.
+      stats: mpeg.Stats or None, collects timings and counters, including
+        bytes_uploaded and server_copy_bytes.
+
+    Returns:
+      String describing an error with the arguments, None otherwise (errors
+      processing the object are reported to console), as
+      metadata_utils.inject_metadata.
+    """
+    if src == dest:
+        return "Input and output cannot be the same"
+
+    extension = os.path.splitext(src)[1].lower()
+    if extension not in metadata_utils.MPEG_FILE_EXTENSIONS:
+        console("Unknown file type")
+        return None
+
+    try:
+        object_fh = ObjectFile(storage, src)
+    except Exception:
+        console("Error: " + src +
+                " does not exist or we do not have permission")
+        return None
+
+    console("Processing: " + src)
+    in_fh = object_fh
+    try:
+        with mpeg.stats.recording(stats):
+            if stats is not None:
+                in_fh = stats.wrap(in_fh)
+            mpeg4_file = metadata_utils.load_injected_mpeg4(
+                in_fh, src, metadata, console, None, faststart, padding)
+            if mpeg4_file is None:
+                return None
+
+            with mpeg.stats.phase("save"):
+                segments = mpeg4_file.segments(mpeg4_file.reader)
+                upload_segments(storage, dest, segments, src,
+                                object_fh.version)
+    except ChangedError:
+        console("Error: " + src + " changed during injection")
+    return None
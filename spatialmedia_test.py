@@ -7,11 +7,32 @@ ffmpeg -y -f lavfi -i testsrc -vf scale=320:240 -vcodec libvpx-vp9 -t 0.05 data/
 ffmpeg -y -f lavfi -i testsrc -vf scale=32:24 -vcodec prores -t 0.05 data/testsrc_32x24_prores.mov
 
 """
+import asyncio
+import contextlib
+import io
+import json
+import mmap
 import unittest
 import os
+import pickle
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+from wsgiref.util import FileWrapper
 
 from spatialmedia.__main__ import main
+from spatialmedia import aio
+from spatialmedia import cache
 from spatialmedia import metadata_utils
+from spatialmedia import mpeg
+from spatialmedia import storage
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                'docker'))
+import jobs
+import virtual
 
 _OUTPUT_DIR = 'test_output'
 
@@ -151,6 +172,1541 @@ class TestAdd(unittest.TestCase):
         self.assertTrue(contents.find('Stereo Mode: 1') >= 0)
 
 
+class TempDirTestCase(unittest.TestCase):
+    """Test case with a temporary directory, self.temp_dir."""
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+
+
+class TestInjectInPlace(TempDirTestCase):
+
+    def relayout(self, name, padding=None):
+        """Saves a copy of a test input with moov (and padding) before mdat."""
+        path = os.path.join(self.temp_dir, name)
+        with open(os.path.join('data', name), 'rb') as in_fh:
+            mpeg4_file = mpeg.load(in_fh)
+            contents = [mpeg4_file.ftyp_box, mpeg4_file.moov_box]
+            if padding:
+                free_box = mpeg.Box()
+                free_box.name = mpeg.constants.TAG_FREE
+                free_box.header_size = 8
+                free_box.contents = bytes(padding)
+                free_box.content_size = padding
+                contents.append(free_box)
+            contents.append(mpeg4_file.first_mdat_box)
+            mpeg4_file.contents = contents
+            with open(path, 'wb') as out_fh:
+                mpeg4_file.save(in_fh, out_fh)
+        return path
+
+    def read_mdat(self, path):
+        with open(path, 'rb') as fh:
+            mdat_box = mpeg.load(fh).first_mdat_box
+            fh.seek(mdat_box.position)
+            return mdat_box.position, fh.read(mdat_box.size())
+
+    def inject_in_place(self, path):
+        self.assertIsNone(main(['-i', '--in-place',
+                                '--v2', '--projection', 'equirectangular',
+                                path]))
+        contents = []
+        metadata_utils.parse_metadata(path, contents.append)
+        return '\n'.join(contents)
+
+    def test_moov_after_mdat(self):
+        path = os.path.join(self.temp_dir, 'testsrc_320x240_h264.mp4')
+        shutil.copyfile('data/testsrc_320x240_h264.mp4', path)
+        mdat = self.read_mdat(path)
+
+        contents = self.inject_in_place(path)
+        self.assertTrue(contents.find('SV3D') >= 0)
+        self.assertEqual(self.read_mdat(path), mdat)
+
+    def test_moov_before_mdat_uses_free_space(self):
+        path = self.relayout('testsrc_320x240_h264.mp4', padding=1024)
+        size = os.path.getsize(path)
+        mdat = self.read_mdat(path)
+
+        contents = self.inject_in_place(path)
+        self.assertTrue(contents.find('SV3D') >= 0)
+        self.assertEqual(self.read_mdat(path), mdat)
+        self.assertEqual(os.path.getsize(path), size)
+
+    def test_moov_before_mdat_without_free_space(self):
+        path = self.relayout('testsrc_320x240_h264.mp4')
+        mdat = self.read_mdat(path)
+
+        contents = self.inject_in_place(path)
+        self.assertTrue(contents.find('SV3D') >= 0)
+        self.assertEqual(self.read_mdat(path), mdat)
+        with open(path, 'rb') as fh:
+            names = [box.name for box in mpeg.load(fh).contents]
+        self.assertEqual(names, [b'ftyp', b'free', b'mdat', b'moov'])
+
+    def test_mdat_extending_to_end_of_file(self):
+        path = self.relayout('testsrc_320x240_h264.mp4')
+        position, mdat = self.read_mdat(path)
+        with open(path, 'r+b') as fh:
+            fh.seek(position)
+            fh.write(struct.pack('>I', 0))
+
+        metadata = metadata_utils.Metadata()
+        metadata.video = metadata_utils.generate_spherical_xml()
+        metadata_utils.inject_metadata_in_place(path, metadata,
+                                                lambda x: None)
+        self.assertEqual(self.read_mdat(path), (position, mdat))
+        with open(path, 'rb') as fh:
+            mpeg4_file = mpeg.load(fh)
+            self.assertIsNotNone(mpeg4_file)
+            names = [box.name for box in mpeg4_file.contents]
+        self.assertEqual(names, [b'ftyp', b'free', b'mdat', b'moov'])
+
+    def test_failed_metadata_leaves_file_unchanged(self):
+        # Without a video handler there is no track to add v2 metadata to.
+        with open('data/testsrc_320x240_h264.mp4', 'rb') as fh:
+            original = fh.read().replace(b'vide', b'none')
+        path = os.path.join(self.temp_dir, 'testsrc_320x240_h264.mp4')
+        with open(path, 'wb') as fh:
+            fh.write(original)
+
+        metadata = metadata_utils.Metadata('equirectangular')
+        log = []
+        metadata_utils.inject_metadata_in_place(path, metadata, log.append)
+        self.assertIn('Error, file left unchanged', log)
+        with open(path, 'rb') as fh:
+            self.assertEqual(fh.read(), original)
+
+
+class TestChunkOffsets(unittest.TestCase):
+
+    def setUp(self):
+        self.numpy = mpeg.box.numpy
+
+    def tearDown(self):
+        mpeg.box.numpy = self.numpy
+
+    def backends(self):
+        backends = [None]
+        if self.numpy is not None:
+            backends.append(self.numpy)
+        return backends
+
+    def index_box(self, name, mode, offsets):
+        index_box = mpeg.Box()
+        index_box.name = name
+        index_box.header_size = 8
+        index_box.contents = (struct.pack(">II", 0, len(offsets)) +
+                              struct.pack(">%d%s" % (len(offsets), mode),
+                                          *offsets))
+        index_box.content_size = len(index_box.contents)
+        return index_box
+
+    def test_stco_copy(self):
+        offsets = [48, 96, 1000, 0xFFFFFF00]
+        for backend in self.backends():
+            mpeg.box.numpy = backend
+            for delta in [0, 16, -48]:
+                out_fh = io.BytesIO()
+                mpeg.box.stco_copy(
+                    None, out_fh, self.index_box(b"stco", "I", offsets), delta)
+                self.assertEqual(
+                    out_fh.getvalue()[8:],
+                    struct.pack(">4I", *[o + delta for o in offsets]))
+
+    def test_co64_copy(self):
+        offsets = [0x100000000, 0x7FFFFFFFFFFF, 12]
+        for backend in self.backends():
+            mpeg.box.numpy = backend
+            out_fh = io.BytesIO()
+            mpeg.box.co64_copy(
+                None, out_fh, self.index_box(b"co64", "Q", offsets), 12)
+            self.assertEqual(out_fh.getvalue()[8:],
+                             struct.pack(">3Q", *[o + 12 for o in offsets]))
+
+    def test_promote_stco(self):
+        offsets = [8, 0xFFFFFF00]
+        for backend in self.backends():
+            mpeg.box.numpy = backend
+            stco_box = self.index_box(b"stco", "I", offsets)
+            self.assertFalse(mpeg.box.promote_stco(None, stco_box, 0xFF))
+            self.assertEqual(stco_box.name, b"stco")
+
+            self.assertTrue(mpeg.box.promote_stco(None, stco_box, 0x100))
+            self.assertEqual(stco_box.name, b"co64")
+            self.assertEqual(stco_box.content_size, 8 + 2 * 8)
+            out_fh = io.BytesIO()
+            stco_box.save(io.BytesIO(), out_fh, 0x100)
+            self.assertEqual(out_fh.getvalue()[:8],
+                             struct.pack(">I4s", 32, b"co64"))
+            self.assertEqual(out_fh.getvalue()[16:],
+                             struct.pack(">2Q", 0x108, 0x100000000))
+
+
+class TestTagCopy(TempDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.source = os.path.join(self.temp_dir, 'source')
+        with open(self.source, 'wb') as fh:
+            fh.write(os.urandom(3 * 1024 * 1024 + 17))
+        self.copy_range = mpeg.box.copy_range
+
+    def tearDown(self):
+        mpeg.box.copy_range = self.copy_range
+
+    def copy(self, out_fh, offset, size):
+        with open(self.source, 'rb') as in_fh:
+            out_fh.write(b'head')
+            in_fh.seek(offset)
+            mpeg.box.tag_copy(in_fh, out_fh, size)
+            self.assertEqual(in_fh.tell(), offset + size)
+            out_fh.write(b'tail')
+        with open(self.source, 'rb') as in_fh:
+            return b'head' + in_fh.read()[offset:offset + size] + b'tail'
+
+    def test_file_to_file(self):
+        path = os.path.join(self.temp_dir, 'output')
+        with open(path, 'wb') as out_fh:
+            expected = self.copy(out_fh, 5, 2 * 1024 * 1024 + 3)
+        with open(path, 'rb') as fh:
+            self.assertEqual(fh.read(), expected)
+
+    def test_file_to_file_with_sendfile(self):
+        mpeg.box.copy_range = lambda *args: 0
+        path = os.path.join(self.temp_dir, 'output')
+        with open(path, 'wb') as out_fh:
+            expected = self.copy(out_fh, 4096, 3 * 1024 * 1024 - 4096)
+        with open(path, 'rb') as fh:
+            self.assertEqual(fh.read(), expected)
+
+    def test_file_to_stream(self):
+        out_fh = io.BytesIO()
+        expected = self.copy(out_fh, 5, 2 * 1024 * 1024 + 3)
+        self.assertEqual(out_fh.getvalue(), expected)
+
+
+class RecordingFile(object):
+    """File wrapper recording the positions of seeks and reads."""
+
+    def __init__(self, fh):
+        self.fh = fh
+        self.reads = []
+
+    def seek(self, *args):
+        return self.fh.seek(*args)
+
+    def tell(self):
+        return self.fh.tell()
+
+    def read(self, size=-1):
+        self.reads.append(self.fh.tell())
+        return self.fh.read(size)
+
+
+def box_bytes(name, *payload):
+    payload = b''.join(payload)
+    return struct.pack('>I4s', 8 + len(payload), name) + payload
+
+
+class TestFragmented(TempDirTestCase):
+
+    def fragmented_file(self, fragments=3, padding=0):
+        """Builds ftyp, moov, [free], (moof, mdat) * fragments, mfra.
+
+        The ftyp and moov are taken from a test input, each moof has a tfhd
+        with an absolute base data offset and a trun with a relative one.
+        """
+        with open('data/testsrc_320x240_h264.mp4', 'rb') as fh:
+            source = mpeg.load(fh)
+            fh.seek(source.ftyp_box.position)
+            data = fh.read(source.ftyp_box.size())
+            fh.seek(source.moov_box.position)
+            data += fh.read(source.moov_box.size())
+        if padding:
+            data += box_bytes(b'free', bytes(padding))
+
+        moof_positions = []
+        for index in range(fragments):
+            moof_size = 8 + 16 + 8 + 24 + 24
+            moof_positions.append(len(data))
+            tfhd = box_bytes(b'tfhd', struct.pack('>IIQ', 1, 1,
+                                                  len(data) + moof_size + 8))
+            trun = box_bytes(b'trun', struct.pack('>IIiI', 0x301, 1, 4, 100))
+            data += box_bytes(b'moof',
+                              box_bytes(b'mfhd', struct.pack('>II', 0, index)),
+                              box_bytes(b'traf', tfhd, trun))
+            data += box_bytes(b'mdat', bytes([index]) * 104)
+        tfra = box_bytes(b'tfra', struct.pack('>IIII', 1 << 24, 1, 0,
+                                              fragments),
+                         b''.join(struct.pack('>QQBBB', index, position,
+                                              1, 1, 1)
+                                  for index, position in
+                                  enumerate(moof_positions)))
+        data += box_bytes(b'mfra', tfra, box_bytes(
+            b'mfro', struct.pack('>II', 0, 8 + len(tfra) + 16)))
+
+        path = os.path.join(self.temp_dir, 'fragmented.mp4')
+        with open(path, 'wb') as fh:
+            fh.write(data)
+        return path
+
+    def fragment_offsets(self, fh):
+        """Returns the moof and mdat positions and offsets of a file."""
+        mpeg4_file = mpeg.load(fh)
+        moofs = [e for e in mpeg4_file.contents if e.name == b'moof']
+        mdats = [e for e in mpeg4_file.contents if e.name == b'mdat']
+        base_offsets, data_offsets = [], []
+        for moof in moofs:
+            fh.seek(moof.content_start() + 16)
+            traf = fh.read(moof.content_size - 16)
+            base_offsets.append(struct.unpack_from('>Q', traf, 24)[0])
+            data_offsets.append(struct.unpack_from('>i', traf, 48)[0])
+        mfra = mpeg4_file.contents[-1]
+        fh.seek(mfra.content_start() + 24)
+        tfra = fh.read(19 * len(moofs))
+        moof_offsets = [struct.unpack_from('>Q', tfra, 19 * i + 8)[0]
+                        for i in range(len(moofs))]
+        return {
+            'moofs': [moof.position for moof in moofs],
+            'mdats': [mdat.content_start() for mdat in mdats],
+            'base_offsets': base_offsets,
+            'data_offsets': data_offsets,
+            'moof_offsets': moof_offsets,
+        }
+
+    def test_save_moves_fragment_offsets(self):
+        path = self.fragmented_file()
+        with open(path, 'rb') as in_fh:
+            mpeg4_file = mpeg.load(in_fh)
+            self.assertTrue(mpeg4_file.is_fragmented())
+            metadata_utils.mpeg4_add_spherical_v2(
+                mpeg4_file, mpeg4_file.reader, 'equirectangular', None, None)
+            out_fh = io.BytesIO()
+            mpeg4_file.save(mpeg4_file.reader, out_fh)
+            before = self.fragment_offsets(in_fh)
+
+        out_fh.seek(0)
+        after = self.fragment_offsets(out_fh)
+        self.assertGreater(after['moofs'][0], before['moofs'][0])
+        self.assertEqual(after['base_offsets'], after['mdats'])
+        self.assertEqual(after['moof_offsets'], after['moofs'])
+        self.assertEqual(after['data_offsets'], before['data_offsets'])
+
+    def test_in_place_needs_room_before_fragments(self):
+        path = self.fragmented_file()
+        with open(path, 'rb') as fh:
+            data = fh.read()
+        with open(path, 'r+b') as fh:
+            mpeg4_file = mpeg.load(fh)
+            metadata_utils.mpeg4_add_spherical_v2(
+                mpeg4_file, mpeg4_file.reader, 'equirectangular', None, None)
+            self.assertFalse(mpeg4_file.save_in_place(fh))
+        with open(path, 'rb') as fh:
+            self.assertEqual(fh.read(), data)
+
+        path = self.fragmented_file(padding=1024)
+        with open(path, 'rb') as fh:
+            before = self.fragment_offsets(fh)
+        self.assertIsNone(main(['-i', '--in-place', '--v2', path]))
+        with open(path, 'rb') as fh:
+            self.assertEqual(self.fragment_offsets(fh), before)
+        contents = []
+        metadata_utils.parse_metadata(path, contents.append)
+        self.assertTrue('\n'.join(contents).find('SV3D') >= 0)
+
+
+class PipeFile(object):
+    """Non-seekable stream returning short reads."""
+
+    def __init__(self, data):
+        self.fh = io.BytesIO(data)
+
+    def read(self, size=-1):
+        if size < 0:
+            return self.fh.read()
+        return self.fh.read(min(size, 1000))
+
+
+class TestStreamInject(TempDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.metadata = metadata_utils.Metadata('equirectangular',
+                                                'top-bottom')
+
+    def moov_before_mdat(self, mdat_size=None):
+        """Returns a test input with its moov saved before the mdat."""
+        with open('data/testsrc_320x240_h264.mp4', 'rb') as in_fh:
+            mpeg4_file = mpeg.load(in_fh)
+            mpeg4_file.contents = [mpeg4_file.ftyp_box, mpeg4_file.moov_box,
+                                   mpeg4_file.first_mdat_box]
+            out_fh = io.BytesIO()
+            mpeg4_file.save(in_fh, out_fh)
+        data = out_fh.getvalue()
+        if mdat_size is not None:
+            mdat_position = data.rindex(b'mdat') - 4
+            data = (data[:mdat_position] + struct.pack('>I', mdat_size) +
+                    data[mdat_position + 4:])
+        return data
+
+    def inject_file(self, data):
+        path = os.path.join(self.temp_dir, 'input.mp4')
+        output = os.path.join(self.temp_dir, 'output.mp4')
+        with open(path, 'wb') as fh:
+            fh.write(data)
+        metadata_utils.inject_metadata(path, output, self.metadata,
+                                       lambda x: None)
+        with open(output, 'rb') as fh:
+            return fh.read()
+
+    def inject_stream(self, data):
+        log = []
+        out_fh = io.BytesIO()
+        metadata_utils.inject_metadata_stream(PipeFile(data), out_fh,
+                                              self.metadata, log.append)
+        self.assertFalse([line for line in log if line.startswith('Error')])
+        return out_fh.getvalue()
+
+    def test_stream_matches_file(self):
+        inputs = [self.moov_before_mdat()]
+        for name in ['testsrc_320x240_h264.mp4', 'testsrc_32x24_prores.mov']:
+            with open(os.path.join('data', name), 'rb') as fh:
+                inputs.append(fh.read())
+        for data in inputs:
+            self.assertEqual(self.inject_stream(data), self.inject_file(data))
+
+    def test_mdat_extending_to_end(self):
+        data = self.moov_before_mdat(mdat_size=0)
+        output = self.inject_stream(data)
+        self.assertEqual(output[-1000:], data[-1000:])
+
+        # Saving a file writes the actual size of the mdat instead of 0.
+        file_output = self.inject_file(data)
+        mdat_position = file_output.rindex(b'mdat') - 4
+        self.assertEqual(output[mdat_position:mdat_position + 8],
+                         b'\x00\x00\x00\x00mdat')
+        self.assertEqual(output[:mdat_position], file_output[:mdat_position])
+        self.assertEqual(output[mdat_position + 4:],
+                         file_output[mdat_position + 4:])
+
+    def test_standard_streams(self):
+        with open('data/testsrc_320x240_h264.mp4', 'rb') as fh:
+            data = fh.read()
+        stdin = io.TextIOWrapper(io.BytesIO(data))
+        stdout = io.TextIOWrapper(io.BytesIO())
+        stderr = io.StringIO()
+        with contextlib.redirect_stdout(stdout), \
+                contextlib.redirect_stderr(stderr):
+            sys_stdin, sys.stdin = sys.stdin, stdin
+            try:
+                main(['-i', '--v2', '--stereo', 'top-bottom', '-', '-'])
+            finally:
+                sys.stdin = sys_stdin
+        self.assertEqual(stdout.buffer.getvalue(), self.inject_file(data))
+        self.assertTrue(stderr.getvalue().find('SV3D') >= 0)
+
+    def test_spatial_audio_detection(self):
+        with open('data/testsrc_320x240_h264.mp4', 'rb') as fh:
+            data = fh.read()
+        log = []
+        out_fh = io.BytesIO()
+        metadata_utils.inject_metadata_stream(PipeFile(data), out_fh,
+                                              self.metadata, log.append,
+                                              spatial_audio=True)
+        self.assertIn('Audio has 0 channel(s) and is not a supported '
+                      'spatial audio format.', log)
+        self.assertIsNone(self.metadata.audio)
+        self.assertEqual(out_fh.getvalue(), self.inject_stream(data))
+
+    def test_truncated_moov(self):
+        with open('data/testsrc_320x240_h264.mp4', 'rb') as fh:
+            moov_last = fh.read()
+        moov_first = self.moov_before_mdat()
+        moov_position = moov_first.index(b'moov') - 4
+        for data, error in [
+                (moov_last[:-100], 'Error, truncated moov box.'),
+                (moov_first[:moov_position + 200],
+                 "Error, truncated b'moov' box."),
+                (moov_last[:moov_last.index(b'moov') - 4],
+                 'Error, stream does not contain moov box.')]:
+            with self.assertRaises(ValueError):
+                b''.join(mpeg.stream.save(PipeFile(data), lambda x: None))
+
+            log = []
+            self.assertFalse(metadata_utils.inject_metadata_stream(
+                PipeFile(data), io.BytesIO(), self.metadata, log.append))
+            self.assertEqual(log[-1], error)
+
+        # The command line removes the incomplete output.
+        output = os.path.join(self.temp_dir, 'output.mp4')
+        stdin = io.TextIOWrapper(io.BytesIO(moov_last[:-100]))
+        stderr = io.StringIO()
+        with contextlib.redirect_stderr(stderr):
+            sys_stdin, sys.stdin = sys.stdin, stdin
+            try:
+                main(['-i', '--v2', '-', output])
+            finally:
+                sys.stdin = sys_stdin
+        self.assertIn('Error, truncated moov box.', stderr.getvalue())
+        self.assertFalse(os.path.exists(output))
+
+
+class TestFaststart(TempDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.output = os.path.join(self.temp_dir, 'output.mp4')
+
+    def chunks(self, fh):
+        """Returns the names of the top-level boxes and the chunk data."""
+        mpeg4_file = mpeg.load(fh)
+        chunks = []
+        for element in mpeg4_file.moov_box.find_all(mpeg.constants.TAG_STCO):
+            header, table = mpeg.box.read_index(mpeg4_file.reader, element)
+            for offset in mpeg.box.unpack_index(table, 4):
+                fh.seek(int(offset))
+                chunks.append(fh.read(32))
+        return [element.name for element in mpeg4_file.contents], chunks
+
+    def test_faststart(self):
+        for name in ['testsrc_320x240_h264.mp4', 'testsrc_32x24_prores.mov']:
+            path = os.path.join('data', name)
+            with open(path, 'rb') as fh:
+                names, chunks = self.chunks(fh)
+                fh.seek(0)
+                data = fh.read()
+            self.assertLess(names.index(b'mdat'), names.index(b'moov'))
+
+            self.assertIsNone(main(['-i', '--v2', '--faststart', path,
+                                    self.output]))
+            with open(self.output, 'rb') as fh:
+                new_names, new_chunks = self.chunks(fh)
+                fh.seek(0)
+                output = fh.read()
+            self.assertLess(new_names.index(b'moov'), new_names.index(b'mdat'))
+            self.assertEqual(new_chunks, chunks)
+
+            out_fh = io.BytesIO()
+            metadata_utils.inject_metadata_stream(
+                PipeFile(data), out_fh,
+                metadata_utils.Metadata('equirectangular'), lambda x: None,
+                faststart=True)
+            self.assertEqual(out_fh.getvalue(), output)
+
+    def test_media_on_both_sides_of_moov(self):
+        with open('data/testsrc_320x240_h264.mp4', 'rb') as fh:
+            mpeg4_file = mpeg.load(fh)
+            contents = list(mpeg4_file.contents)
+            mpeg4_file.contents.append(mpeg4_file.first_mdat_box)
+            with contextlib.redirect_stdout(io.StringIO()):
+                self.assertFalse(mpeg4_file.faststart())
+            mpeg4_file.contents.pop()
+            self.assertEqual(mpeg4_file.contents, contents)
+
+            self.assertTrue(mpeg4_file.faststart())
+            self.assertIs(mpeg4_file.contents[2], mpeg4_file.moov_box)
+            self.assertTrue(mpeg4_file.faststart())
+
+
+class TestSegments(TempDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.output = os.path.join(self.temp_dir, 'output.mp4')
+        self.metadata = metadata_utils.Metadata('equirectangular')
+
+    def test_segments_match_output(self):
+        for name in ['testsrc_320x240_h264.mp4', 'testsrc_32x24_prores.mov']:
+            path = os.path.join('data', name)
+            for faststart in [False, True]:
+                metadata_utils.inject_metadata(path, self.output,
+                                               self.metadata, lambda x: None,
+                                               faststart=faststart)
+                segments = metadata_utils.inject_mpeg4_segments(
+                    path, self.metadata, lambda x: None, faststart=faststart)
+                self.assertIsNotNone(segments)
+
+                data = []
+                with open(path, 'rb') as fh:
+                    for segment in segments:
+                        if segment.data is None:
+                            fh.seek(segment.position)
+                            data.append(fh.read(segment.size))
+                        else:
+                            data.append(segment.data)
+                with open(self.output, 'rb') as fh:
+                    self.assertEqual(b''.join(data), fh.read())
+                # The media is referenced, not copied.
+                self.assertTrue(any(segment.data is None
+                                    for segment in segments))
+
+
+class TestPadding(TempDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.padded = os.path.join(self.temp_dir, 'padded.mp4')
+        self.output = os.path.join(self.temp_dir, 'output.mp4')
+        self.assertIsNone(main(['-i', '--faststart', '--padding', '65536',
+                                'data/testsrc_320x240_h264.mp4',
+                                self.padded]))
+
+    def layout(self, path):
+        with open(path, 'rb') as fh:
+            mpeg4_file = mpeg.load(fh)
+            return [(element.name, element.position, element.size())
+                    for element in mpeg4_file.contents]
+
+    def test_padding_after_moov(self):
+        layout = self.layout(self.padded)
+        names = [name for name, _, _ in layout]
+        index = names.index(b'moov')
+        self.assertEqual(names[index + 1:index + 3], [b'free', b'mdat'])
+        self.assertEqual(layout[index + 1][2], 65536)
+
+    def test_padding_is_consumed(self):
+        layout = self.layout(self.padded)
+        mdat = [element for element in layout if element[0] == b'mdat']
+        with open(self.padded, 'rb') as fh:
+            data = fh.read()
+
+        # Copies keep the media where it is, shrinking the padding.
+        self.assertIsNone(main(['-i', '--v2', '--stereo', 'top-bottom',
+                                self.padded, self.output]))
+        new_layout = self.layout(self.output)
+        self.assertEqual(new_layout[-1], mdat[0])
+        self.assertEqual(sum(size for name, _, size in new_layout
+                             if name in (b'moov', b'free')),
+                         sum(size for name, _, size in layout
+                             if name in (b'moov', b'free')))
+        with open(self.output, 'rb') as fh:
+            output = fh.read()
+        self.assertEqual(output[mdat[0][1]:], data[mdat[0][1]:])
+
+        metadata = metadata_utils.Metadata('equirectangular')
+        metadata.stereo = 'top-bottom'
+        metadata_utils.inject_metadata(self.padded, self.output, metadata,
+                                       lambda x: None, padding=65536)
+        with open(self.output, 'rb') as fh:
+            output = fh.read()
+        self.assertEqual(self.layout(self.output)[-1], mdat[0])
+        out_fh = io.BytesIO()
+        metadata_utils.inject_metadata_stream(
+            PipeFile(data), out_fh, metadata, lambda x: None, padding=65536)
+        self.assertEqual(out_fh.getvalue(), output)
+
+        # So does rewriting the file in place.
+        shutil.copyfile(self.padded, self.output)
+        self.assertIsNone(main(['-i', '--in-place', '--v2', '--stereo',
+                                'left-right', self.output]))
+        self.assertEqual(self.layout(self.output)[-1], mdat[0])
+        with open(self.output, 'rb') as fh:
+            self.assertEqual(fh.read()[mdat[0][1]:], data[mdat[0][1]:])
+        metadata = metadata_utils.parse_metadata(self.output, lambda x: None)
+        self.assertEqual(list(metadata.video_v2.values())[0]['stereo_mode'],
+                         2)
+
+    def test_free_space_is_not_held_in_memory(self):
+        with open(self.padded, 'rb') as fh:
+            mpeg4_file = mpeg.load(fh)
+            free = mpeg4_file.contents[
+                mpeg4_file.contents.index(mpeg4_file.moov_box) + 1]
+            metadata_utils.mpeg4_add_spherical_v2(
+                mpeg4_file, mpeg4_file.reader, 'equirectangular', None, None)
+            self.assertTrue(mpeg4_file.reserve_padding(0))
+            # The padding shrinks and its contents are copied when saved.
+            self.assertIn(free, mpeg4_file.contents)
+            self.assertIsNone(free.contents)
+            self.assertLess(free.size(), 65536)
+
+    def test_resize_free_space(self):
+        def loaded_free_box(size):
+            free = mpeg.mpeg4_container.free_box(size)
+            free.contents = None
+            return free
+
+        first, second = loaded_free_box(1000), loaded_free_box(500)
+        resize = mpeg.mpeg4_container.resize_free_space
+        self.assertEqual(resize([first, second], 1500), [first, second])
+        self.assertEqual(resize([first, second], 1400), [first, second])
+        self.assertEqual(first.size(), 900)
+
+        for growth in [4, 100]:
+            first = loaded_free_box(1000)
+            free_space = resize([first, second], 1500 + growth)
+            self.assertEqual(free_space[0], first)
+            self.assertEqual(free_space[2], second)
+            self.assertEqual(sum(element.size() for element in free_space),
+                             1500 + growth)
+            self.assertGreaterEqual(free_space[1].size(), 8)
+        self.assertIsNone(resize([loaded_free_box(1000), second], 504))
+
+
+class WriteRecordingFile(io.BytesIO):
+    """In-memory file recording the size of every write."""
+
+    def __init__(self):
+        io.BytesIO.__init__(self)
+        self.writes = []
+
+    def write(self, data):
+        self.writes.append(len(data))
+        return io.BytesIO.write(self, data)
+
+
+class TestBoxWriter(unittest.TestCase):
+
+    def test_large_header(self):
+        sa3d_box = mpeg.SA3DBox.create(4, {
+            'ambisonic_type': 'periphonic',
+            'ambisonic_order': 1,
+            'ambisonic_channel_ordering': 'ACN',
+            'ambisonic_normalization': 'SN3D',
+            'head_locked_stereo': False,
+            'channel_map': [0, 1, 2, 3]})
+        sa3d_box.header_size = 16
+        out_fh = mpeg.box.BoxWriter(sa3d_box.size())
+        sa3d_box.save(None, out_fh, 0)
+        data = out_fh.getvalue()
+        self.assertEqual(len(data), sa3d_box.size())
+        self.assertEqual(data[:16], struct.pack(
+            '>I4sQ', 1, mpeg.constants.TAG_SA3D, sa3d_box.size()))
+
+        loaded = mpeg.sa3d.load(io.BytesIO(bytes(data)), 0, len(data))
+        self.assertEqual(loaded.num_channels, 4)
+        self.assertEqual(loaded.channel_map, [0, 1, 2, 3])
+
+    def test_moov_written_at_once(self):
+        with open('data/testsrc_320x240_h264.mp4', 'rb') as fh:
+            mpeg4_file = mpeg.load(fh)
+            metadata_utils.mpeg4_add_metadata(
+                mpeg4_file, mpeg4_file.reader,
+                metadata_utils.Metadata('equirectangular', 'top-bottom'),
+                lambda x: None)
+            out_fh = WriteRecordingFile()
+            mpeg4_file.save(fh, out_fh)
+            expected = io.BytesIO()
+            for element in mpeg4_file.contents:
+                element.save(fh, expected, 0)
+        self.assertEqual(out_fh.getvalue(), expected.getvalue())
+        self.assertIn(mpeg4_file.moov_box.size(), out_fh.writes)
+        self.assertLessEqual(len(out_fh.writes), 4)
+
+
+class TestSaveProgress(TempDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.block_size = mpeg.box.PROGRESS_BLOCK_SIZE
+        self.interval = mpeg.box.PROGRESS_INTERVAL
+        mpeg.box.PROGRESS_BLOCK_SIZE = 1024
+        mpeg.box.PROGRESS_INTERVAL = 0
+
+    def tearDown(self):
+        mpeg.box.PROGRESS_BLOCK_SIZE = self.block_size
+        mpeg.box.PROGRESS_INTERVAL = self.interval
+
+    def inject(self):
+        output = os.path.join(self.temp_dir, 'output.mp4')
+        progress = []
+        metadata_utils.inject_metadata(
+            'data/testsrc_320x240_h264.mp4', output,
+            metadata_utils.Metadata('equirectangular'), lambda x: None,
+            progress=lambda *args: progress.append(args))
+        return os.path.getsize(output), progress
+
+    def test_progress(self):
+        size, progress = self.inject()
+        self.assertEqual(progress[-1][:2], (size, size))
+        written = [value for value, _, _ in progress]
+        self.assertEqual(written, sorted(written))
+        self.assertTrue(all(mb_per_s >= 0 for _, _, mb_per_s in progress))
+        # ftyp and free (written together), the mdat header, three blocks
+        # of its 2760 bytes, moov.
+        self.assertEqual(len(progress), 6)
+
+    def test_throttled(self):
+        mpeg.box.PROGRESS_INTERVAL = 3600
+        size, progress = self.inject()
+        self.assertEqual([report[:2] for report in progress], [(size, size)])
+
+
+class TestJobs(TempDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.database = os.path.join(self.temp_dir, 'jobs.sqlite3')
+        self.conn = jobs.connect(self.database)
+        self.addCleanup(self.conn.close)
+        self.input = os.path.join(self.temp_dir, 'input.mp4')
+        shutil.copy('data/testsrc_320x240_h264.mp4', self.input)
+
+    def events(self, job_ids):
+        return [json.loads(event[len('data: '):])
+                for event in jobs.events(job_ids, self.database)]
+
+    def test_run_job(self):
+        job_id = jobs.enqueue(self.conn, 'input.mp4', {'spherical': True})
+        self.assertEqual(jobs.get(self.conn, job_id)['status'], jobs.QUEUED)
+        job = jobs.claim(self.conn, 1)
+        self.assertEqual(job['id'], job_id)
+        self.assertIsNone(jobs.claim(self.conn, 1))
+        with contextlib.redirect_stdout(io.StringIO()):
+            jobs.run_job(self.conn, job, self.temp_dir)
+
+        state = jobs.get(self.conn, job_id)
+        self.assertEqual(state['status'], jobs.DONE)
+        self.assertEqual(state['output_url'], '/download/injected_input.mp4')
+        output = os.path.join(self.temp_dir, 'injected_input.mp4')
+        self.assertEqual(state['bytes_written'], os.path.getsize(output))
+        self.assertEqual(state['total_bytes'], os.path.getsize(output))
+        parsed = metadata_utils.parse_metadata(output, lambda x: None)
+        self.assertIn('Track 0', parsed.video)
+        self.assertEqual(self.events([job_id, 'missing']), [
+            state, {'id': 'missing', 'status': jobs.ERROR,
+                    'error': 'Unknown job'}])
+        self.assertIn('spatialmedia_jobs_finished_total{status="done"} 1\n',
+                      jobs.prometheus_metrics(self.conn))
+
+    def test_requeue(self):
+        first = jobs.enqueue(self.conn, 'input.mp4', {})
+        second = jobs.enqueue(self.conn, 'input.mp4', {})
+        jobs.claim(self.conn, 1)
+        jobs.claim(self.conn, 2)
+        self.assertEqual(jobs.requeue(self.conn, 1), 1)
+        self.assertEqual(jobs.get(self.conn, first)['status'], jobs.QUEUED)
+        self.assertEqual(jobs.get(self.conn, second)['status'], jobs.RUNNING)
+        self.assertEqual(jobs.requeue(self.conn), 1)
+        self.assertEqual(jobs.claim(self.conn, 3)['id'], first)
+
+    def test_run_stream(self):
+        size = os.path.getsize(self.input)
+        with open(self.input, 'rb') as in_fh, \
+                contextlib.redirect_stdout(io.StringIO()):
+            job_id = jobs.run_stream(self.conn, 'input.mp4',
+                                     {'spherical': True}, in_fh, size,
+                                     self.temp_dir)
+        state = jobs.get(self.conn, job_id)
+        self.assertEqual(state['status'], jobs.DONE)
+        self.assertEqual(sorted(os.listdir(self.temp_dir)), [
+            'injected_input.mp4', 'input.mp4', 'jobs.sqlite3',
+            'jobs.sqlite3-shm', 'jobs.sqlite3-wal'])
+
+    def test_run_stream_truncated(self):
+        with open(self.input, 'rb') as fh:
+            data = fh.read()
+        with contextlib.redirect_stdout(io.StringIO()):
+            job_id = jobs.run_stream(self.conn, 'input.mp4',
+                                     {'spherical': True},
+                                     io.BytesIO(data[:-100]), len(data),
+                                     self.temp_dir)
+        self.assertEqual(jobs.get(self.conn, job_id)['status'], jobs.ERROR)
+        self.assertFalse(os.path.exists(
+            os.path.join(self.temp_dir, 'injected_input.mp4')))
+
+    def test_abandon_streams(self):
+        process = subprocess.Popen([sys.executable, '-c', ''])
+        process.wait()
+        live = jobs.enqueue(self.conn, 'a.mp4', {}, jobs.RUNNING,
+                            streamed=True, worker=os.getpid())
+        dead = jobs.enqueue(self.conn, 'b.mp4', {}, jobs.RUNNING,
+                            streamed=True, worker=process.pid)
+        unknown = jobs.enqueue(self.conn, 'c.mp4', {}, jobs.RUNNING,
+                               streamed=True)
+        self.assertEqual(jobs.abandon_streams(self.conn), 2)
+        self.assertEqual(jobs.get(self.conn, live)['status'], jobs.RUNNING)
+        for job_id in (dead, unknown):
+            self.assertEqual(jobs.get(self.conn, job_id)['error'],
+                             'Upload interrupted')
+        # Streamed jobs are never run by the workers.
+        self.assertEqual(jobs.requeue(self.conn), 0)
+
+
+class TestStats(TempDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.input = 'data/testsrc_320x240_h264.mp4'
+        self.output = os.path.join(self.temp_dir, 'output.mp4')
+
+    def test_inject(self):
+        stats = mpeg.Stats()
+        metadata_utils.inject_metadata(
+            self.input, self.output, metadata_utils.Metadata('equirectangular'),
+            lambda x: None, stats=stats)
+        for phase in ('load', 'metadata', 'save', 'media_copy'):
+            self.assertIn(phase, stats.timings)
+        self.assertGreater(stats.counters['boxes_parsed'], 0)
+        self.assertEqual(stats.counters['bytes_written'],
+                         os.path.getsize(self.output))
+        self.assertIsNone(mpeg.stats.active())
+
+    def test_chunk_offsets(self):
+        with open(self.input, 'rb') as fh:
+            mpeg4_file = mpeg.load(fh)
+            entries = 0
+            for element in mpeg4_file.moov_box.find_all(mpeg.constants.TAG_STCO):
+                header, table = mpeg.box.read_index(mpeg4_file.reader, element)
+                entries += len(mpeg.box.unpack_index(table, 4))
+
+        stats = mpeg.Stats()
+        metadata_utils.inject_metadata(
+            self.input, self.output, metadata_utils.Metadata('equirectangular'),
+            lambda x: None, faststart=True, stats=stats)
+        self.assertIn('chunk_offsets', stats.timings)
+        self.assertEqual(stats.counters['chunk_offsets_rewritten'], entries)
+
+    def test_parse(self):
+        stats = mpeg.Stats()
+        metadata_utils.parse_metadata(self.input, lambda x: None, stats=stats)
+        self.assertEqual(list(stats.timings), ['load', 'parse'])
+        self.assertGreater(stats.counters['bytes_read'], 0)
+
+
+class TestAsync(TempDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.input = 'data/testsrc_320x240_h264.mp4'
+        self.output = os.path.join(self.temp_dir, 'output.mp4')
+        self.metadata = metadata_utils.Metadata('equirectangular')
+
+    def test_inject(self):
+        expected = os.path.join(self.temp_dir, 'expected.mp4')
+        metadata_utils.inject_metadata(self.input, expected, self.metadata,
+                                       lambda x: None)
+        log = []
+        progress = []
+
+        async def inject():
+            return await asyncio.gather(
+                aio.inject_metadata(self.input, self.output, self.metadata,
+                                    log.append,
+                                    lambda *args: progress.append(args)),
+                aio.parse_metadata(self.input, log.append))
+
+        error, parsed = asyncio.run(inject())
+        self.assertIsNone(error)
+        self.assertIsNotNone(parsed)
+        with open(expected, 'rb') as fh:
+            expected_data = fh.read()
+        with open(self.output, 'rb') as fh:
+            self.assertEqual(fh.read(), expected_data)
+        self.assertEqual(progress[-1][:2], (len(expected_data),
+                                            len(expected_data)))
+        self.assertIn('Saved file settings', log)
+
+    @unittest.skipUnless(hasattr(os, 'mkfifo'), 'requires named pipes')
+    def test_inject_pipe(self):
+        expected = os.path.join(self.temp_dir, 'expected.mp4')
+        metadata_utils.inject_metadata(self.input, expected, self.metadata,
+                                       lambda x: None)
+        pipe = os.path.join(self.temp_dir, 'input.mp4')
+        os.mkfifo(pipe)
+        log = []
+
+        def feed():
+            with open(self.input, 'rb') as in_fh, open(pipe, 'wb') as out_fh:
+                shutil.copyfileobj(in_fh, out_fh)
+
+        async def inject():
+            feeding = asyncio.get_running_loop().run_in_executor(None, feed)
+            error = await aio.inject_metadata(pipe, self.output,
+                                              self.metadata, log.append)
+            await feeding
+            return error
+
+        self.assertIsNone(asyncio.run(inject()))
+        with open(expected, 'rb') as fh:
+            expected_data = fh.read()
+        with open(self.output, 'rb') as fh:
+            self.assertEqual(fh.read(), expected_data)
+        self.assertIn('Saved file settings', log)
+
+    def test_cancel(self):
+        async def inject():
+            task = asyncio.current_task()
+            await aio.inject_metadata(self.input, self.output, self.metadata,
+                                      lambda x: None,
+                                      lambda *args: task.cancel())
+
+        with self.assertRaises(asyncio.CancelledError):
+            asyncio.run(inject())
+        self.assertFalse(os.path.exists(self.output))
+
+
+class TestLazyLoad(unittest.TestCase):
+
+    def structure(self, element):
+        children = None
+        if isinstance(element, mpeg.Container):
+            children = [self.structure(child) for child in element.contents]
+        return (element.name, element.position, element.size(), children)
+
+    def test_lazy_load_reads_top_level_headers(self):
+        with open('data/testsrc_320x240_h264.mp4', 'rb') as fh:
+            recording_fh = RecordingFile(fh)
+            mpeg4_file = mpeg.load(recording_fh, lazy=True)
+            for element in mpeg4_file.contents:
+                reads = [p for p in recording_fh.reads
+                         if element.content_start() <= p < element.position +
+                         element.size()]
+                self.assertEqual(reads, [])
+
+            recording_fh.reads = []
+            metadata_utils.parse_spherical_mpeg4(
+                mpeg4_file, recording_fh, lambda x: None)
+            mdat_box = mpeg4_file.first_mdat_box
+            self.assertFalse([p for p in recording_fh.reads
+                              if mdat_box.position < p < mdat_box.position +
+                              mdat_box.size()])
+
+    def test_lazy_load_matches_eager_load(self):
+        for name in ['testsrc_320x240_h264.mp4', 'testsrc_32x24_prores.mov']:
+            with open(os.path.join('data', name), 'rb') as fh:
+                eager = [self.structure(element)
+                         for element in mpeg.load(fh).contents]
+                lazy = [self.structure(element)
+                        for element in mpeg.load(fh, lazy=True).contents]
+            self.assertEqual(lazy, eager)
+
+    def test_pickle_lazy_load(self):
+        with open('data/testsrc_320x240_h264.mp4', 'rb') as fh:
+            eager = self.structure(mpeg.load(fh).moov_box)
+            lazy_moov = mpeg.load(fh, lazy=True).moov_box
+            self.assertIsNotNone(lazy_moov.source)
+            copy = pickle.loads(pickle.dumps(lazy_moov))
+        self.assertEqual(self.structure(copy), eager)
+        self.assertIsNone(copy.source)
+
+
+class TestTrackIndex(unittest.TestCase):
+
+    def test_tracks(self):
+        with open('data/testsrc_320x240_h264.mp4', 'rb') as fh:
+            mpeg4_file = mpeg.load(fh)
+            tracks = mpeg4_file.tracks
+            self.assertIs(mpeg4_file.tracks, tracks)
+            self.assertEqual(len(tracks), 1)
+            track = tracks[0]
+            self.assertEqual(track.track_id, 1)
+            self.assertEqual(track.handler_type, mpeg.constants.TAG_VIDE)
+            self.assertTrue(track.is_video())
+            self.assertEqual(track.codec, b'avc1')
+            self.assertEqual(track.num_audio_channels, -1)
+            self.assertEqual(track.sv3d, [])
+            self.assertEqual(track.uuid, [])
+
+            metadata_utils.mpeg4_add_metadata(
+                mpeg4_file, mpeg4_file.reader,
+                metadata_utils.Metadata('equirectangular', 'top-bottom'),
+                lambda x: None)
+            metadata_utils.mpeg4_add_spherical_xml_v1(
+                mpeg4_file, mpeg4_file.reader,
+                metadata_utils.generate_spherical_xml())
+            self.assertEqual(len(track.sv3d), 1)
+            self.assertEqual(track.st3d[0].stereo_mode, 1)
+            self.assertEqual(len(track.uuid), 1)
+            self.assertEqual(metadata_utils.get_num_audio_tracks(
+                mpeg4_file, mpeg4_file.reader), 0)
+
+
+def full_size(element):
+    """Returns the size of element, summing the contents of containers."""
+    if not isinstance(element, mpeg.Container):
+        return element.size()
+    return (element.header_size + element.padding +
+            sum(full_size(child) for child in element.contents))
+
+
+class TestIncrementalResize(unittest.TestCase):
+
+    def test_only_ancestors_are_resized(self):
+        with open('data/testsrc_320x240_h264.mp4', 'rb') as fh:
+            mpeg4_file = mpeg.load(fh)
+            sample_description = mpeg4_file.tracks[0].stsd.contents[0]
+            ancestors = []
+            parent = sample_description
+            while parent is not None:
+                ancestors.append(parent)
+                parent = parent.parent
+            self.assertIs(ancestors[-1], mpeg4_file)
+
+            st3d = mpeg.sv3d.ST3DBox.create()
+            sample_description.append(st3d)
+            self.assertIs(st3d.parent, sample_description)
+            self.assertTrue(mpeg4_file.dirty)
+            for element in self.walk(mpeg4_file.contents):
+                if isinstance(element, mpeg.Container):
+                    self.assertEqual(element.dirty, element in ancestors,
+                                     element.name)
+
+            mpeg4_file.resize()
+            self.assertFalse(mpeg4_file.dirty)
+            for element in self.walk(mpeg4_file.contents):
+                self.assertEqual(element.size(), full_size(element),
+                                 element.name)
+                if isinstance(element, mpeg.Container):
+                    self.assertFalse(element.dirty)
+
+    def test_pickled_box_has_no_parent(self):
+        with open('data/testsrc_320x240_h264.mp4', 'rb') as fh:
+            mpeg4_file = mpeg.load(fh)
+            stsd = mpeg4_file.tracks[0].stsd
+            copy = pickle.loads(pickle.dumps(stsd.contents[0].contents[0]))
+            self.assertIsNone(copy.parent)
+            self.assertEqual(copy.name, stsd.contents[0].contents[0].name)
+
+    def walk(self, elements):
+        for element in elements:
+            yield element
+            if isinstance(element, mpeg.Container):
+                yield from self.walk(element.contents)
+
+
+class TestVirtualOutput(TempDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.input = os.path.join(self.temp_dir, 'input.mp4')
+        shutil.copy('data/testsrc_320x240_h264.mp4', self.input)
+        metadata = metadata_utils.Metadata('equirectangular')
+        self.path = os.path.join(self.temp_dir, 'output.mp4.virtual')
+        self.segments = metadata_utils.inject_mpeg4_segments(
+            self.input, metadata, lambda x: None)
+        virtual.write(self.path, self.input, self.segments)
+        output = os.path.join(self.temp_dir, 'output.mp4')
+        metadata_utils.inject_metadata(self.input, output, metadata,
+                                       lambda x: None)
+        with open(output, 'rb') as fh:
+            self.expected = fh.read()
+        # Position in the output of the media data, copied from the input.
+        media = next(segment for segment in self.segments
+                     if segment.data is None)
+        self.media_start = sum(segment.size for segment in
+                               self.segments[:self.segments.index(media)])
+
+    def read(self, start, stop, file_wrapper=None):
+        output = virtual.VirtualFile(self.path)
+        self.assertEqual(output.size, len(self.expected))
+        body = output.body(start, stop, file_wrapper)
+        try:
+            return b''.join(body)
+        finally:
+            body.close()
+
+    def test_ranges(self):
+        size = len(self.expected)
+        start = self.media_start + 10
+        for start, stop in [(0, size), (start, start + 100), (0, start + 100),
+                            (size - 10, size)]:
+            self.assertEqual(self.read(start, stop),
+                             self.expected[start:stop])
+            self.assertEqual(self.read(start, stop, FileWrapper),
+                             self.expected[start:stop])
+
+    def test_replaced_source(self):
+        output = virtual.VirtualFile(self.path)
+        replacement = os.path.join(self.temp_dir, 'replacement')
+        with open(replacement, 'wb') as fh:
+            fh.write(b'\0' * len(self.expected))
+        os.replace(replacement, self.input)
+        # Sent from the opened input, as a single segment with sendfile.
+        start = self.media_start + 10
+        body = output.body(start, start + 100, FileWrapper)
+        self.assertIsInstance(body, FileWrapper)
+        self.assertEqual(b''.join(body), self.expected[start:start + 100])
+        body.close()
+
+        with self.assertRaises(virtual.StaleError):
+            virtual.VirtualFile(self.path)
+        os.remove(self.input)
+        with self.assertRaises(virtual.StaleError):
+            virtual.VirtualFile(self.path)
+
+    def test_byte_range(self):
+        self.assertEqual(virtual.byte_range('bytes=10-19', 100), (10, 20))
+        self.assertEqual(virtual.byte_range('bytes=90-', 100), (90, 100))
+        self.assertEqual(virtual.byte_range('bytes=-10', 100), (90, 100))
+        self.assertEqual(virtual.byte_range('bytes=-200', 100), (0, 100))
+        self.assertEqual(virtual.byte_range('bytes=50-200', 100), (50, 100))
+        for header in [None, '', 'bytes=0-1,5-6', 'items=0-1', 'bytes=5-2',
+                       'bytes=a-b', 'bytes=-']:
+            self.assertIsNone(virtual.byte_range(header, 100), header)
+        for header in ['bytes=100-', 'bytes=200-300', 'bytes=-0']:
+            with self.assertRaises(virtual.RangeError):
+                virtual.byte_range(header, 100)
+
+
+class TestSlots(unittest.TestCase):
+
+    def test_loaded_boxes_have_no_dict(self):
+        with open('data/testsrc_32x24_prores.mov', 'rb') as fh:
+            mpeg4_file = mpeg.load(fh)
+            metadata_utils.mpeg4_add_metadata(
+                mpeg4_file, mpeg4_file.reader,
+                metadata_utils.Metadata('equirectangular', 'top-bottom'),
+                lambda x: None)
+        self.assertFalse(hasattr(mpeg4_file, '__dict__'))
+        elements = list(mpeg4_file.contents)
+        names = set()
+        while elements:
+            element = elements.pop()
+            self.assertFalse(hasattr(element, '__dict__'), element.name)
+            names.add(element.name)
+            if isinstance(element, mpeg.Container):
+                elements.extend(element.contents)
+        self.assertIn(b'st3d', names)
+        self.assertIn(b'equi', names)
+
+
+class TestBufferedLoad(unittest.TestCase):
+
+    def test_moov_is_read_once(self):
+        with open('data/testsrc_320x240_h264.mp4', 'rb') as fh:
+            recording_fh = RecordingFile(fh)
+            mpeg4_file = mpeg.load(recording_fh)
+            metadata_utils.parse_spherical_mpeg4(
+                mpeg4_file, mpeg4_file.reader, lambda x: None)
+
+        moov_box = mpeg4_file.moov_box
+        reads = [p for p in recording_fh.reads
+                 if moov_box.position <= p < moov_box.position + moov_box.size()]
+        self.assertEqual(set(reads), set([moov_box.position]))
+        self.assertLessEqual(len(recording_fh.reads),
+                             len(mpeg4_file.contents) + 1)
+
+    def sound_sample_description(self, body):
+        data = (struct.pack(">I4s", 16 + len(body), b"lpcm") +
+                bytes(8) + body)
+        fh = mpeg.BufferReader(data, 100)
+        return mpeg.container.load(fh, 100, 100 + len(data)), fh
+
+    def test_sample_description_num_channels(self):
+        version_0 = struct.pack(">hhihh", 0, 0, 0, 6, 16) + bytes(8)
+        sample_description, fh = self.sound_sample_description(version_0)
+        self.assertEqual(sample_description.padding, 28)
+        self.assertEqual(metadata_utils.get_sample_description_num_channels(
+            sample_description, fh), 6)
+
+        version_2 = struct.pack(">hhihhhhiidi", 2, 0, 0, 3, 16, -2, 0, 65536,
+                                72, 48000.0, 4) + bytes(20)
+        sample_description, fh = self.sound_sample_description(version_2)
+        self.assertEqual(sample_description.padding, 64)
+        self.assertEqual(metadata_utils.get_sample_description_num_channels(
+            sample_description, fh), 4)
+
+
+class TestMemoryMap(TempDirTestCase):
+
+    def inject(self, path, memory_map):
+        with open(path, 'rb') as in_fh:
+            mpeg4_file = mpeg.load(in_fh, memory_map=memory_map)
+            metadata_utils.mpeg4_add_spherical_v2(
+                mpeg4_file, mpeg4_file.reader, 'equirectangular', None, None)
+            out_fh = io.BytesIO()
+            mpeg4_file.save(mpeg4_file.reader, out_fh)
+            mpeg4_file.close()
+        return out_fh.getvalue()
+
+    def test_memory_map_matches_read(self):
+        for name in ['testsrc_320x240_h264.mp4', 'testsrc_32x24_prores.mov']:
+            path = os.path.join('data', name)
+            with open(path, 'rb') as in_fh:
+                mpeg4_file = mpeg.load(in_fh, memory_map=True)
+                self.assertIsInstance(mpeg4_file.reader.buffer, mmap.mmap)
+                mpeg4_file.close()
+            self.assertEqual(self.inject(path, True), self.inject(path, False))
+
+    def test_read_outside_buffer(self):
+        buffer_reader = mpeg.reader.BufferReader(b'0123456789', 100)
+        self.assertEqual(bytes(buffer_reader.read_at(105, 3)), b'567')
+        self.assertEqual(bytes(buffer_reader.read_at(108, 5)), b'89')
+        for position in [95, 98, 110, 120]:
+            self.assertEqual(bytes(buffer_reader.read_at(position, 4)), b'')
+        buffer_reader.seek(120)
+        self.assertEqual(buffer_reader.read(4), b'')
+
+    def test_command_line(self):
+        outputs = []
+        for flags in ([], ['--mmap']):
+            output = os.path.join(self.temp_dir, '%d.mp4' % len(outputs))
+            with contextlib.redirect_stdout(io.StringIO()):
+                main(['-i', '--v2'] + flags +
+                     ['data/testsrc_320x240_h264.mp4', output])
+            with open(output, 'rb') as fh:
+                outputs.append(fh.read())
+        self.assertEqual(outputs[0], outputs[1])
+
+        stdout = io.StringIO()
+        with contextlib.redirect_stdout(stdout):
+            main(['--mmap', output])
+        self.assertIn('EQUI {', stdout.getvalue())
+
+
+class TestParseCache(TempDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.path = os.path.join(self.temp_dir, 'input.mp4')
+        shutil.copy('data/testsrc_320x240_h264.mp4', self.path)
+
+    def parse(self, parse_cache):
+        log = []
+        metadata = metadata_utils.parse_metadata(self.path, log.append,
+                                                 parse_cache)
+        return metadata, log
+
+    def test_repeated_parse_is_cached(self):
+        parse_cache = cache.ParseCache()
+        metadata, log = self.parse(parse_cache)
+        cached_metadata, cached_log = self.parse(parse_cache)
+        self.assertIs(cached_metadata, metadata)
+        self.assertEqual(cached_log, log)
+
+        os.utime(self.path, ns=(0, 0))
+        self.assertIsNot(self.parse(parse_cache)[0], metadata)
+
+    def test_disk_cache(self):
+        directory = os.path.join(self.temp_dir, 'cache')
+        metadata, log = self.parse(cache.ParseCache(directory=directory))
+        cached_metadata, cached_log = self.parse(
+            cache.ParseCache(directory=directory))
+        self.assertEqual(cached_metadata.to_dict(), metadata.to_dict())
+        self.assertEqual(cached_log, log)
+
+        cache.ParseCache(directory=directory, max_disk_size=0).evict_disk()
+        self.assertEqual(os.listdir(directory), [])
+
+    def test_unpicklable_entry(self):
+        directory = os.path.join(self.temp_dir, 'cache')
+        parse_cache = cache.ParseCache(directory=directory)
+        parse_cache.put(self.path, cache.CacheEntry(lambda: None, []))
+        self.assertEqual(os.listdir(directory), [])
+
+    @unittest.skipUnless(hasattr(os, 'getuid'), 'POSIX permissions')
+    def test_shared_directory_is_rejected(self):
+        directory = os.path.join(self.temp_dir, 'cache')
+        cache.ParseCache(directory=directory)
+        self.assertEqual(os.stat(directory).st_mode & 0o777, 0o700)
+        os.chmod(directory, 0o777)
+        with self.assertRaises(ValueError):
+            cache.ParseCache(directory=directory)
+
+    def test_eviction(self):
+        parse_cache = cache.ParseCache()
+        self.parse(parse_cache)
+        entry = cache.CacheEntry(None, [], parse_cache.get(self.path).moov)
+        parse_cache.max_size = entry.size()
+        parse_cache.put('data/testsrc_320x240_vp9.mp4', entry)
+        self.assertIsNone(parse_cache.get(self.path))
+        self.assertIs(parse_cache.get('data/testsrc_320x240_vp9.mp4'), entry)
+        self.assertEqual(parse_cache.current_size, entry.size())
+
+    def test_inject_reuses_moov(self):
+        parse_cache = cache.ParseCache()
+        self.parse(parse_cache)
+        metadata = metadata_utils.Metadata()
+        metadata.video = metadata_utils.generate_spherical_xml()
+
+        outputs = []
+        for injection_cache in (parse_cache, None):
+            output = os.path.join(self.temp_dir, 'output%d.mp4' % len(outputs))
+            metadata_utils.inject_metadata(self.path, output, metadata,
+                                           lambda x: None, injection_cache)
+            with open(output, 'rb') as fh:
+                outputs.append(fh.read())
+        self.assertEqual(outputs[0], outputs[1])
+
+
+class TestBatchInject(TempDirTestCase):
+
+    def run_main(self, args):
+        stdout = io.StringIO()
+        with contextlib.redirect_stdout(stdout):
+            self.assertIsNone(main(args))
+        return dict((result['input'], result) for result in
+                    map(json.loads, stdout.getvalue().splitlines()))
+
+    def test_output_dir(self):
+        inputs = ['data/testsrc_320x240_h264.mp4',
+                  'data/testsrc_320x240_vp9.mp4',
+                  'data/missing.mp4']
+        results = self.run_main(['-i', '--output-dir', self.temp_dir,
+                                 '--jobs', '2'] + inputs)
+
+        self.assertEqual(sorted(results.keys()), sorted(inputs))
+        for input_file in inputs[:2]:
+            result = results[input_file]
+            self.assertEqual(result['status'], 'ok')
+            self.assertEqual(result['output'], os.path.join(
+                self.temp_dir, os.path.basename(input_file)))
+            self.assertEqual(result['bytes_written'],
+                             os.path.getsize(result['output']))
+            self.assertEqual(
+                result['metadata']['video']['Track 0']['ProjectionType'],
+                'equirectangular')
+        self.assertEqual(results['data/missing.mp4']['status'], 'error')
+
+    def test_manifest(self):
+        manifest = os.path.join(self.temp_dir, 'manifest.csv')
+        output = os.path.join(self.temp_dir, 'prores.mov')
+        with open(manifest, 'w') as fh:
+            fh.write('input,output\n')
+            fh.write('data/testsrc_32x24_prores.mov,%s\n' % output)
+        results = self.run_main(['-i', '--v2', '--batch', manifest,
+                                 '--jobs', '1'])
+
+        result = results['data/testsrc_32x24_prores.mov']
+        self.assertEqual(result['status'], 'ok')
+        self.assertTrue(os.path.exists(output))
+
+    def test_malformed_manifest_row(self):
+        manifest = os.path.join(self.temp_dir, 'manifest.csv')
+        output = os.path.join(self.temp_dir, 'prores.mov')
+        with open(manifest, 'w') as fh:
+            fh.write('data/testsrc_320x240_h264.mp4\n')
+            fh.write('data/testsrc_32x24_prores.mov,%s\n' % output)
+        results = self.run_main(['-i', '--batch', manifest, '--jobs', '1'])
+
+        result = results['data/testsrc_320x240_h264.mp4']
+        self.assertEqual(result['status'], 'error')
+        self.assertIn('line 1', result['error'])
+        self.assertEqual(results['data/testsrc_32x24_prores.mov']['status'],
+                         'ok')
+
+    def test_output_dir_duplicate_names(self):
+        os.mkdir(os.path.join(self.temp_dir, 'other'))
+        other = os.path.join(self.temp_dir, 'other', 'testsrc_320x240_h264.mp4')
+        shutil.copy('data/testsrc_320x240_h264.mp4', other)
+        output_dir = os.path.join(self.temp_dir, 'out')
+        stdout = io.StringIO()
+        with contextlib.redirect_stdout(stdout):
+            main(['-i', '--output-dir', output_dir, '--jobs', '1',
+                  'data/testsrc_320x240_h264.mp4', other])
+        self.assertTrue(stdout.getvalue().startswith(
+            'Error, more than one input would be written to: '))
+        self.assertFalse(os.path.exists(output_dir))
+
+    def test_json_inspection(self):
+        output = os.path.join(self.temp_dir, 'v2.mp4')
+        with contextlib.redirect_stdout(io.StringIO()):
+            main(['-i', '--v2', '--stereo', 'top-bottom',
+                  'data/testsrc_320x240_h264.mp4', output])
+        inputs = [output, 'data/testsrc_320x240_vp9.mp4', 'data/missing.mp4']
+        results = self.run_main(['--json', '--jobs', '2'] + inputs)
+
+        self.assertEqual(sorted(results.keys()), sorted(inputs))
+        video_v2 = results[output]['metadata']['video_v2']['Track 0']
+        self.assertEqual(video_v2['projection'], 'equirectangular')
+        self.assertEqual(video_v2['stereo_mode'], 1)
+        self.assertEqual(video_v2['pose'], {'yaw': 0, 'pitch': 0, 'roll': 0})
+        self.assertEqual(
+            results['data/testsrc_320x240_vp9.mp4']['metadata']['video'], {})
+        self.assertEqual(results['data/missing.mp4']['status'], 'error')
+        for result in results.values():
+            self.assertGreaterEqual(result['elapsed_seconds'], 0)
+
+
+class TestObjectStorage(TempDirTestCase):
+
+    def test_plan_parts(self):
+        source = bytes(range(256))
+        Segment = mpeg.mpeg4_container.Segment
+        segments = [Segment(b'abc', None, 3), Segment(None, 0, 100),
+                    Segment(b'defg', None, 4), Segment(None, 200, 5),
+                    Segment(b'hi', None, 2), Segment(None, 100, 50)]
+        parts = storage.plan_parts(segments, 10, 40)
+
+        output = b''
+        for part in parts[:-1]:
+            self.assertGreaterEqual(sum(s.size for s in part), 10)
+        for part in parts:
+            if len(part) == 1 and part[0].data is None:
+                self.assertLessEqual(part[0].size, 40)
+            for segment in part:
+                if segment.data is None:
+                    output += source[segment.position:
+                                     segment.position + segment.size]
+                else:
+                    output += segment.data
+        self.assertEqual(output, b'abc' + source[:100] + b'defg' +
+                         source[200:205] + b'hi' + source[100:150])
+        copied = [part[0].size for part in parts
+                  if len(part) == 1 and part[0].data is None]
+        self.assertEqual(sum(copied), 93 + 50)
+
+    def test_inject(self):
+        shutil.copy('data/testsrc_320x240_h264.mp4',
+                    os.path.join(self.temp_dir, 'in.mp4'))
+        local = storage.LocalStorage(self.temp_dir, min_part_size=256)
+        metadata = metadata_utils.Metadata('equirectangular', 'top-bottom')
+        for faststart in (False, True):
+            expected = os.path.join(self.temp_dir, 'expected.mp4')
+            metadata_utils.inject_metadata(
+                'data/testsrc_320x240_h264.mp4', expected, metadata,
+                lambda x: None, faststart=faststart)
+
+            stats = mpeg.Stats()
+            self.assertIsNone(storage.inject_metadata(
+                local, 'in.mp4', 'out/out.mp4', metadata, lambda x: None,
+                faststart=faststart, stats=stats))
+            with open(expected, 'rb') as fh:
+                expected_data = fh.read()
+            self.assertEqual(local.read('out/out.mp4', 0,
+                                        local.size('out/out.mp4')),
+                             expected_data)
+            counters = stats.counters
+            self.assertGreater(counters['server_copy_bytes'], 2000)
+            self.assertEqual(counters['server_copy_bytes'] +
+                             counters['bytes_uploaded'], len(expected_data))
+        self.assertEqual(sorted(os.listdir(self.temp_dir)),
+                         ['expected.mp4', 'in.mp4', 'out'])
+
+    def test_part_too_small(self):
+        shutil.copy('data/testsrc_320x240_h264.mp4',
+                    os.path.join(self.temp_dir, 'in.mp4'))
+        local = storage.LocalStorage(self.temp_dir, min_part_size=256)
+        upload = local.create_upload('out.mp4')
+        local.upload_part('out.mp4', upload, 1, b'small')
+        local.upload_part_copy('out.mp4', upload, 2, 'in.mp4', 0, 300)
+        with self.assertRaises(ValueError):
+            local.complete_upload('out.mp4', upload, ['', ''])
+        local.abort_upload('out.mp4', upload)
+        self.assertEqual(os.listdir(self.temp_dir), ['in.mp4'])
+
+    def test_incomplete_backend(self):
+        class ReadOnlyStorage(storage.Storage):
+            def head(self, key):
+                return 0, ''
+
+            def read(self, key, start, stop, version=None):
+                return b''
+
+        with self.assertRaises(TypeError):
+            ReadOnlyStorage()
+
+    def test_source_changed(self):
+        source = os.path.join(self.temp_dir, 'in.mp4')
+        shutil.copy('data/testsrc_320x240_h264.mp4', source)
+
+        class OverwritingStorage(storage.LocalStorage):
+            def create_upload(self, key):
+                with open(source, 'ab') as fh:
+                    fh.write(b'\0' * 16)
+                return storage.LocalStorage.create_upload(self, key)
+
+        local = OverwritingStorage(self.temp_dir, min_part_size=256)
+        messages = []
+        storage.inject_metadata(
+            local, 'in.mp4', 'out.mp4',
+            metadata_utils.Metadata('equirectangular'), messages.append)
+        self.assertIn('Error: in.mp4 changed during injection', messages)
+        self.assertEqual(os.listdir(self.temp_dir), ['in.mp4'])
+
+
 if __name__ == '__main__':
     try:
         os.mkdir('test_output')